@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+
+import asyncio
+import configparser
+import contextvars
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from custom_exception import *
+import etl_toolbox as tb
+import file_source
+import log_sink
+import stage_metrics
+from sync_single_tag import plan_task_groups, load_group, merge_group, write_tag_logs
+
+
+class BatchPipeline(object):
+    """ run the groups of a sync batch through fetch, load and merge stages,
+    so fetching the next file overlaps loading the current one and merging the previous one.
+    the blocking work runs in a thread pool, semaphores bound the concurrency of every stage,
+    a file is fetched and loaded by one group at a time and a target table is merged by table_merge_limit groups
+    :param fetch_workers: concurrent downloads
+    :param load_workers: concurrent loads to tempdb
+    :param merge_workers: concurrent merges
+    :param table_merge_limit: concurrent merges into the same target table
+    """
+
+    def __init__(self, fetch_workers=2, load_workers=2, merge_workers=2, table_merge_limit=1):
+        self.fetch_workers = fetch_workers
+        self.load_workers = load_workers
+        self.merge_workers = merge_workers
+        self.table_merge_limit = table_merge_limit
+        self.stats = {"groups": 0, "fail": 0, "wall_seconds": None,
+                      "busy_seconds": {"fetch": 0.0, "load": 0.0, "merge": 0.0}}
+
+    async def _run_blocking(self, stage_name, func, *args):
+        """ run func in the thread pool with the context of the caller, so the stages are recorded """
+        start = time.time()
+        context = contextvars.copy_context()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, context.run, func, *args)
+        finally:
+            self.stats["busy_seconds"][stage_name] += time.time() - start
+
+    def _lock_of(self, lock_dict, key, limit):
+        if key not in lock_dict:
+            lock_dict[key] = asyncio.Semaphore(limit)
+        return lock_dict[key]
+
+    async def _sync_group(self, request_id, task_id, group_key, detail_list, file_modify_time):
+        """ same result as sync_single_tag.sync_group
+        :return: None on success, the error message on failure
+        """
+        file_name, file_path, target_schema, target_table, tag_storage_type = group_key
+        start_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        file_lock = self._lock_of(self._file_locks, file_name, 1)
+
+        # the prefetched files waiting for their load are bounded, so the downloads cannot fill the disk,
+        # the file lock is taken before the ahead and stage slots, a group waiting for its file holds no slot
+        async with file_lock, self._ahead:
+            if file_modify_time is not None:
+                async with self._fetch:
+                    try:
+                        await self._run_blocking("fetch", tb.prefetch_file, file_name, file_path, file_modify_time)
+                    except FileloadError as e:
+                        # the load fetches it again and reports the error
+                        print("Prefetch {} fail: {}".format(file_name, str(e)))
+
+            async with self._load:
+                try:
+                    pk_string, derived_tuple, file_modify_time = await self._run_blocking(
+                        "load", load_group, group_key, None, file_modify_time)
+                except (LookupError, FileloadError) as e:
+                    await self._run_blocking("load", write_tag_logs, request_id, task_id, detail_list, file_name,
+                                             None, start_time, "fail", str(e))
+                    return str(e)
+                finally:
+                    await self._run_blocking("load", _drop_prefetched, file_name, file_modify_time)
+
+        async with self._merge, self._lock_of(self._table_locks, (target_schema, target_table),
+                                              self.table_merge_limit):
+            try:
+                await self._run_blocking("merge", merge_group, group_key, detail_list, pk_string, derived_tuple,
+                                         file_modify_time)
+            except Exception as e:
+                await self._run_blocking("merge", write_tag_logs, request_id, task_id, detail_list, file_name,
+                                         None, start_time, "fail", str(e))
+                return str(e)
+            await self._run_blocking("merge", write_tag_logs, request_id, task_id, detail_list, file_name,
+                                     file_modify_time, start_time, "success", None)
+        return None
+
+    async def run(self, request_id, task_id, group_dict, stat_dict):
+        """ sync every group of group_dict, see sync_single_tag.plan_task_groups
+        :param stat_dict: file path -> modification time, the files missing are stated by the loader
+        :return: list of error messages of the failed groups
+        """
+        # the semaphores belong to the running event loop
+        self._fetch = asyncio.Semaphore(self.fetch_workers)
+        self._load = asyncio.Semaphore(self.load_workers)
+        self._merge = asyncio.Semaphore(self.merge_workers)
+        self._ahead = asyncio.Semaphore(self.fetch_workers + self.load_workers)
+        self._file_locks = dict()
+        self._table_locks = dict()
+
+        start = time.time()
+        self._executor = ThreadPoolExecutor(self.fetch_workers + self.load_workers + self.merge_workers,
+                                            thread_name_prefix="batch-pipeline")
+        try:
+            result_list = await asyncio.gather(*[
+                self._sync_group(request_id, task_id, group_key, detail_list, stat_dict.get(group_key[1]))
+                for group_key, detail_list in group_dict.items()])
+        finally:
+            self._executor.shutdown()
+        self.stats["wall_seconds"] = round(time.time() - start, 3)
+        self.stats["busy_seconds"] = dict([(x, round(y, 3)) for x, y in self.stats["busy_seconds"].items()])
+        error_list = [x for x in result_list if x]
+        self.stats["groups"] = len(result_list)
+        self.stats["fail"] = len(error_list)
+        return error_list
+
+
+def _drop_prefetched(file_name, file_modify_time):
+    """ remove a prefetched file the load did not use, e.g. another job loaded the version meanwhile """
+    if file_modify_time is None:
+        return
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    local_path = tb.prefetch_path(config['paths']['csv_base'], file_name, file_modify_time)
+    if os.path.exists(local_path):
+        os.remove(local_path)
+
+
+def sync_batch(task_id, tag_name_list=None, src_file_name=None, request_id=None):
+    """ like sync_single_tag.sync_multi_task, with the groups run through a BatchPipeline,
+    the concurrency is read from [pipeline] fetch_workers, load_workers, merge_workers and table_merge_limit
+    :param task_id: unique id for the tag sync task
+    :param tag_name_list: English names of tags, None means all tags of the task
+    :param src_file_name: only sync the tags sourced from this file, None means no filter
+    :param request_id: the id provided by app to link the original log
+    """
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    pipeline_cfg = config['pipeline'] if config.has_section('pipeline') else dict()
+    pipeline = BatchPipeline(int(pipeline_cfg.get('fetch_workers', 2)), int(pipeline_cfg.get('load_workers', 2)),
+                             int(pipeline_cfg.get('merge_workers', 2)), int(pipeline_cfg.get('table_merge_limit', 1)))
+
+    with log_sink.flush_on_error(), stage_metrics.recording(request_id, task_id):
+        group_dict = plan_task_groups(task_id, tag_name_list, src_file_name)
+        with stage_metrics.stage("hdfs_stat") as metric:
+            stat_dict = file_source.get_file_source().stat_many(sorted(set([x[1] for x in group_dict])))
+            metric.rows = len(stat_dict)
+        error_list = asyncio.run(pipeline.run(request_id, task_id, group_dict, stat_dict))
+        print("Batch pipeline stats: {}".format(pipeline.stats))
+
+    if error_list:
+        raise Exception("; ".join(error_list))
@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+""" throughput of the load stream for plain, gzip and zstd input, without a database:
+the file is read through open_decompressed, optionally with the line_hash column appended,
+and the output must equal the output of the plain file
+"""
+
+import argparse
+import gzip
+import hashlib
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import csv_stream
+
+
+def generate_csv(file_path, row_count):
+    with open(file_path, 'w') as f:
+        f.write("id,level,geo_point,tag_0,tag_1\n")
+        for i in range(row_count):
+            f.write("{},{},POINT({:.6f} {:.6f}),{},{}\n".format(
+                i, random.randint(1, 20), random.uniform(70, 140), random.uniform(10, 50),
+                random.choice(["a", "b", "c", ""]), random.randint(0, 1000)))
+
+
+def compress(plain_path, codec, level):
+    out_path = "{}.{}".format(plain_path, "gz" if codec == "gzip" else "zst")
+    with open(plain_path, 'rb') as src:
+        data = src.read()
+    if codec == "gzip":
+        data = gzip.compress(data, compresslevel=level)
+    else:
+        import zstandard
+        data = zstandard.ZstdCompressor(level=level).compress(data)
+    with open(out_path, 'wb') as dst:
+        dst.write(data)
+    return out_path
+
+
+def read_stream(file_path, detail):
+    """ :return: (seconds, output bytes, md5 of the output) """
+    start = time.time()
+    f = csv_stream.open_decompressed(open(file_path, 'rb'), file_path)
+    if detail:
+        f = csv_stream.HashedLineReader(f)
+    digest = hashlib.md5()
+    size = 0
+    with f:
+        while True:
+            chunk = f.read(1 << 16)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+    return time.time() - start, size, digest.hexdigest()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=500000, help='rows of the generated csv')
+    parser.add_argument('--detail', action='store_true', help='append line_hash like a detail file')
+    args = parser.parse_args()
+
+    case_list = [("plain", None, None), ("gzip -1", "gzip", 1), ("gzip -6", "gzip", 6)]
+    try:
+        import zstandard
+        case_list = case_list + [("zstd -3", "zstd", 3), ("zstd -19", "zstd", 19)]
+    except ImportError:
+        print("zstandard is not installed, zstd is skipped")
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        plain_path = os.path.join(work_dir, "bench.csv")
+        generate_csv(plain_path, args.rows)
+        plain_size = os.path.getsize(plain_path)
+        plain_digest = None
+        for name, codec, level in case_list:
+            file_path = plain_path if codec is None else compress(plain_path, codec, level)
+            seconds, size, digest = read_stream(file_path, args.detail)
+            if plain_digest is None:
+                plain_digest = digest
+            elif digest != plain_digest:
+                raise SystemExit("{} output differs from the plain file".format(name))
+            print("{}: file {:.1f}MB ({:.1%} of plain), {:.3f}s, {:.1f}MB/s of csv".format(
+                name, os.path.getsize(file_path) / (1 << 20), os.path.getsize(file_path) / plain_size, seconds,
+                size / (1 << 20) / seconds))
+            if codec is not None:
+                os.remove(file_path)
@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import csv_stream
+
+MD5_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'md5_csv_line.sh')
+
+
+def generate_csv(file_path, row_count):
+    """ write a sample csv, includes blank padded values, backslashes and a last line without line ending """
+    with open(file_path, 'w') as f:
+        f.write("id,level,geo_point,val\n")
+        for i in range(row_count):
+            val = random.choice(["a", " padded ", "back\\slash", "", "\tx"])
+            line = "{},{},POINT({} {}),{}".format(i, random.randint(1, 20), random.random(), random.random(), val)
+            if i < row_count - 1:
+                line = line + "\n"
+            f.write(line)
+
+
+def run_shell(work_dir, csv_name):
+    """ run md5_csv_line.sh, it reads csv_base from connection.cfg in the current directory """
+    with open(os.path.join(work_dir, 'connection.cfg'), 'w') as f:
+        f.write("[paths]\ncsv_base={}\n".format(work_dir))
+    start = time.time()
+    subprocess.run(['bash', MD5_SCRIPT, csv_name], cwd=work_dir, check=True, stdout=subprocess.DEVNULL)
+    return time.time() - start
+
+
+def run_python(csv_path, out_path, workers):
+    start = time.time()
+    with csv_stream.open_detail_stream(csv_path, workers) as reader, open(out_path, 'wb') as out:
+        while True:
+            data = reader.read(1 << 16)
+            if not data:
+                break
+            out.write(data)
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=20000, help='rows of the generated csv')
+    parser.add_argument('--workers', type=int, default=4, help='processes of the parallel python hasher')
+    parser.add_argument('--skip-shell', action='store_true', help='do not run md5_csv_line.sh')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        csv_name = "bench.csv"
+        csv_path = os.path.join(work_dir, csv_name)
+        generate_csv(csv_path, args.rows)
+
+        seconds = run_python(csv_path, csv_path + ".py1", 1)
+        print("python, 1 worker: {:.3f}s, {:.0f} lines/s".format(seconds, args.rows / seconds))
+        seconds = run_python(csv_path, csv_path + ".pyn", args.workers)
+        print("python, {} workers: {:.3f}s, {:.0f} lines/s".format(args.workers, seconds, args.rows / seconds))
+
+        with open(csv_path + ".py1", 'rb') as f1, open(csv_path + ".pyn", 'rb') as f2:
+            if f1.read() != f2.read():
+                raise SystemExit("parallel output differs from sequential output")
+
+        if not args.skip_shell:
+            seconds = run_shell(work_dir, csv_name)
+            print("md5_csv_line.sh: {:.3f}s, {:.0f} lines/s".format(seconds, args.rows / seconds))
+            with open(csv_path + ".detail", 'rb') as f1, open(csv_path + ".py1", 'rb') as f2:
+                if f1.read() != f2.read():
+                    raise SystemExit("python output differs from md5_csv_line.sh output")
+            print("python output is byte identical with md5_csv_line.sh")
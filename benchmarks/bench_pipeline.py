@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+""" benchmark the file to tag pipeline stage by stage on synthetic data
+it needs a throwaway postgresql (and mysql for --end-to-end) given by a connection.cfg, HDFS is replaced by
+tools/fake_hadoop.py. every run writes a generated connection.cfg to a temp dir and works there:
+    cd <dir of your connection.cfg> && python benchmarks/bench_pipeline.py --rows 10000 100000 --output bench.json
+results are json lines, one per case and stage. --baseline compares with a previous result file and exits with 1
+when a stage is slower than the tolerance allows
+"""
+
+import argparse
+import configparser
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO_DIR)
+import db_pool
+import etl_toolbox as tb
+
+FAKE_HADOOP = os.path.join(REPO_DIR, 'tools', 'fake_hadoop.py')
+
+# tables of the metadata database, only the columns used by the sync
+MYSQL_FIXTURE_DDL = [
+    "create table if not exists bench_sync_rule (task_id varchar(64), tag_name_en varchar(128),"
+    " src_file_name varchar(256), src_file_path varchar(1024), schema_name varchar(128), table_name varchar(128),"
+    " tag_data_type varchar(32), tag_storage_type varchar(32), upload_method varchar(32),"
+    " derived_field varchar(128), derived_value varchar(128), derived_source_column varchar(128))",
+    "create table if not exists bench_pk_table (table_name varchar(128), primary_key varchar(1024))",
+    "create table if not exists bench_log_file (file_name varchar(256), file_path varchar(1024),"
+    " file_hdfs_time datetime, start_time datetime, end_time datetime, status varchar(32), error_msg text,"
+    " tmp_table_schema varchar(128), tmp_table_name varchar(128), delta_base_time datetime,"
+    " delta_inserted bigint, delta_changed bigint, delta_deleted bigint, reject_rows bigint, reject_file varchar(1024),"
+    " load_checkpoint text, file_checksum varchar(128), primary key (file_name, file_hdfs_time))",
+    "create table if not exists bench_log_tag (request_id varchar(64), sync_task_id varchar(64),"
+    " tag_name_en varchar(128), file_name varchar(256), file_hdfs_time datetime, start_time datetime,"
+    " end_time datetime, status varchar(32), error_msg text)",
+    "create table if not exists bench_stage_metrics (request_id varchar(64), sync_task_id varchar(64),"
+    " tag_name_en varchar(128), file_name varchar(256), stage varchar(32), start_time datetime,"
+    " duration_ms bigint, row_count bigint, byte_count bigint, status varchar(32), detail text,"
+    " key (request_id))",
+]
+
+
+def write_config(source_cfg, work_dir):
+    """ copy the database sections and point paths and metadata tables to the benchmark fixtures """
+    config = configparser.ConfigParser()
+    config.read(source_cfg)
+    bench_config = configparser.ConfigParser()
+    for section in ['mysql', 'postgre', 'pool']:
+        if config.has_section(section):
+            bench_config[section] = dict(config[section])
+    # the dedup stage is timed on its own, so the raw staging table must exist
+    bench_config['postgre']['dedup_mode'] = 'server'
+    bench_config['paths'] = {'hadoop_cmd': FAKE_HADOOP, 'csv_base': os.path.join(work_dir, 'csv')}
+    bench_config['mysql_tables'] = {'sync_rule': 'bench_sync_rule', 'pk_table': 'bench_pk_table',
+                                    'log_file': 'bench_log_file', 'log_tag': 'bench_log_tag',
+                                    'stage_metrics': 'bench_stage_metrics'}
+    with open(os.path.join(work_dir, 'connection.cfg'), 'w') as f:
+        bench_config.write(f)
+    os.makedirs(os.path.join(work_dir, 'csv'), exist_ok=True)
+    os.makedirs(os.path.join(work_dir, 'hdfs'), exist_ok=True)
+    return bench_config
+
+
+def generate_csv(file_path, rows, columns, dup_ratio, derived_columns):
+    """ id,level then columns tag columns and derived_columns derived source columns
+    :return: (tag column list, derived source column list)
+    """
+    tag_list = ["tag_{}".format(i) for i in range(columns)]
+    derived_list = ["src_{}".format(i) for i in range(derived_columns)]
+    with open(file_path, 'w') as f:
+        f.write(",".join(["id", "level"] + tag_list + derived_list) + "\n")
+        for i in range(rows):
+            key = random.randint(0, max(i - 1, 0)) if random.random() < dup_ratio else i
+            values = [str(key), str(key % 20)]
+            values = values + ["{:.4f}".format(random.random()) for x in tag_list]
+            values = values + ["" if random.random() < 0.3 else str(random.randint(0, 100)) for x in derived_list]
+            f.write(",".join(values) + "\n")
+    return tag_list, derived_list
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def run_case(bench_config, work_dir, rows, columns, dup_ratio, derived_columns):
+    """ run every stage once
+    :return: dict of stage -> seconds
+    """
+    tmp_schema = bench_config['postgre']['tmp_schema']
+    file_name = "bench_{}_{}_{}.csv".format(rows, columns, derived_columns)
+    table_name = file_name.split('.')[0]
+    hdfs_path = "/bench/" + file_name
+    local_hdfs_file = os.path.join(work_dir, 'hdfs', 'bench', file_name)
+    os.makedirs(os.path.dirname(local_hdfs_file), exist_ok=True)
+    tag_list, derived_list = generate_csv(local_hdfs_file, rows, columns, dup_ratio, derived_columns)
+    csv_base = bench_config['paths']['csv_base']
+    local_file = os.path.join(csv_base, file_name)
+
+    stage_dict = dict()
+    stage_dict["hdfs_stat"], result = timed(subprocess.check_output, [FAKE_HADOOP, 'fs', '-stat', '%y', hdfs_path])
+    if os.path.exists(local_file):
+        os.remove(local_file)
+    stage_dict["fetch"], result = timed(subprocess.check_call, [FAKE_HADOOP, 'fs', '-get', hdfs_path, csv_base])
+    stage_dict["load"], result = timed(tb.load_csv_to_pg, table_name, local_file, "id,level", "tag", tuple())
+
+    # the dedup statement alone, the copy part of the load is load - dedup
+    dedup_sql = "drop table if exists {0}_dedup; create table {0}_dedup as select * from (" \
+                " select a.*, row_number() over (partition by id,level) as rrn from {0} a) b where b.rrn = 1" \
+        .format(table_name)
+    stage_dict["dedup"], result = timed(tb.postgre_executor, tmp_schema, dedup_sql, None)
+    stage_dict["copy"] = stage_dict["load"] - stage_dict["dedup"]
+
+    source_table = table_name + "_dedup"
+    if derived_list:
+        derived_tuple = ("brand", ",".join(["{}:b{}:derived_val".format(x, i) for i, x in enumerate(derived_list)]))
+        fields_list = ["id", "level"] + tag_list + derived_list + ["rrn"]
+        derive_sql = tb.create_derived_table(tmp_schema, source_table, derived_tuple, fields_list=fields_list)
+        stage_dict["derive"], result = timed(tb.postgre_executor, tmp_schema, derive_sql, None)
+
+    # merge all tag columns into a fresh target table
+    target_table = table_name + "_target"
+    target_sql = "drop table if exists {0}; create table {0} (id varchar(4000), level integer, {1}," \
+                 " primary key (id, level))".format(target_table, ", ".join([x + " numeric" for x in tag_list]))
+    tb.postgre_executor(tmp_schema, target_sql, None)
+    merge_tag_list = [(x, "numeric") for x in tag_list]
+    stage_dict["merge"], result = timed(tb.merge_tags, tmp_schema, source_table, tmp_schema, target_table,
+                                        "id,level", merge_tag_list)
+    stage_dict["merge_again"], result = timed(tb.merge_tags, tmp_schema, source_table, tmp_schema, target_table,
+                                              "id,level", merge_tag_list)
+
+    drop_sql = "drop table if exists {0}; drop table if exists {0}_dedup; drop table if exists {0}_dedup_derived;" \
+               "drop table if exists {1}".format(table_name, target_table)
+    tb.postgre_executor(tmp_schema, drop_sql, None)
+    return stage_dict
+
+
+def run_end_to_end(bench_config, work_dir, rows, columns, dup_ratio):
+    """ sync every tag of a generated file through sync_multi_task with metadata fixtures in mysql """
+    from sync_single_tag import sync_multi_task
+
+    tmp_schema = bench_config['postgre']['tmp_schema']
+    file_name = "bench_e2e_{}_{}.csv".format(rows, columns)
+    table_name = file_name.split('.')[0]
+    target_table = table_name + "_target"
+    local_hdfs_file = os.path.join(work_dir, 'hdfs', 'bench', file_name)
+    os.makedirs(os.path.dirname(local_hdfs_file), exist_ok=True)
+    tag_list, derived_list = generate_csv(local_hdfs_file, rows, columns, dup_ratio, 0)
+
+    for ddl in MYSQL_FIXTURE_DDL:
+        tb.mysql_executor(ddl, None)
+    task_id = "bench_{}".format(int(time.time()))
+    for tag_name in tag_list:
+        tb.mysql_executor("insert into bench_sync_rule (task_id, tag_name_en, src_file_name, src_file_path,"
+                          " schema_name, table_name, tag_data_type, tag_storage_type, upload_method)"
+                          " values (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                          (task_id, tag_name, file_name, "/bench/" + file_name, tmp_schema, target_table,
+                           "numeric", "tag", "incremental"))
+    tb.mysql_executor("insert into bench_pk_table (table_name, primary_key) values (%s, %s)",
+                      (target_table, "id,level"))
+    target_sql = "drop table if exists {0}; create table {0} (id varchar(4000), level integer, {1}," \
+                 " primary key (id, level))".format(target_table, ", ".join([x + " numeric" for x in tag_list]))
+    tb.postgre_executor(tmp_schema, target_sql, None)
+
+    seconds, result = timed(sync_multi_task, task_id, None, None, "bench")
+    return {"end_to_end": seconds}
+
+
+def compare_baseline(result_list, baseline_path, tolerance):
+    """ :return: list of regression messages """
+    baseline = dict()
+    with open(baseline_path) as f:
+        for line in f:
+            item = json.loads(line)
+            baseline[(item["case"], item["stage"])] = item["seconds"]
+    message_list = list()
+    for item in result_list:
+        old_seconds = baseline.get((item["case"], item["stage"]))
+        if old_seconds and item["seconds"] > old_seconds * (1 + tolerance) and item["seconds"] - old_seconds > 0.05:
+            message_list.append("{} {}: {:.3f}s -> {:.3f}s".format(item["case"], item["stage"], old_seconds,
+                                                                   item["seconds"]))
+    return message_list
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='connection.cfg', help='connection.cfg with the throwaway databases')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000], help='row counts to run')
+    parser.add_argument('--columns', type=int, nargs='+', default=[1, 10], help='tag column counts to run')
+    parser.add_argument('--dup-ratio', type=float, nargs='+', default=[0.0, 0.2], help='duplicated key ratios')
+    parser.add_argument('--derived-columns', type=int, nargs='+', default=[0, 4], help='derived column counts')
+    parser.add_argument('--end-to-end', action='store_true', help='also run sync_multi_task, needs mysql')
+    parser.add_argument('--output', default='bench_output.json', help='json lines result file')
+    parser.add_argument('--baseline', default=None, help='previous result file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown ratio against baseline')
+    args = parser.parse_args()
+
+    source_cfg = os.path.abspath(args.config)
+    output_path = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    result_list = list()
+    with tempfile.TemporaryDirectory(prefix="bench_pipeline_") as work_dir:
+        bench_config = write_config(source_cfg, work_dir)
+        os.environ['FAKE_HDFS_ROOT'] = os.path.join(work_dir, 'hdfs')
+        os.chdir(work_dir)
+        random.seed(42)
+
+        for rows in args.rows:
+            for columns in args.columns:
+                for dup_ratio in args.dup_ratio:
+                    for derived_columns in args.derived_columns:
+                        case = "rows={} columns={} dup_ratio={} derived={}".format(rows, columns, dup_ratio,
+                                                                                   derived_columns)
+                        print("Run case {}".format(case))
+                        stage_dict = run_case(bench_config, work_dir, rows, columns, dup_ratio, derived_columns)
+                        for stage, seconds in stage_dict.items():
+                            result_list.append({"case": case, "rows": rows, "columns": columns,
+                                                "dup_ratio": dup_ratio, "derived_columns": derived_columns,
+                                                "stage": stage, "seconds": round(seconds, 4),
+                                                "rows_per_second": round(rows / seconds, 1) if seconds > 0 else None})
+                if args.end_to_end:
+                    case = "end_to_end rows={} columns={}".format(rows, columns)
+                    stage_dict = run_end_to_end(bench_config, work_dir, rows, columns, args.dup_ratio[0])
+                    result_list.append({"case": case, "rows": rows, "columns": columns, "stage": "end_to_end",
+                                        "seconds": round(stage_dict["end_to_end"], 4)})
+        db_pool.close_all()
+
+    with open(output_path, 'w') as f:
+        for item in result_list:
+            f.write(json.dumps(item) + "\n")
+    print("Results written to {}".format(output_path))
+
+    if baseline_path:
+        message_list = compare_baseline(result_list, baseline_path, args.tolerance)
+        if message_list:
+            print("Regressions against {}:".format(baseline_path))
+            print("\n".join(message_list))
+            sys.exit(1)
+        print("No regression against {}".format(baseline_path))
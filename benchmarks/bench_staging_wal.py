@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+""" compare bytes written by logged varchar staging tables and unlogged typed staging tables
+run it from the directory of connection.cfg, the staging tables are created in [postgre] tmp_schema
+"""
+
+import argparse
+import configparser
+import io
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import db_pool
+import etl_toolbox as tb
+
+
+def generate_csv(row_count, dup_ratio):
+    lines = ["id,level,geo_point,score,flag"]
+    for i in range(row_count):
+        key = random.randint(0, i) if random.random() < dup_ratio else i
+        lines.append("{},{},POINT({:.6f} {:.6f}),{:.4f},{}".format(
+            key, random.randint(1, 20), random.uniform(70, 140), random.uniform(10, 50), random.random(),
+            random.choice(["t", "f"])))
+    return ("\n".join(lines) + "\n").encode('UTF-8')
+
+
+def measure(tmp_schema, table_name, data, column_type_dict, staging_mode):
+    with db_pool.pg_connection(tmp_schema) as conn:
+        cur = conn.cursor()
+        start_lsn = tb.current_wal_lsn(cur)
+        conn.commit()
+    tb.load_stream_to_pg(table_name, io.BytesIO(data), "id,level", tuple(), column_type_dict, staging_mode)
+    with db_pool.pg_connection(tmp_schema) as conn:
+        cur = conn.cursor()
+        report = tb.staging_write_report(cur, start_lsn, [table_name, table_name + "_dedup"], staging_mode)
+        cur.execute("drop table if exists {0}; drop table if exists {0}_dedup".format(table_name))
+        conn.commit()
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=200000, help='rows of the generated csv')
+    parser.add_argument('--dup-ratio', type=float, default=0.1, help='ratio of duplicated keys')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    tmp_schema = config['postgre']['tmp_schema']
+
+    data = generate_csv(args.rows, args.dup_ratio)
+    typed = {"id": "text", "level": "integer", "geo_point": '"public"."geometry"', "score": "numeric",
+             "flag": "bool"}
+    for name, column_type_dict, staging_mode in [("logged varchar", None, "logged"),
+                                                 ("unlogged typed", typed, "unlogged")]:
+        report = measure(tmp_schema, "bench_staging_wal", data, column_type_dict, staging_mode)
+        print("{}: wal_bytes={} table_bytes={}".format(name, report["wal_bytes"], report["table_bytes"]))
+    db_pool.close_all()
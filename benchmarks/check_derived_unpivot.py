@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+""" check the lateral VALUES unpivot of create_derived_table against the union all reference
+on sample data, and time both. run it from the directory of connection.cfg
+"""
+
+import argparse
+import configparser
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import db_pool
+import etl_toolbox as tb
+
+
+def create_sample_table(cur, table_name, row_count, source_count):
+    """ id, other and source_count derived source columns, about a third of the values are null """
+    source_list = ["src_{}".format(i) for i in range(source_count)]
+    cur.execute("drop table if exists {}".format(table_name))
+    cur.execute("create table {} (id varchar(4000), other varchar(4000), {}, rrn bigint)".format(
+        table_name, ", ".join(["{} varchar(4000)".format(x) for x in source_list])))
+    row_list = list()
+    for i in range(row_count):
+        values = [str(i), random.choice(["good", "bad", None])]
+        values = values + [None if random.random() < 0.3 else str(random.randint(0, 100)) for x in source_list]
+        row_list.append(tuple(values) + (1,))
+    cur.executemany("insert into {} values ({})".format(table_name, ", ".join(["%s"] * (source_count + 3))), row_list)
+    derived_str = ",".join(["{}:v{}:val".format(x, i) for i, x in enumerate(source_list)])
+    return ("brand", derived_str), ["id", "other"] + source_list + ["rrn"]
+
+
+def run(cur, create_sql):
+    start = time.time()
+    cur.execute(create_sql)
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=20000, help='rows of the sample table')
+    parser.add_argument('--sources', type=int, default=12, help='number of derived source columns')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    tmp_schema = config['postgre']['tmp_schema']
+
+    with db_pool.pg_connection(tmp_schema) as conn:
+        cur = conn.cursor()
+        derived_tuple, fields_list = create_sample_table(cur, "check_unpivot", args.rows, args.sources)
+        conn.commit()
+
+        union_seconds = run(cur, tb.create_derived_table_union(tmp_schema, "check_unpivot", derived_tuple,
+                                                               fields_list=fields_list))
+        cur.execute("alter table check_unpivot_derived rename to check_unpivot_union")
+        unpivot_seconds = run(cur, tb.create_derived_table(tmp_schema, "check_unpivot", derived_tuple,
+                                                           fields_list=fields_list))
+
+        cur.execute("select count(*) from (select * from check_unpivot_union except all "
+                    " select * from check_unpivot_derived) a")
+        missing = cur.fetchone()[0]
+        cur.execute("select count(*) from (select * from check_unpivot_derived except all "
+                    " select * from check_unpivot_union) a")
+        extra = cur.fetchone()[0]
+        cur.execute("select count(*) from check_unpivot_derived")
+        row_count = cur.fetchone()[0]
+        cur.execute("drop table check_unpivot; drop table check_unpivot_union; drop table check_unpivot_derived")
+        conn.commit()
+    db_pool.close_all()
+
+    print("union all: {:.3f}s, unpivot: {:.3f}s, {} derived rows".format(union_seconds, unpivot_seconds, row_count))
+    if missing or extra:
+        raise SystemExit("unpivot output differs: {} rows missing, {} rows extra".format(missing, extra))
+    print("unpivot output equals union all output")
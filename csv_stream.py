@@ -0,0 +1,814 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+
+import csv
+import functools
+import gzip
+import hashlib
+import io
+import mmap
+import os
+import re
+import shlex
+import sqlite3
+import subprocess
+import tempfile
+import time
+import multiprocessing
+from custom_exception import *
+
+
+class LineStreamReader(object):
+    """ file like object which reads a binary stream line by line and transforms each line,
+    it can be passed to cursor.copy_expert directly so nothing is written to disk
+    :param fileobj: binary file like object to read from
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.line_no = 0
+        self.bytes_in = 0
+        # time spent in transform, reported as a stage of the load
+        self.transform_seconds = 0.0
+        self._buffer = b""
+        self._eof = False
+
+    def transform(self, line):
+        """ transform one line, override it in subclass
+        :param line: bytes of one line, include the line ending
+        :return: bytes to output, None to drop the line
+        """
+        return line
+
+    def finish(self):
+        """ called once after the last line, override it to release resources """
+        pass
+
+    def _read_unit(self):
+        """ read the next unit to transform from the wrapped stream, a line by default """
+        return self.fileobj.readline()
+
+    def _next_line(self):
+        """ read and transform lines until one is kept
+        :return: transformed bytes, empty bytes at the end of stream
+        """
+        while True:
+            line = self._read_unit()
+            if not line:
+                if not self._eof:
+                    self._eof = True
+                    self.finish()
+                return b""
+            self.bytes_in += len(line)
+            start = time.perf_counter()
+            new_line = self.transform(line)
+            self.transform_seconds += time.perf_counter() - start
+            self.line_no += 1
+            if new_line is not None:
+                return new_line
+
+    def readline(self, size=-1):
+        if self._buffer:
+            line, self._buffer = self._buffer, b""
+        else:
+            line = self._next_line()
+        return line
+
+    def read(self, size=-1):
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        self._buffer = b""
+        while size is None or size < 0 or length < size:
+            line = self._next_line()
+            if not line:
+                break
+            chunks.append(line)
+            length += len(line)
+
+        data = b"".join(chunks)
+        if size is not None and 0 <= size < len(data):
+            data, self._buffer = data[:size], data[size:]
+        return data
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # let the wrapped stream decide how to close, e.g. CommandStream checks the exit code
+        return self.fileobj.__exit__(exc_type, exc_val, exc_tb)
+
+
+class CommandStream(object):
+    """ binary file like object of the stdout of a reader command, e.g. `hadoop fs -cat <path>`
+    the pipe blocks the command while the consumer is slower, so nothing is buffered on disk
+    closing the stream waits for the command and raises FileloadError when it failed,
+    so a truncated output is never taken as a complete file
+    :param cmd_list: command and arguments
+    """
+
+    def __init__(self, cmd_list):
+        self.cmd_list = cmd_list
+        # stderr goes to a temp file, a full stderr pipe would block the command
+        self._stderr = tempfile.TemporaryFile()
+        try:
+            self.proc = subprocess.Popen(cmd_list, stdout=subprocess.PIPE, stderr=self._stderr)
+        except OSError as e:
+            self._stderr.close()
+            raise FileloadError("Reader command {} cannot start: {}".format(cmd_list[0], str(e)))
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.proc.stdout.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def readline(self, size=-1):
+        line = self.proc.stdout.readline(size)
+        self.bytes_read += len(line)
+        return line
+
+    def peek(self, size=1):
+        """ look at the next bytes without consuming them, e.g. the magic bytes of a compressed file """
+        return self.proc.stdout.peek(size)
+
+    def kill(self):
+        """ stop the command without checking the result """
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.stdout.close()
+        self.proc.wait()
+        self._stderr.close()
+
+    def close(self):
+        if self.proc.stdout.closed:
+            return
+        # the consumer must have reached EOF, otherwise the command is still writing
+        if self.proc.stdout.read(1):
+            self.kill()
+            raise FileloadError("Reader command {} output was not fully consumed.".format(" ".join(self.cmd_list)))
+        self.proc.stdout.close()
+        return_code = self.proc.wait()
+        self._stderr.seek(0)
+        error_output = self._stderr.read().decode('UTF-8', 'replace').strip()
+        self._stderr.close()
+        if return_code != 0:
+            raise FileloadError("Reader command {} failed with code {}: {}".format(
+                " ".join(self.cmd_list), return_code, error_output[-1000:]))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.kill()
+        else:
+            self.close()
+
+
+def open_command_stream(cmd_template, file_path):
+    """ start a reader command for a file
+    :param cmd_template: command line, {path} is replaced by file_path, e.g. "hadoop fs -cat {path}"
+    :param file_path: the file to read
+    :return: CommandStream
+    """
+    cmd_list = [x.replace('{path}', file_path) for x in shlex.split(cmd_template)]
+    print("Stream file by: {}".format(" ".join(cmd_list)))
+    return CommandStream(cmd_list)
+
+
+class RawInput(io.RawIOBase):
+    """ raw io adapter of a stream with read(size) only, so it can be buffered and read by lines """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.stream.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.stream.close()
+        super().close()
+
+
+COMPRESSION_EXTENSIONS = {".gz": "gzip", ".gzip": "gzip", ".zst": "zstd", ".zstd": "zstd"}
+COMPRESSION_MAGIC = {b"\x1f\x8b": "gzip", b"\x28\xb5\x2f\xfd": "zstd"}
+
+
+def detect_compression(file_name, head=b""):
+    """ find the codec of a file by its extension, or by the magic bytes at its head
+    :param file_name: file name or path
+    :param head: the first bytes of the file, 4 bytes are enough
+    :return: gzip, zstd or None for a plain file
+    """
+    codec = COMPRESSION_EXTENSIONS.get(os.path.splitext(file_name)[1].lower())
+    if codec is None:
+        for magic, magic_codec in COMPRESSION_MAGIC.items():
+            if head.startswith(magic):
+                codec = magic_codec
+    return codec
+
+
+class DecompressedStream(object):
+    """ binary file like object of the decompressed content of a gzip or zstd stream,
+    nothing is written to disk. closing it closes the compressed stream, so CommandStream still checks the exit code
+    zstd needs the zstandard package
+    :param fileobj: binary file like object of the compressed content
+    :param codec: gzip or zstd
+    """
+
+    def __init__(self, fileobj, codec):
+        self.fileobj = fileobj
+        self.codec = codec
+        self.bytes_out = 0
+        # time spent reading and decompressing, reported as a stage of the load
+        self.seconds = 0.0
+        if codec == "gzip":
+            # reads every member of a concatenated gzip file
+            self._reader = gzip.GzipFile(fileobj=fileobj, mode='rb')
+        elif codec == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise FileloadError("zstd compressed input needs the zstandard package.")
+            self._reader = io.BufferedReader(RawInput(zstandard.ZstdDecompressor().stream_reader(
+                fileobj, read_size=1 << 20, read_across_frames=True)), 1 << 20)
+        else:
+            raise FileloadError("Compression {} is not supported.".format(codec))
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        data = self._reader.read(size)
+        self.seconds += time.perf_counter() - start
+        self.bytes_out += len(data)
+        return data
+
+    def readline(self, size=-1):
+        start = time.perf_counter()
+        line = self._reader.readline(size)
+        self.seconds += time.perf_counter() - start
+        self.bytes_out += len(line)
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+    def close(self):
+        # the decompressor is dropped without closing, zstandard would close the wrapped stream first
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return self.fileobj.__exit__(exc_type, exc_val, exc_tb)
+
+
+def open_decompressed(fileobj, file_name):
+    """ wrap a stream with DecompressedStream when the file is compressed
+    :param fileobj: binary file like object, with peek() the magic bytes are checked too
+    :param file_name: file name or path, to check the extension
+    :return: fileobj itself for a plain file
+    """
+    head = fileobj.peek(4)[:4] if hasattr(fileobj, 'peek') else b""
+    codec = detect_compression(file_name, head)
+    if codec is None:
+        return fileobj
+    print("Decompress {} as {} while streaming".format(file_name, codec))
+    return DecompressedStream(fileobj, codec)
+
+
+class RecordStreamReader(LineStreamReader):
+    """ like LineStreamReader but transforms whole csv records,
+    a quoted field containing line endings keeps its lines in one record
+    """
+
+    def _read_unit(self):
+        record = self.fileobj.readline()
+        # an odd number of quotes means a quoted field continues on the next line
+        while record and record.count(b'"') % 2 == 1:
+            next_line = self.fileobj.readline()
+            if not next_line:
+                break
+            record = record + next_line
+        return record
+
+
+def parse_record(record):
+    """ split one csv record to a list of str fields """
+    return next(csv.reader(io.StringIO(record.decode('UTF-8'), newline='')))
+
+
+def parse_record_nulls(record):
+    """ split one csv record like COPY ... WITH NULL AS '' CSV reads it,
+    an unquoted empty field is None (null), a quoted empty field is an empty str
+    """
+    text = record.decode('UTF-8').rstrip('\r\n')
+    field_list = list()
+    i = 0
+    while True:
+        if text.startswith('"', i):
+            # a quoted field, "" inside is a quote, the text after the closing quote is kept as csv does
+            char_list = list()
+            j = i + 1
+            while j < len(text):
+                if text[j] == '"':
+                    if text.startswith('"', j + 1):
+                        char_list.append('"')
+                        j += 2
+                        continue
+                    break
+                char_list.append(text[j])
+                j += 1
+            end = text.find(',', j + 1)
+            end = len(text) if end == -1 else end
+            field_list.append("".join(char_list) + text[j + 1:end])
+        else:
+            end = text.find(',', i)
+            end = len(text) if end == -1 else end
+            field_list.append(text[i:end] if end > i else None)
+        if end >= len(text):
+            return field_list
+        i = end + 1
+
+
+class KeyHashSet(object):
+    """ set of 16 bytes key hashes with a memory budget,
+    when the in-memory set exceeds the budget it is spilled to a sqlite file and cleared
+    :param memory_budget: bytes of the in-memory set, about 100 bytes per key
+    """
+
+    BYTES_PER_KEY = 100
+
+    def __init__(self, memory_budget=256 << 20):
+        self.max_keys = max(memory_budget // self.BYTES_PER_KEY, 1)
+        self._keys = set()
+        self._spill_dir = None
+        self._spill_db = None
+        self.spilled = 0
+
+    def _spill(self):
+        if self._spill_db is None:
+            self._spill_dir = tempfile.TemporaryDirectory(prefix="dedup_")
+            self._spill_db = sqlite3.connect(os.path.join(self._spill_dir.name, "keys.db"))
+            self._spill_db.execute("pragma journal_mode = off")
+            self._spill_db.execute("pragma synchronous = off")
+            self._spill_db.execute("create table k (h blob primary key) without rowid")
+        self._spill_db.executemany("insert into k values (?)", ((x,) for x in self._keys))
+        self._spill_db.commit()
+        self.spilled += len(self._keys)
+        self._keys = set()
+
+    def add(self, key_hash):
+        """ add a key hash
+        :return: True when the key is new, False when it was added before
+        """
+        if key_hash in self._keys:
+            return False
+        if self._spill_db is not None and \
+                self._spill_db.execute("select 1 from k where h = ?", (key_hash,)).fetchone() is not None:
+            return False
+        self._keys.add(key_hash)
+        if len(self._keys) >= self.max_keys:
+            self._spill()
+        return True
+
+    def close(self):
+        if self._spill_db is not None:
+            self._spill_db.close()
+            self._spill_dir.cleanup()
+            self._spill_db = None
+        self._keys = set()
+
+
+class DedupRecordReader(RecordStreamReader):
+    """ drop the records whose primary key was seen before, the first occurrence is kept,
+    the header is passed through and used to find the primary key columns.
+    key values are compared as the csv text, like the varchar (or text) staging columns do,
+    an unquoted empty key value is null and differs from a quoted empty one, as COPY reads them.
+    a key column of another staging type compares the cast values, it is deduped by the server
+    :param fileobj: binary file like object of the csv
+    :param pk_list: primary key column names
+    :param memory_budget: bytes of the in-memory key set before spilling to disk
+    """
+
+    def __init__(self, fileobj, pk_list, memory_budget=256 << 20):
+        super().__init__(fileobj)
+        self.pk_list = [x.lower() for x in pk_list]
+        self.key_set = KeyHashSet(memory_budget)
+        self.pk_index_list = None
+        self.duplicates = 0
+
+    def transform(self, record):
+        if self.pk_index_list is None:
+            col_list = [x.lower() for x in record.decode('UTF-8').rstrip('\r\n').split(',')]
+            missing_list = [x for x in self.pk_list if x not in col_list]
+            if missing_list:
+                raise FileloadError("Primary key {} not found in csv header.".format(",".join(missing_list)))
+            self.pk_index_list = [col_list.index(x) for x in self.pk_list]
+            return record
+
+        field_list = parse_record(record)
+        key_list = [field_list[i] if i < len(field_list) else None for i in self.pk_index_list]
+        if "" in key_list:
+            # an empty value is null unless it is quoted, only a record with "" can have a quoted one
+            if b'""' in record:
+                field_list = parse_record_nulls(record)
+                key_list = [field_list[i] if i < len(field_list) else None for i in self.pk_index_list]
+            else:
+                key_list = [None if x == "" else x for x in key_list]
+        key = "\x00".join(["\x01" if x is None else x for x in key_list])
+        if self.key_set.add(hashlib.blake2b(key.encode('UTF-8'), digest_size=16).digest()):
+            return record
+        self.duplicates += 1
+        return None
+
+    def finish(self):
+        print("Client dedup dropped {} duplicated records, {} keys spilled to disk.".format(
+            self.duplicates, self.key_set.spilled))
+        self.key_set.close()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.key_set.close()
+        return super().__exit__(exc_type, exc_val, exc_tb)
+
+
+# ascii only, a unicode digit or space passes \d and \s but fails the input of postgresql
+NUMERIC_PATTERN = re.compile(r"^\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?\s*$|^\s*[+-]?(nan|inf|infinity)\s*$",
+                             re.I | re.ASCII)
+INTEGER_PATTERN = re.compile(r"^\s*[+-]?\d+\s*$", re.ASCII)
+POINT_PATTERN = re.compile(r"^\s*point\s*\(\s*(\S+)\s+(\S+)\s*\)\s*$", re.I | re.ASCII)
+# postgresql takes any unique prefix of the words, on and off need two letters
+BOOL_VALUES = set(["true"[:i] for i in range(1, 5)] + ["false"[:i] for i in range(1, 6)] +
+                  ["yes"[:i] for i in range(1, 4)] + ["no"[:i] for i in range(1, 3)] +
+                  ["on", "of", "off", "1", "0"])
+
+
+def check_value(value, value_type):
+    """ check a csv text value casts to the type like postgresql does, an empty value is null and always valid
+    :param value: str of the field
+    :param value_type: numeric, bool, integer (32 bits) or geo_point (WKT point)
+    :return: True when the value is valid
+    """
+    if value == "":
+        return True
+    if value_type == "numeric":
+        return NUMERIC_PATTERN.match(value) is not None
+    elif value_type == "bool":
+        return value.strip(" \t\n\r\f\v").lower() in BOOL_VALUES
+    elif value_type == "integer":
+        return INTEGER_PATTERN.match(value) is not None and -2 ** 31 <= int(value) < 2 ** 31
+    elif value_type == "geo_point":
+        point = POINT_PATTERN.match(value)
+        return point is not None and all([NUMERIC_PATTERN.match(x) for x in point.groups()])
+    return True
+
+
+class ValidatingRecordReader(RecordStreamReader):
+    """ check every record while it streams, the field count against the header and the values of the
+    typed columns, see check_value. without a reject file the first bad record fails the load,
+    with it the bad records are written there with their reason and dropped, until there are more than max_rejects
+    :param fileobj: binary file like object of the csv
+    :param type_dict: lower case column name -> value type of check_value
+    :param reject_path: csv file of the rejected records, None means fail at the first bad record
+    :param max_rejects: rejected records allowed before the load fails
+    """
+
+    def __init__(self, fileobj, type_dict, reject_path=None, max_rejects=0):
+        super().__init__(fileobj)
+        self.type_dict = type_dict
+        self.reject_path = reject_path
+        self.max_rejects = max_rejects
+        self.col_count = None
+        self.check_list = None
+        self.rejects = 0
+        self._reject_file = None
+        self._reject_writer = None
+
+    def check(self, record):
+        """ :return: the reason to reject the record, None when it is valid """
+        try:
+            field_list = parse_record(record)
+        except (UnicodeDecodeError, csv.Error) as e:
+            return "cannot parse the record, {}".format(str(e))
+        if len(field_list) != self.col_count:
+            return "{} fields, the header has {}".format(len(field_list), self.col_count)
+        for i, col, value_type in self.check_list:
+            if not check_value(field_list[i], value_type):
+                return "{} is not a valid {}: {}".format(col, value_type, field_list[i][:100])
+        return None
+
+    def reject(self, record, reason):
+        self.rejects += 1
+        if self.reject_path is None:
+            raise FileloadError("Record {} is rejected, {}.".format(self.line_no, reason))
+        if self.rejects > self.max_rejects:
+            raise FileloadError("More than {} records are rejected, see {}, the last one: record {}, {}.".format(
+                self.max_rejects, self.reject_path, self.line_no, reason))
+        if self._reject_file is None:
+            self._reject_file = open(self.reject_path, 'w', newline='', encoding='UTF-8')
+            self._reject_writer = csv.writer(self._reject_file)
+            self._reject_writer.writerow(["record_no", "reject_reason", "record"])
+        self._reject_writer.writerow([self.line_no, reason, record.decode('UTF-8', 'replace').rstrip('\r\n')])
+
+    def transform(self, record):
+        if self.check_list is None:
+            col_list = [x.lower() for x in record.decode('UTF-8').rstrip('\r\n').split(',')]
+            self.col_count = len(col_list)
+            self.check_list = [(i, x, self.type_dict[x]) for i, x in enumerate(col_list) if x in self.type_dict]
+            return record
+
+        reason = self.check(record)
+        if reason is None:
+            return record
+        self.reject(record, reason)
+        return None
+
+    def _close_reject_file(self):
+        if self._reject_file is not None:
+            self._reject_file.close()
+            self._reject_file = None
+
+    def finish(self):
+        if self.rejects:
+            print("Validation rejected {} records to {}.".format(self.rejects, self.reject_path))
+        self._close_reject_file()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._close_reject_file()
+        return super().__exit__(exc_type, exc_val, exc_tb)
+
+
+def line_hash(line, line_no):
+    """ hash one line exactly like md5_csv_line.sh does:
+    `read -r` strips the line ending and surrounding blanks, then md5sum of "<line>,<line_no>"
+    :param line: bytes of one line
+    :param line_no: line number start from 0, the header is line 0
+    :return: hex digest as bytes
+    """
+    content = line.rstrip(b"\n").strip(b" \t")
+    return hashlib.md5(content + b"," + str(line_no).encode()).hexdigest().encode()
+
+
+def append_hash(line, line_no, hash_value):
+    """ append the hash column to a line like `paste -d","` does
+    the header gets line_hash, a last line without line ending gets an empty hash because `read` skips it
+    """
+    if line_no == 0:
+        hash_value = b"line_hash"
+    elif not line.endswith(b"\n"):
+        hash_value = b""
+    return line.rstrip(b"\n") + b"," + hash_value + b"\n"
+
+
+class HashedLineReader(LineStreamReader):
+    """ append line_hash column to every line of a csv stream,
+    the output is byte identical with the .detail file generated by md5_csv_line.sh
+    :param fileobj: binary file like object of the csv
+    :param hash_iter: optional iterator of precomputed hashes, one per line, see parallel_line_hashes
+    """
+
+    def __init__(self, fileobj, hash_iter=None):
+        super().__init__(fileobj)
+        self.hash_iter = hash_iter
+
+    def transform(self, line):
+        if self.hash_iter is not None:
+            hash_value = next(self.hash_iter)
+        else:
+            hash_value = line_hash(line, self.line_no)
+        return append_hash(line, self.line_no, hash_value)
+
+
+def _segment_bounds(file_path, segment_size):
+    """ split a file into segments at line boundaries
+    :return: list of (start_offset, end_offset)
+    """
+    file_size = os.path.getsize(file_path)
+    bounds = list()
+    with open(file_path, 'rb') as f:
+        start = 0
+        while start < file_size:
+            end = start + segment_size
+            if end >= file_size:
+                end = file_size
+            else:
+                f.seek(end)
+                f.readline()
+                end = f.tell()
+            bounds.append((start, end))
+            start = end
+    return bounds
+
+
+def _count_lines(args):
+    file_path, start, end = args
+    count = 0
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(remaining, 1 << 20))
+            if not chunk:
+                break
+            count += chunk.count(b"\n")
+            remaining -= len(chunk)
+    return count
+
+
+def _hash_segment(args):
+    file_path, start, end, first_line_no = args
+    hash_list = list()
+    line_no = first_line_no
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            hash_list.append(line_hash(line, line_no))
+            line_no += 1
+    return hash_list
+
+
+def parallel_line_hashes(file_path, workers, segment_size=64 << 20):
+    """ compute the line hashes of a local file with a process pool, in file order
+    the line number of each segment start is found by counting line endings first,
+    at most 2 * workers segments are hashed ahead of the consumer to bound memory
+    :param file_path: local csv file
+    :param workers: number of processes
+    :param segment_size: bytes of each segment
+    :return: iterator of hex digest bytes, one per line
+    """
+    bounds = _segment_bounds(file_path, segment_size)
+    # the loader runs in threads of the worker and the pipeline, a forked child could inherit a held lock,
+    # the processes are started from a clean interpreter instead
+    start_methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("forkserver" if "forkserver" in start_methods else "spawn")
+    with context.Pool(workers) as pool:
+        counts = pool.map(_count_lines, [(file_path, start, end) for start, end in bounds])
+        first_line_list = list()
+        line_no = 0
+        for count in counts:
+            first_line_list.append(line_no)
+            line_no += count
+
+        tasks = [(file_path, start, end, first_line_list[i]) for i, (start, end) in enumerate(bounds)]
+        pending = list()
+        next_task = 0
+        while next_task < len(tasks) or pending:
+            while next_task < len(tasks) and len(pending) < 2 * workers:
+                pending.append(pool.apply_async(_hash_segment, (tasks[next_task],)))
+                next_task += 1
+            for hash_value in pending.pop(0).get():
+                yield hash_value
+
+
+def open_detail_stream(local_file_path, workers=1):
+    """ open a local csv as a stream with the line_hash column appended
+    :param local_file_path: local csv file, may be gzip or zstd compressed
+    :param workers: hash with a process pool when larger than 1
+    :return: HashedLineReader
+    """
+    f = open_decompressed(open(local_file_path, 'rb'), local_file_path)
+    hash_iter = None
+    if workers > 1:
+        if isinstance(f, DecompressedStream):
+            # the segments are found by seeking in the file, a compressed file is hashed while streaming
+            print("{} is compressed, hash it in the loading process.".format(local_file_path))
+        else:
+            hash_iter = parallel_line_hashes(local_file_path, workers)
+    return HashedLineReader(f, hash_iter)
+
+
+class FileRangeReader(object):
+    """ binary file like object of a byte range of a local file
+    :param file_path: local file
+    :param start: first byte offset
+    :param end: offset after the last byte
+    """
+
+    def __init__(self, file_path, start, end):
+        self.f = open(file_path, 'rb')
+        self.f.seek(start)
+        self.remaining = end - start
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        limit = self.remaining if size is None or size < 0 else min(size, self.remaining)
+        line = self.f.readline(limit)
+        self.remaining -= len(line)
+        return line
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _count_quotes(mm, start, end, step=16 << 20):
+    count = 0
+    for offset in range(start, end, step):
+        count += mm[offset:min(offset + step, end)].count(b'"')
+    return count
+
+
+def record_chunk_bounds(file_path, chunk_count, start=0):
+    """ split a csv file into about chunk_count byte ranges of the same size at record boundaries,
+    the file is scanned with mmap and a line ending inside a quoted field is never taken as a boundary
+    :param file_path: local csv file
+    :param chunk_count: number of chunks wanted, fewer are returned for a small file or very long records
+    :param start: offset of the first record, e.g. after the header
+    :return: list of (start_offset, end_offset)
+    """
+    file_size = os.path.getsize(file_path)
+    if file_size <= start:
+        return list()
+
+    bounds = list()
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        chunk_start = start
+        # scanned is the offset the quote parity is known for, the quotes of [start, scanned) are counted
+        scanned = start
+        quote_odd = False
+        for i in range(1, chunk_count):
+            target = start + (file_size - start) * i // chunk_count
+            if target <= scanned:
+                continue
+            quote_odd ^= _count_quotes(mm, scanned, target) % 2 == 1
+            scanned = target
+            # move to the end of the record, an odd number of quotes means a quoted field continues
+            while True:
+                line_end = mm.find(b"\n", scanned)
+                if line_end < 0:
+                    scanned = file_size
+                    break
+                quote_odd ^= _count_quotes(mm, scanned, line_end + 1) % 2 == 1
+                scanned = line_end + 1
+                if not quote_odd:
+                    break
+            if scanned >= file_size:
+                break
+            bounds.append((chunk_start, scanned))
+            chunk_start = scanned
+        bounds.append((chunk_start, file_size))
+    return bounds
+
+
+def open_chunk_stream(file_path, start, end, first_line_no, detail=False):
+    """ open a chunk of a local csv, without header
+    :param first_line_no: line number of the first line of the chunk, the header is line 0
+    :param detail: append the line_hash column
+    :return: FileRangeReader or HashedLineReader
+    """
+    f = FileRangeReader(file_path, start, end)
+    if detail:
+        f = HashedLineReader(f)
+        f.line_no = first_line_no
+    return f
+
+
+def plan_chunks(file_path, chunk_count, detail=False):
+    """ split a local csv after its header for a parallel COPY
+    :param file_path: local csv file, not compressed
+    :param chunk_count: number of chunks wanted
+    :param detail: the chunks append the line_hash column, the line numbers of the chunks are counted first
+    :return: list of functions without argument, each opens the stream of one chunk
+    """
+    with open(file_path, 'rb') as f:
+        header_end = len(f.readline())
+
+    chunk_list = list()
+    line_no = 1
+    for start, end in record_chunk_bounds(file_path, chunk_count, header_end):
+        chunk_list.append(functools.partial(open_chunk_stream, file_path, start, end, line_no, detail))
+        if detail:
+            line_no += _count_lines((file_path, start, end))
+    return chunk_list
@@ -0,0 +1,332 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+
+import configparser
+import threading
+import time
+from contextlib import contextmanager
+import mysql.connector
+import psycopg2
+
+
+class ConnectionPool(object):
+    """ thread safe pool of reusable database connections
+    :param connect_func: function without argument, return a new connection
+    :param ping_func: function(conn), return True when the connection still works
+    :param reset_func: function(conn), clean the connection before it goes back to the pool
+    :param close_func: function(conn), close the connection, default calls conn.close()
+    :param max_size: max number of connections opened by the pool
+    :param idle_timeout: seconds, idle connections older than this are closed
+    :param check_interval: seconds, idle connections older than this are pinged before reuse
+    :param name: name of the pool, used in messages
+    """
+
+    def __init__(self, connect_func, ping_func, reset_func, close_func=None, max_size=5, idle_timeout=300,
+                 check_interval=30, name="pool"):
+        self._connect = connect_func
+        self._ping = ping_func
+        self._reset = reset_func
+        self._close_func = close_func
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.name = name
+
+        # list of (connection, last_used_timestamp), the last one is the most recently used
+        self._idle = list()
+        self._opened = 0
+        self._cond = threading.Condition()
+        self.stats = {"hit": 0, "miss": 0, "wait": 0, "evicted": 0, "broken": 0}
+
+    def _evict_idle(self):
+        """ close the idle connections which exceed idle_timeout, must hold the lock """
+        now = time.time()
+        keep_list = list()
+        for conn, last_used in self._idle:
+            if now - last_used > self.idle_timeout:
+                self._close(conn)
+                self._opened -= 1
+                self.stats["evicted"] += 1
+            else:
+                keep_list.append((conn, last_used))
+        self._idle = keep_list
+
+    def _close(self, conn):
+        try:
+            if self._close_func is None:
+                conn.close()
+            else:
+                self._close_func(conn)
+        except Exception:
+            pass
+
+    def acquire(self, timeout=None):
+        """ get a connection from the pool, open a new one when the pool is not full
+        :param timeout: seconds to wait for a free connection, None means wait forever
+        :return: connection object
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self._cond:
+                self._evict_idle()
+                while not self._idle and self._opened >= self.max_size:
+                    self.stats["wait"] += 1
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError("{} has no free connection.".format(self.name))
+                    self._cond.wait(remaining)
+                    self._evict_idle()
+
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                else:
+                    conn, last_used = None, None
+                    self._opened += 1
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._opened -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self.stats["miss"] += 1
+                return conn
+
+            # health check only the connections idle for a while, avoid a round trip on every checkout
+            if time.time() - last_used < self.check_interval or self._ping(conn):
+                with self._cond:
+                    self.stats["hit"] += 1
+                return conn
+
+            self._close(conn)
+            with self._cond:
+                self._opened -= 1
+                self.stats["broken"] += 1
+
+    def release(self, conn, broken=False):
+        """ give the connection back to the pool
+        :param conn: connection got from acquire
+        :param broken: close the connection instead of reusing it
+        """
+        if not broken:
+            try:
+                self._reset(conn)
+            except Exception:
+                broken = True
+
+        with self._cond:
+            if broken:
+                self._close(conn)
+                self._opened -= 1
+                self.stats["broken"] += 1
+            else:
+                self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    def close_all(self):
+        """ close all idle connections """
+        with self._cond:
+            for conn, last_used in self._idle:
+                self._close(conn)
+                self._opened -= 1
+            self._idle = list()
+            self._cond.notify_all()
+
+    def get_stats(self):
+        """ get the pool usage statistics
+        :return: dict of counters
+        """
+        with self._cond:
+            stats = dict(self.stats)
+            stats["opened"] = self._opened
+            stats["idle"] = len(self._idle)
+            stats["max_size"] = self.max_size
+        return stats
+
+
+_pool_lock = threading.Lock()
+_mysql_pool = None
+_pg_pool = None
+# the search_path currently set on each postgresql connection, key is id(conn)
+_pg_schema = dict()
+
+
+def _read_pool_config(config, prefix):
+    """ read pool settings from the [pool] section of connection.cfg, fall back to defaults
+    keys are <prefix>_max_size, <prefix>_idle_timeout and <prefix>_check_interval, prefix is mysql or pg
+    """
+    pool_cfg = config['pool'] if config.has_section('pool') else dict()
+    return {"max_size": int(pool_cfg.get(prefix + '_max_size', 5)),
+            "idle_timeout": int(pool_cfg.get(prefix + '_idle_timeout', 300)),
+            "check_interval": int(pool_cfg.get(prefix + '_check_interval', 30))}
+
+
+def _mysql_ping(conn):
+    try:
+        conn.ping(reconnect=False)
+    except Exception:
+        return False
+    else:
+        return True
+
+
+def _pg_ping(conn):
+    if conn.closed:
+        return False
+    try:
+        cur = conn.cursor()
+        cur.execute("select 1")
+        cur.fetchall()
+        cur.close()
+        conn.rollback()
+    except Exception:
+        return False
+    else:
+        return True
+
+
+def _rollback(conn):
+    conn.rollback()
+
+
+def _pg_close(conn):
+    _pg_schema.pop(id(conn), None)
+    conn.close()
+
+
+def _pg_reset(conn):
+    if conn.closed:
+        raise psycopg2.InterfaceError("connection already closed")
+    conn.rollback()
+
+
+def get_mysql_pool():
+    """ get the process wide mysql connection pool, create it at first call
+    :return: ConnectionPool
+    """
+    global _mysql_pool
+    with _pool_lock:
+        if _mysql_pool is None:
+            config = configparser.ConfigParser()
+            config.read('connection.cfg')
+
+            mysqlConn = config['mysql']
+            dbhost = mysqlConn['db_host']
+            dbuser = mysqlConn['db_user']
+            dbpass = mysqlConn['db_pass']
+            dbname = mysqlConn['db_name']
+
+            def connect():
+                return mysql.connector.connect(host=dbhost,
+                                               user=dbuser,
+                                               passwd=dbpass,
+                                               database=dbname
+                                               )
+
+            _mysql_pool = ConnectionPool(connect, _mysql_ping, _rollback, name="mysql pool",
+                                         **_read_pool_config(config, 'mysql'))
+    return _mysql_pool
+
+
+def get_pg_pool():
+    """ get the process wide postgresql connection pool, create it at first call
+    :return: ConnectionPool
+    """
+    global _pg_pool
+    with _pool_lock:
+        if _pg_pool is None:
+            config = configparser.ConfigParser()
+            config.read('connection.cfg')
+
+            pg_cfg = config['postgre']
+            pg_host = pg_cfg['pg_host']
+            pg_user = pg_cfg['pg_user']
+            pg_pass = pg_cfg['pg_pass']
+            pg_db = pg_cfg['pg_db']
+
+            def connect():
+                return psycopg2.connect(dbname=pg_db,
+                                        user=pg_user,
+                                        host=pg_host,
+                                        password=pg_pass,
+                                        )
+
+            _pg_pool = ConnectionPool(connect, _pg_ping, _pg_reset, _pg_close, name="postgre pool",
+                                      **_read_pool_config(config, 'pg'))
+    return _pg_pool
+
+
+@contextmanager
+def mysql_connection():
+    """ borrow a mysql connection from the pool, it will be rolled back and returned after use """
+    pool = get_mysql_pool()
+    conn = pool.acquire()
+    try:
+        yield conn
+    except Exception:
+        pool.release(conn, broken=not _mysql_ping(conn))
+        raise
+    else:
+        pool.release(conn)
+
+
+@contextmanager
+def mysql_dedicated_connection():
+    """ open a mysql connection outside the pool and close it after use, for a session held for long,
+    e.g. a named lock, which must not take a pooled connection from the executors it waits for
+    """
+    conn = get_mysql_pool()._connect()
+    try:
+        yield conn
+    finally:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+@contextmanager
+def pg_connection(schema_name, timeout=None):
+    """ borrow a postgresql connection from the pool with search_path set to schema_name
+    :param schema_name: the schema used as search_path during the checkout
+    :param timeout: seconds to wait for a free connection, None means wait forever, TimeoutError after it
+    """
+    pool = get_pg_pool()
+    conn = pool.acquire(timeout)
+    try:
+        # search_path is committed so a rollback inside the checkout keeps it, only set it when changed
+        if _pg_schema.get(id(conn)) != schema_name:
+            cur = conn.cursor()
+            cur.execute("set search_path to " + schema_name)
+            conn.commit()
+            cur.close()
+            _pg_schema[id(conn)] = schema_name
+        yield conn
+    except Exception:
+        pool.release(conn, broken=bool(conn.closed))
+        raise
+    else:
+        pool.release(conn)
+
+
+def pool_stats():
+    """ get statistics of the created pools
+    :return: dict, pool name -> counters
+    """
+    stats = dict()
+    if _mysql_pool is not None:
+        stats["mysql"] = _mysql_pool.get_stats()
+    if _pg_pool is not None:
+        stats["postgre"] = _pg_pool.get_stats()
+    return stats
+
+
+def close_all():
+    """ close every idle connection of the created pools """
+    if _mysql_pool is not None:
+        _mysql_pool.close_all()
+    if _pg_pool is not None:
+        _pg_pool.close_all()
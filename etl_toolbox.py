@@ -2,12 +2,23 @@
 # -*- coding: UTF-8 -*-
 
 import configparser
-import subprocess
+import functools
+import hashlib
+import json
+import os
+import queue
+import re
+import threading
 import time
+import uuid
+from contextlib import contextmanager
 from datetime import datetime
 from custom_exception import *
-import mysql.connector
-import psycopg2
+import csv_stream
+import db_pool
+import file_source
+import metadata_cache
+import stage_metrics
 
 
 def mysql_executor(sqlstring, values):
@@ -17,42 +28,23 @@ def mysql_executor(sqlstring, values):
     :return: if select return query result
     """
 
-    # Access connection file
-    config = configparser.ConfigParser()
-    config.read('connection.cfg')
+    # borrow a connection from the pool, it is returned when the block exits
+    with db_pool.mysql_connection() as mydb:
+        mycursor = mydb.cursor()
 
-    ## Read mysql connection
-    mysqlConn = config['mysql']
-
-    dbhost = mysqlConn['db_host']
-    dbuser = mysqlConn['db_user']
-    dbpass = mysqlConn['db_pass']
-    dbname = mysqlConn['db_name']
-
-    mydb = mysql.connector.connect(
-        host=dbhost,
-        user=dbuser,
-        passwd=dbpass,
-        database=dbname
-    )
-
-    mycursor = mydb.cursor()
-
-    if "select" in sqlstring:
-        mycursor.execute(sqlstring, values)
-        myresult = mycursor.fetchall()
-        mycursor.close
-        mydb.close
-        return myresult
-    else:
-        print("MySQL insert here.")
-        print("sqlstring:", sqlstring)
-        print("values:", values)
-        mycursor.execute(sqlstring, values)
-        mydb.commit()
-        mycursor.close
-        mydb.close
-        print(mycursor.rowcount, "record inserted.")
+        if "select" in sqlstring:
+            mycursor.execute(sqlstring, values)
+            myresult = mycursor.fetchall()
+            mycursor.close()
+            return myresult
+        else:
+            print("MySQL insert here.")
+            print("sqlstring:", sqlstring)
+            print("values:", values)
+            mycursor.execute(sqlstring, values)
+            mydb.commit()
+            print(mycursor.rowcount, "record inserted.")
+            mycursor.close()
 
 
 def postgre_desc_table(schema_name, table_name):
@@ -62,39 +54,21 @@ def postgre_desc_table(schema_name, table_name):
     :param table_name: the name of table
     :return: list of field names
     """
-    # read postgres connection info
-    config = configparser.ConfigParser()
-    config.read('connection.cfg')
-
-    pg_cfg = config['postgre']
-    pg_host = pg_cfg['pg_host']
-    pg_user = pg_cfg['pg_user']
-    pg_pass = pg_cfg['pg_pass']
-    pg_db = pg_cfg['pg_db']
-    # pg_port = pg_cfg['pg_port']
-    # tmp_schema = pg_cfg['tmp_schema']
-
-    # create a connection
+    # borrow a connection from the pool
     try:
-        conn = psycopg2.connect(dbname=pg_db,
-                                user=pg_user,
-                                host=pg_host,
-                                password=pg_pass,
-                                options=f'-c search_path={schema_name}',
-                                )
-        cur = conn.cursor()
-        sql_string = "Select * FROM {} LIMIT 0".format(table_name)
-        cur.execute(sql_string)
-        col_names = [desc[0] for desc in cur.description]
-        print(col_names)
+        with db_pool.pg_connection(schema_name) as conn:
+            cur = conn.cursor()
+            sql_string = "Select * FROM {} LIMIT 0".format(table_name)
+            cur.execute(sql_string)
+            col_names = [desc[0] for desc in cur.description]
+            cur.close()
+            print(col_names)
     except Exception as e:
         error_msg = "PSQL desc table error, {}".format(str(e))
         print(error_msg)
         raise Exception(error_msg)
     else:
         return col_names
-    finally:
-        conn.close()
 
 
 def postgre_executor(schema_name, sql_string, sql_val):
@@ -103,40 +77,23 @@ def postgre_executor(schema_name, sql_string, sql_val):
     :param schema_name: the schema of table located
     :param sql_string: the sql to be executed
     :param sql_val: the val substuted in the
-    :return: if select return query result
+    :return: row count of the last statement
     """
-    # read postgres connection info
-    config = configparser.ConfigParser()
-    config.read('connection.cfg')
-
-    pg_cfg = config['postgre']
-    pg_host = pg_cfg['pg_host']
-    pg_user = pg_cfg['pg_user']
-    pg_pass = pg_cfg['pg_pass']
-    pg_db = pg_cfg['pg_db']
-    # pg_port = pg_cfg['pg_port']
-    # tmp_schema = pg_cfg['tmp_schema']
-
-    # create a connection
+    # borrow a connection from the pool
     try:
-        conn = psycopg2.connect(dbname=pg_db,
-                                user=pg_user,
-                                host=pg_host,
-                                password=pg_pass,
-                                options=f'-c search_path={schema_name}',
-                                )
-        cur = conn.cursor()
-        result = cur.execute(sql_string, sql_val)
-        print(result)
-        conn.commit()
+        with db_pool.pg_connection(schema_name) as conn:
+            cur = conn.cursor()
+            cur.execute(sql_string, sql_val)
+            result = cur.rowcount
+            print(result)
+            conn.commit()
+            cur.close()
     except Exception as e:
         error_msg = "PSQL execute error, {}".format(str(e))
         print(error_msg)
         raise Exception(error_msg)
     else:
         return result
-    finally:
-        conn.close()
 
 
 def cast_field_type(tag_name, tag_data_type):
@@ -158,15 +115,18 @@ def cast_field_type(tag_name, tag_data_type):
         raise Exception(error_msg)
 
 
-def reformat_pk_str(column_str):
+def reformat_pk_str(column_str, typed=False):
     """ when confront geo_point string, constructs PostGIS ST_Geometry point object
     when confront level field, cast to integer
     :param column_str: the string of columns delimited by comma
+    :param typed: the source is a typed staging table, the columns already have the target types
     :return: reformatted column string
     """
     column_list = list()
     for col in column_str.split(','):
-        if "geo_point" == col.lower():
+        if typed:
+            column_list.append(col)
+        elif "geo_point" == col.lower():
             column_list.append('cast(public.st_pointfromtext({}) as "public"."geometry")'.format(col))
         elif "level" == col.lower():
             column_list.append('cast("{}" as integer)'.format(col))
@@ -191,136 +151,1368 @@ def merge_tag(source_schema, source_table, target_schema, target_table, pk_strin
     :param tag_data_type:
     :return:
     """
-    merge_fields = "({}, {})".format(pk_string, tag_name)
-    cast_field = cast_field_type(tag_name, tag_data_type)
-    source_pk_string = reformat_pk_str(pk_string)
+    merge_tags(source_schema, source_table, target_schema, target_table, pk_string, [(tag_name, tag_data_type)])
+
+
+def build_merge_sql(source_schema, source_table, target_table, pk_string, tag_list, where_str=None,
+                    skip_unchanged=False):
+    """ build the upsert sql of several tags
+    :param source_schema: the schema of source_table
+    :param source_table: the source table of csv data
+    :param target_table: target tag table
+    :param pk_string: primary key string
+    :param tag_list: list of (tag_name, tag_data_type), tag name equals target field name
+    :param where_str: optional filter on the source table
+    :param skip_unchanged: do not update the rows whose tag values are unchanged
+    :return: merge sql string
+    """
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    staging_typed = config['postgre'].get('staging_typed', 'false') == 'true'
+
+    tag_name_list = [tag_name for tag_name, tag_data_type in tag_list]
+    tag_names = ", ".join(tag_name_list)
+    merge_fields = "({}, {})".format(pk_string, tag_names)
+    cast_field = ", ".join([cast_field_type(tag_name, tag_data_type) for tag_name, tag_data_type in tag_list])
+    source_pk_string = reformat_pk_str(pk_string, staging_typed)
     source_fields = "{}, {}".format(source_pk_string, cast_field)
+    update_fields = ", ".join(["{} = excluded.{}".format(tag_name, tag_name) for tag_name in tag_name_list])
+    where_sql = "" if where_str is None else " where " + where_str
     merge_sql = "insert into " + target_table + merge_fields + \
-                "   (select " + source_fields + " from " + source_schema + "." + source_table + ")" + \
+                "   (select " + source_fields + " from " + source_schema + "." + source_table + where_sql + ")" + \
                 " on conflict (" + pk_string + ") do update " + \
-                " set " + tag_name + " = excluded." + tag_name
+                " set " + update_fields
+    if skip_unchanged:
+        merge_sql = merge_sql + " where (" + ", ".join([target_table + "." + x for x in tag_name_list]) + ")" + \
+                    " is distinct from (" + ", ".join(["excluded." + x for x in tag_name_list]) + ")"
+    return merge_sql
+
 
-    print("The merge sql is:")
-    print(merge_sql)
+def merge_source_sql(source_schema, source_table, pk_string, tag_list):
+    """ the source table as subquery s with the target types and names, and _in_source true on every row
+    :param source_schema: the schema of source_table
+    :param source_table: the source table of csv data
+    :param pk_string: primary key string
+    :param tag_list: list of (tag_name, tag_data_type), tag name equals target field name
+    :return: sql string
+    """
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    staging_typed = config['postgre'].get('staging_typed', 'false') == 'true'
 
+    pk_list = pk_string.split(',')
+    select_list = ["{} as {}".format(x, y) for x, y in zip(reformat_pk_str(pk_string, staging_typed).split(','),
+                                                          pk_list)]
+    select_list = select_list + ["{} as {}".format(cast_field_type(tag_name, tag_data_type), tag_name)
+                                 for tag_name, tag_data_type in tag_list]
+    return "(select " + ", ".join(select_list) + ", true as _in_source from " + \
+           source_schema + "." + source_table + ") s"
+
+
+def build_update_join_sql(source_schema, source_table, target_table, pk_string, tag_list, skip_unchanged=False):
+    """ build the merge of several tags as an update joined with the source table and an insert of the new keys,
+    both statements read the source in one pass which allows a hash join instead of a probe per row
+    :param source_schema: the schema of source_table
+    :param source_table: the source table of csv data
+    :param target_table: target tag table
+    :param pk_string: primary key string
+    :param tag_list: list of (tag_name, tag_data_type), tag name equals target field name
+    :param skip_unchanged: do not update the rows whose tag values are unchanged
+    :return: list of the update sql and the insert sql
+    """
+    pk_list = pk_string.split(',')
+    tag_name_list = [tag_name for tag_name, tag_data_type in tag_list]
+    source_sql = merge_source_sql(source_schema, source_table, pk_string, tag_list)
+    join_str = " and ".join(["t.{} = s.{}".format(x, x) for x in pk_list])
+
+    update_sql = "update " + target_table + " t set " + \
+                 ", ".join(["{} = s.{}".format(x, x) for x in tag_name_list]) + \
+                 " from " + source_sql + " where " + join_str
+    if skip_unchanged:
+        update_sql = update_sql + " and (" + ", ".join(["t." + x for x in tag_name_list]) + ")" + \
+                     " is distinct from (" + ", ".join(["s." + x for x in tag_name_list]) + ")"
+
+    # a key inserted by a concurrent merge after the update is still updated
+    insert_sql = "insert into " + target_table + "(" + pk_string + ", " + ", ".join(tag_name_list) + ")" + \
+                 " select " + ", ".join(["s." + x for x in pk_list + tag_name_list]) + " from " + source_sql + \
+                 " where not exists (select 1 from " + target_table + " t where " + join_str + ")" + \
+                 " on conflict (" + pk_string + ") do update set " + \
+                 ", ".join(["{} = excluded.{}".format(x, x) for x in tag_name_list])
+    return [update_sql, insert_sql]
+
+
+def plan_merge(cur, source_schema, source_table, target_table, full=False):
+    """ choose the merge strategy by the size of the source table against the target table
+    upsert: insert ... on conflict, probes the target index per source row, best for a small source
+    update_join: update joined with the source then insert the new keys, best when the source touches a large
+     share of the target
+    distinct: update_join which skips the rows whose values are unchanged, for full uploads which mostly repeat
+     the current values
+    rebuild: a new copy of the target table swapped in, see rebuild_target, when the source covers most of the target
+    [postgre] merge_strategy forces one of them, auto (default) takes update_join or distinct when the source rows
+    reach merge_join_ratio (default 0.2) of the target rows, and rebuild when they reach merge_rebuild_ratio
+    (default none, rebuild is not chosen). the strategies except upsert set work_mem and maintenance_work_mem
+    to merge_work_mem (default 256MB) for the hash join and the index builds
+    :param cur: cursor of the merge connection, the target table is found by its search path
+    :param full: the merge is of a full upload
+    :return: dict of strategy, source_rows, target_rows and work_mem
+    """
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    pg_cfg = config['postgre']
+    strategy = pg_cfg.get('merge_strategy', 'auto')
+    join_ratio = float(pg_cfg.get('merge_join_ratio', 0.2))
+    rebuild_ratio = pg_cfg.get('merge_rebuild_ratio')
+
+    cur.execute("select count(*) from " + source_schema + "." + source_table)
+    source_rows = cur.fetchall()[0][0]
+    # the estimate of the last analyze is enough to compare the sizes, -1 means never analyzed
+    cur.execute("select greatest(reltuples, 0)::bigint from pg_class where oid = to_regclass(%s)", (target_table,))
+    result = cur.fetchall()
+    target_rows = result[0][0] if result else 0
+
+    if strategy == "auto":
+        if rebuild_ratio and target_rows > 0 and source_rows >= target_rows * float(rebuild_ratio):
+            strategy = "rebuild"
+        elif target_rows > 0 and source_rows >= target_rows * join_ratio:
+            strategy = "distinct" if full else "update_join"
+        else:
+            strategy = "upsert"
+    elif strategy not in ("upsert", "update_join", "distinct", "rebuild"):
+        raise Exception("[postgre] merge_strategy {} is not supported.".format(strategy))
+
+    # a table the rebuild cannot copy faithfully is merged in place
+    rebuild_blocker = rebuild_unsupported(cur, target_table) if strategy == "rebuild" else None
+    if rebuild_blocker:
+        print("{} is not rebuilt, {}, upsert instead".format(target_table, rebuild_blocker))
+        strategy = "upsert"
+
+    work_mem = None if strategy == "upsert" else pg_cfg.get('merge_work_mem', '256MB')
+    plan = {"strategy": strategy, "source_rows": source_rows, "target_rows": target_rows, "work_mem": work_mem}
+    if rebuild_blocker:
+        plan["rebuild_blocker"] = rebuild_blocker
+    return plan
+
+
+def rebuild_unsupported(cur, target_table):
+    """ :return: why rebuild_target cannot copy the target table, None when it can """
+    cur.execute("select string_agg(attname, ', ') from pg_attribute where attrelid = to_regclass(%s)"
+                " and attnum > 0 and not attisdropped and attidentity <> ''", (target_table,))
+    identity_columns = cur.fetchall()[0][0]
+    if identity_columns:
+        # the copied identity would restart, the values of the new keys cannot be carried over
+        return "identity column " + identity_columns
+    return None
+
+
+def _rebuild_name(name):
+    """ the name of an object of the rebuilt table before the swap, within the 63 bytes of an identifier """
+    return name[:55] + "_rebuild"
+
+
+def rebuild_target(cur, source_schema, source_table, target_table, pk_string, tag_list, full_tag_list=None):
+    """ write a new copy of the target table from the current table full joined with the source table,
+    rebuild its constraints, indexes and grants and swap it in by rename, the old table is dropped.
+    the rows are written once sequentially and the new table has no dead tuple.
+    runs in the transaction of cur, the target is locked against writes until commit, readers see the old table.
+    the new keys get the column defaults, generated columns are computed again and the sequences owned by
+    the target move to the new table. identity columns are not supported, see rebuild_unsupported.
+    triggers and ownership are not carried over, a view or foreign key depending on the table fails the swap
+    :param cur: cursor of the merge connection, the target table is found by its search path
+    :param source_schema: the schema of source_table
+    :param source_table: the source table of csv data
+    :param target_table: target tag table
+    :param pk_string: primary key string
+    :param tag_list: list of (tag_name, tag_data_type), tag name equals target field name
+    :param full_tag_list: tags uploaded by full method, null for the keys absent from the source
+    :return: rows of the new table
+    """
+    new_table = _rebuild_name(target_table)
+    cur.execute("lock table " + target_table + " in exclusive mode")
+    cur.execute("select relnamespace::regnamespace::text from pg_class where oid = to_regclass(%s)", (target_table,))
+    target_schema = cur.fetchall()[0][0]
+
+    # the generated columns are left out, the new table computes them
+    cur.execute("select a.attname, pg_get_expr(d.adbin, d.adrelid) from pg_attribute a"
+                " left join pg_attrdef d on d.adrelid = a.attrelid and d.adnum = a.attnum"
+                " where a.attrelid = to_regclass(%s) and a.attnum > 0 and not a.attisdropped"
+                " and a.attgenerated = '' order by a.attnum", (target_table,))
+    default_dict = dict(cur.fetchall())
+    cur.execute("select * from " + target_table + " limit 0")
+    col_list = [desc[0] for desc in cur.description if desc[0] in default_dict]
+    pk_list = [x.lower() for x in pk_string.split(',')]
+    tag_name_list = [tag_name.lower() for tag_name, tag_data_type in tag_list]
+    full_list = [x.lower() for x in full_tag_list] if full_tag_list else list()
+    select_list = list()
+    for col in col_list:
+        if col in pk_list:
+            select_list.append("coalesce(t.{}, s.{})".format(col, col))
+        elif col in full_list:
+            select_list.append("s." + col)
+        elif col in tag_name_list:
+            select_list.append("case when s._in_source then s.{} else t.{} end".format(col, col))
+        elif default_dict[col] is not None:
+            # a new key has no target row, it gets the default as the upsert would give it
+            select_list.append("case when t.{} is null then {} else t.{} end".format(pk_list[0], default_dict[col],
+                                                                                   col))
+        else:
+            select_list.append("t." + col)
+    join_str = " and ".join(["t.{} = s.{}".format(x, x) for x in pk_list])
+
+    cur.execute("drop table if exists " + new_table)
+    cur.execute("create table " + new_table + " (like " + target_table + " including all excluding indexes)")
+    cur.execute("insert into " + new_table + " (" + ", ".join(col_list) + ")" +
+                " select " + ", ".join(select_list) + " from " + target_table + " t full join " +
+                merge_source_sql(source_schema, source_table, pk_string, tag_list) + " on " + join_str)
+    row_count = cur.rowcount
+
+    # constraints with their indexes, then the other indexes, under temporary names
+    cur.execute("select conname, pg_get_constraintdef(oid) from pg_constraint"
+                " where conrelid = to_regclass(%s) and contype in ('p', 'u', 'x', 'f')", (target_table,))
+    constraint_list = cur.fetchall()
+    for con_name, con_def in constraint_list:
+        cur.execute('alter table {} add constraint "{}" {}'.format(new_table, _rebuild_name(con_name), con_def))
+    cur.execute("select indexname, indexdef from pg_indexes i where schemaname = %s and tablename = %s"
+                " and not exists (select 1 from pg_constraint c where c.conindid ="
+                " to_regclass(quote_ident(i.schemaname) || '.' || quote_ident(i.indexname)))",
+                (target_schema, target_table))
+    index_list = cur.fetchall()
+    for index_name, index_def in index_list:
+        cur.execute(re.sub(r"INDEX \S+ ON (ONLY )?\S+ ",
+                           'INDEX "{}" ON {}.{} '.format(_rebuild_name(index_name), target_schema, new_table),
+                           index_def, count=1))
+    cur.execute("select grantee, string_agg(privilege_type, ', ') from information_schema.role_table_grants"
+                " where table_schema = %s and table_name = %s and grantee <> current_user group by grantee",
+                (target_schema, target_table))
+    for grantee, privileges in cur.fetchall():
+        grantee = "public" if grantee == "PUBLIC" else '"{}"'.format(grantee)
+        cur.execute("grant {} on {} to {}".format(privileges, new_table, grantee))
+    cur.execute("analyze " + new_table)
+
+    # a serial default of the new table still uses the sequence of the target, which is dropped with its owner
+    cur.execute("select s.oid::regclass::text, a.attname from pg_depend d"
+                " join pg_class s on s.oid = d.objid and s.relkind = 'S'"
+                " join pg_attribute a on a.attrelid = d.refobjid and a.attnum = d.refobjsubid"
+                " where d.refobjid = to_regclass(%s) and d.classid = 'pg_class'::regclass and d.deptype = 'a'",
+                (target_table,))
+    for sequence_name, col in cur.fetchall():
+        cur.execute("alter sequence {} owned by {}.{}".format(sequence_name, new_table, col))
+
+    # swap, the constraint and index names are free once the old table is dropped
+    cur.execute("drop table " + target_table)
+    cur.execute("alter table " + new_table + " rename to " + target_table)
+    for con_name, con_def in constraint_list:
+        cur.execute('alter table {} rename constraint "{}" to "{}"'.format(target_table, _rebuild_name(con_name),
+                                                                         con_name))
+    for index_name, index_def in index_list:
+        cur.execute('alter index {}."{}" rename to "{}"'.format(target_schema, _rebuild_name(index_name),
+                                                               index_name))
+    print("Rebuilt {} with {} rows, {} constraints and {} indexes".format(target_table, row_count,
+                                                                        len(constraint_list), len(index_list)))
+    return row_count
+
+
+def build_null_absent_sql(source_schema, source_table, target_table, pk_string, column_list):
+    """ build the sql to set columns to null for the target rows whose key is absent from the source table
+    :param source_schema: the schema of source_table
+    :param source_table: the source table of csv data
+    :param target_table: target tag table
+    :param pk_string: primary key string
+    :param column_list: list of columns to be set null
+    :return: update sql string
+    """
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    staging_typed = config['postgre'].get('staging_typed', 'false') == 'true'
+
+    set_str = ", ".join(["{} = NULL".format(column_name) for column_name in column_list])
+    not_null_str = " or ".join(["t.{} is not null".format(column_name) for column_name in column_list])
+    target_pk_string = ",".join(["t." + x for x in pk_string.split(',')])
+    null_sql = "update {} t set {} where ({}) and not exists (select 1 from {}.{} where ({}) = ({}))".format(
+        target_table, set_str, not_null_str, source_schema, source_table,
+        reformat_pk_str(pk_string, staging_typed), target_pk_string)
+    return null_sql
+
+
+def build_null_deleted_sql(source_schema, deleted_table, target_table, pk_string, column_list):
+    """ build the sql to set columns to null for the target rows whose key was deleted from the source file
+    :param source_schema: the schema of deleted_table
+    :param deleted_table: table of the deleted keys, see create_delta_tables
+    :param target_table: target tag table
+    :param pk_string: primary key string
+    :param column_list: list of columns to be set null
+    :return: update sql string
+    """
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    staging_typed = config['postgre'].get('staging_typed', 'false') == 'true'
+
+    set_str = ", ".join(["{} = NULL".format(column_name) for column_name in column_list])
+    null_sql = "update {} set {} where ({}) in (select {} from {}.{})".format(
+        target_table, set_str, pk_string, reformat_pk_str(pk_string, staging_typed), source_schema, deleted_table)
+    return null_sql
+
+
+def build_null_sql(source_schema, source_table, target_table, pk_string, column_list, deleted_table=None):
+    """ the null-out of full tags, for the deleted keys when the source is a delta, see build_null_deleted_sql,
+    otherwise for the keys absent from the source, see build_null_absent_sql
+    """
+    if deleted_table:
+        return build_null_deleted_sql(source_schema, deleted_table, target_table, pk_string, column_list)
+    return build_null_absent_sql(source_schema, source_table, target_table, pk_string, column_list)
+
+
+def merge_tags(source_schema, source_table, target_schema, target_table, pk_string, tag_list, full_tag_list=None,
+               deleted_table=None):
+    """ merge several tags of the same source table at once with the strategy of plan_merge,
+    the source table is scanned once and every target row is written once,
+    with [postgre] merge_batch_size > 0 the merge is done by merge_tags_batched
+    :param source_schema: the schema of source_table
+    :param source_table: the source table of csv data
+    :param target_schema: the schema of target table
+    :param target_table: target tag table
+    :param pk_string: primary key string
+    :param tag_list: list of (tag_name, tag_data_type), tag name equals target field name
+    :param full_tag_list: tags uploaded by full method, their values of keys absent from the source are set to
+     null in the same transaction, and unchanged rows are not rewritten
+    :param deleted_table: with a delta as source_table, the table of the deleted keys, see create_delta_tables,
+     the full tags are set to null for these keys instead of the keys absent from the delta
+    :return: dict of merged and nulled row counts, nulled is None without full_tag_list or with a rebuild
+     of a whole source table, and the plan of plan_merge, None for a batched merge
+    """
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    batch_size = int(config['postgre'].get('merge_batch_size', 0))
+    if batch_size > 0:
+        batch_report_list = merge_tags_batched(source_schema, source_table, target_schema, target_table, pk_string,
+                                               tag_list, batch_size, full_tag_list, deleted_table)
+        return {"merged": sum([x["rows"] for x in batch_report_list]), "nulled": None, "plan": None}
+
+    null_sql = None
+    if full_tag_list:
+        null_sql = build_null_sql(source_schema, source_table, target_table, pk_string, full_tag_list, deleted_table)
+
+    # all statements in one transaction, each row count is kept for the stage metrics
+    merge_report = {"merged": None, "nulled": None, "plan": None}
     try:
         print("Start to merge table {}".format(target_table))
-        result = postgre_executor(target_schema, merge_sql, None)
+        with db_pool.pg_connection(target_schema) as conn:
+            cur = conn.cursor()
+            with stage_metrics.stage("merge_plan", source_table) as metric:
+                merge_plan = plan_merge(cur, source_schema, source_table, target_table, bool(full_tag_list))
+                metric.rows = merge_plan["source_rows"]
+                metric.detail = merge_plan
+            merge_report["plan"] = merge_plan
+            print("Merge plan of {} into {}: {}".format(source_table, target_table, merge_plan))
+
+            # only for this transaction, the pooled connection keeps its defaults
+            if merge_plan["work_mem"]:
+                cur.execute("set local work_mem = %s", (merge_plan["work_mem"],))
+                cur.execute("set local maintenance_work_mem = %s", (merge_plan["work_mem"],))
+
+            if merge_plan["strategy"] == "rebuild":
+                # the absent keys of full tags are null in the new table already, a delta nulls the deleted keys
+                rebuild_target(cur, source_schema, source_table, target_table, pk_string, tag_list,
+                               None if deleted_table else full_tag_list)
+                merge_report["merged"] = merge_plan["source_rows"]
+                if null_sql and deleted_table:
+                    cur.execute(null_sql)
+                    merge_report["nulled"] = cur.rowcount
+            else:
+                if merge_plan["strategy"] == "upsert":
+                    merge_sql_list = [build_merge_sql(source_schema, source_table, target_table, pk_string,
+                                                      tag_list, skip_unchanged=bool(full_tag_list))]
+                else:
+                    merge_sql_list = build_update_join_sql(source_schema, source_table, target_table, pk_string,
+                                                           tag_list, merge_plan["strategy"] == "distinct")
+                print("The merge sql is:")
+                for merge_sql in merge_sql_list + ([null_sql] if null_sql else []):
+                    print(merge_sql)
+
+                merge_report["merged"] = 0
+                for merge_sql in merge_sql_list:
+                    cur.execute(merge_sql)
+                    merge_report["merged"] += cur.rowcount
+                if null_sql:
+                    cur.execute(null_sql)
+                    merge_report["nulled"] = cur.rowcount
+            conn.commit()
+            cur.close()
     except Exception as e:
-        raise Exception(str(e))
+        raise Exception("PSQL execute error, {}".format(str(e)))
     else:
-        print("PSQL execute result: {}".format(result))
+        print("PSQL execute result: {}".format(merge_report))
+        return merge_report
 
 
-def load_csv_to_pg(table_name, local_file_path, pk_string, tag_storage_type, derived_tuple):
+def _checkpoint_table(source_schema):
+    """ create the merge checkpoint table in the staging schema when missing
+    a checkpoint row is written in the same transaction as its batch, so a batch is never applied twice
+    """
+    checkpoint_table = source_schema + ".merge_checkpoint"
+    create_sql = "create table if not exists " + checkpoint_table + \
+                 " (source_oid oid, target_table text, tag_names text, last_key text[], rows_done bigint," + \
+                 " update_time timestamp default now(), primary key (source_oid, target_table, tag_names))"
+    postgre_executor(source_schema, create_sql, None)
+    return checkpoint_table
+
+
+def purge_merge_checkpoints(source_schema):
+    """ delete the checkpoints of batched merges whose staging table is dropped, e.g. a merge failed part-way
+    and its file was loaded again to a new generation, such a merge can never resume
+    :return: number of checkpoints deleted
+    """
+    checkpoint_table = source_schema + ".merge_checkpoint"
+    with db_pool.pg_connection(source_schema) as conn:
+        cur = conn.cursor()
+        cur.execute("select to_regclass(%s) is not null", (checkpoint_table,))
+        if not cur.fetchone()[0]:
+            cur.close()
+            return 0
+        cur.execute("delete from " + checkpoint_table + " m" +
+                    " where not exists (select 1 from pg_class c where c.oid = m.source_oid)")
+        purge_count = cur.rowcount
+        conn.commit()
+        cur.close()
+    if purge_count:
+        print("Deleted {} checkpoints of merges from dropped staging tables".format(purge_count))
+    return purge_count
+
+
+def get_merge_checkpoint(source_schema, source_table, target_table, tag_list):
+    """ get the last completed key of an unfinished batched merge
+    the staging table oid is part of the key, so a reloaded staging table never resumes an old checkpoint
+    :return: list of key values, None when no merge is in progress
+    """
+    checkpoint_table = _checkpoint_table(source_schema)
+    tag_names = ",".join([tag_name for tag_name, tag_data_type in tag_list])
+    with db_pool.pg_connection(source_schema) as conn:
+        cur = conn.cursor()
+        cur.execute("select last_key from " + checkpoint_table +
+                    " where source_oid = to_regclass(%s)::oid and target_table = %s and tag_names = %s",
+                    (source_schema + "." + source_table, target_table, tag_names))
+        result = cur.fetchall()
+        cur.close()
+    return result[0][0] if result else None
+
+
+def unfinished_merge_count(source_schema, target_table, tag_name_list):
+    """ :return: number of batched merges of any of the tags into target_table which stopped part-way,
+     the target holds some of their ranges only. the checkpoints of dropped staging tables are not counted,
+     see purge_merge_checkpoints, and the checkpoint table is not created when missing
+    """
+    checkpoint_table = source_schema + ".merge_checkpoint"
+    with db_pool.pg_connection(source_schema) as conn:
+        cur = conn.cursor()
+        cur.execute("select to_regclass(%s) is not null", (checkpoint_table,))
+        if not cur.fetchone()[0]:
+            cur.close()
+            return 0
+        cur.execute("select count(*) from " + checkpoint_table + " m" +
+                    " where m.target_table = %s and string_to_array(m.tag_names, ',') && %s::text[]" +
+                    " and exists (select 1 from pg_class c where c.oid = m.source_oid)",
+                    (target_table, list(tag_name_list)))
+        result = cur.fetchall()
+        cur.close()
+    return result[0][0]
+
+
+def merge_tags_batched(source_schema, source_table, target_schema, target_table, pk_string, tag_list, batch_size,
+                       full_tag_list=None, deleted_table=None):
+    """ merge in primary key ranges of batch_size source rows, commit each range with its checkpoint,
+    a rerun on the same staging table resumes after the last committed range,
+    the values of full_tag_list for keys absent from the source are set to null after the last range
+    :param source_schema: the schema of source_table
+    :param source_table: the source table of csv data
+    :param target_schema: the schema of target table
+    :param target_table: target tag table
+    :param pk_string: primary key string
+    :param tag_list: list of (tag_name, tag_data_type), tag name equals target field name
+    :param batch_size: source rows per batch
+    :param full_tag_list: tags uploaded by full method
+    :param deleted_table: the deleted keys of a delta source, see merge_tags
+    :return: list of batch reports, dict of rows, seconds and rows_per_second
+    """
+    checkpoint_table = _checkpoint_table(source_schema)
+    tag_names = ",".join([tag_name for tag_name, tag_data_type in tag_list])
+    pk_list = pk_string.split(',')
+    key_str = "(" + pk_string + ")"
+    full_source = source_schema + "." + source_table
+    checkpoint_key = (full_source, target_table, tag_names)
+
+    # the key walk needs an index on the staging primary key
+    index_sql = "create index if not exists {}_pk_idx on {} ({})".format(source_table, full_source, pk_string)
+    postgre_executor(source_schema, index_sql, None)
+
+    last_key = get_merge_checkpoint(source_schema, source_table, target_table, tag_list)
+    if last_key is not None:
+        print("Resume merge of {} into {} after key {}".format(full_source, target_table, last_key))
+
+    batch_report_list = list()
+    while True:
+        start_time = time.time()
+        with db_pool.pg_connection(target_schema) as conn:
+            cur = conn.cursor()
+            lower_str = "true" if last_key is None else key_str + " > (" + ",".join(["%s"] * len(pk_list)) + ")"
+            lower_val = tuple() if last_key is None else tuple(last_key)
+
+            # find the upper bound of this range
+            cur.execute("select " + ",".join(["cast({} as text)".format(x) for x in pk_list]) + " from " +
+                        full_source + " where " + lower_str + " order by " + pk_string +
+                        " offset %s limit 1", lower_val + (batch_size - 1,))
+            upper_result = cur.fetchall()
+            if upper_result:
+                upper_key = list(upper_result[0])
+                where_str = lower_str + " and " + key_str + " <= (" + ",".join(["%s"] * len(pk_list)) + ")"
+                where_val = lower_val + tuple(upper_key)
+            else:
+                upper_key = None
+                where_str = lower_str
+                where_val = lower_val
+
+            merge_sql = build_merge_sql(source_schema, source_table, target_table, pk_string, tag_list, where_str,
+                                        skip_unchanged=bool(full_tag_list))
+            cur.execute(merge_sql, where_val)
+            row_count = cur.rowcount
+
+            if upper_key is None:
+                if full_tag_list:
+                    cur.execute(build_null_sql(source_schema, source_table, target_table, pk_string, full_tag_list,
+                                               deleted_table))
+                    print("{} rows of {} set to null for absent keys".format(cur.rowcount, target_table))
+                cur.execute("delete from " + checkpoint_table +
+                            " where source_oid = to_regclass(%s)::oid and target_table = %s and tag_names = %s",
+                            checkpoint_key)
+            else:
+                cur.execute("insert into " + checkpoint_table +
+                            " (source_oid, target_table, tag_names, last_key, rows_done)" +
+                            " values (to_regclass(%s)::oid, %s, %s, %s, %s)" +
+                            " on conflict (source_oid, target_table, tag_names) do update" +
+                            " set last_key = excluded.last_key," +
+                            " rows_done = " + checkpoint_table + ".rows_done + excluded.rows_done," +
+                            " update_time = now()",
+                            checkpoint_key + (upper_key, row_count))
+            conn.commit()
+            cur.close()
+
+        seconds = time.time() - start_time
+        batch_report = {"rows": row_count, "seconds": round(seconds, 3),
+                        "rows_per_second": round(row_count / seconds, 1) if seconds > 0 else None}
+        batch_report_list.append(batch_report)
+        print("Merge batch {} of {} into {}: {}".format(len(batch_report_list), full_source, target_table,
+                                                       batch_report))
+        if upper_key is None:
+            break
+        last_key = upper_key
+
+    return batch_report_list
+
+
+def load_csv_to_pg(table_name, local_file_path, pk_string, tag_storage_type, derived_tuple, column_type_dict=None,
+                   file_modify_time=None, validate=None, checkpoint=None, snapshot_table=None):
     """ load local file to postgresql
     :param table_name: the table_name of the file
     :param local_file_path: the file in the local path
     :param pk_string: the primary key string
     :param tag_storage_type: tag or detail type
     :param derived_tuple: tuple of derived field information
-    :return:
+    :param column_type_dict: lower case column name -> postgresql type, None means all varchar(4000)
+    :param file_modify_time: the time of hdfs csv file modified
+    :param validate: function wrapping the stream to check its records, see validation_reader
+    :param checkpoint: LoadCheckpoint of the file version, a plain file is copied in chunks committed one by one
+     then, so a retry copies the missing chunks only
+    :param snapshot_table: the delta snapshot of the file, see load_stream_to_pg
+    :return: dict of load report, see load_stream_to_pg
     """
 
-    # read postgres connection info
+    # read path config
     config = configparser.ConfigParser()
     config.read('connection.cfg')
 
-    pg_cfg = config['postgre']
-    pg_host = pg_cfg['pg_host']
-    pg_user = pg_cfg['pg_user']
-    pg_pass = pg_cfg['pg_pass']
-    pg_db = pg_cfg['pg_db']
-    # pg_port = pg_cfg['pg_port']
-    tmp_schema = pg_cfg['tmp_schema']
-
     path_cfg = config['paths']
-    md5_script = path_cfg['md5_script']
-
-    # create a connection
-    conn = psycopg2.connect(dbname=pg_db,
-                            user=pg_user,
-                            host=pg_host,
-                            password=pg_pass,
-                            options=f'-c search_path={tmp_schema}',
-                            )
-    cur = conn.cursor()
-
-    ## add a hash value for detail type csv
+    hash_workers = int(path_cfg.get('line_hash_workers', 1))
+
+    # a large plain file is split and copied over several connections, f only gives the header then,
+    # the validation needs the header so a validated file is copied by one connection
+    copy_workers = 1 if validate else copy_worker_count(local_file_path)
+    chunk_count = copy_workers
+    if checkpoint is not None and not validate and not is_compressed(local_file_path):
+        # the chunk plan of the first attempt is kept, the chunk numbers of the checkpoint refer to it
+        chunk_count = checkpoint.get("chunk_count")
+        if chunk_count is None:
+            chunk_size = int(config['postgre'].get('copy_chunk_mb', 256)) << 20
+            chunk_count = max(copy_workers, -(-os.path.getsize(local_file_path) // chunk_size))
+            checkpoint.update(chunk_count=chunk_count)
+    if chunk_count > 1:
+        detail = tag_storage_type == "detail"
+        parallel_chunks = csv_stream.plan_chunks(local_file_path, chunk_count, detail)
+        print("Copy {} in {} chunks with {} connection(s)".format(local_file_path, len(parallel_chunks),
+                                                                  copy_workers))
+        f = open(local_file_path, 'rb')
+        if detail:
+            f = csv_stream.HashedLineReader(f)
+        return load_stream_to_pg(table_name, f, pk_string, derived_tuple, column_type_dict,
+                                 file_modify_time=file_modify_time, parallel_chunks=parallel_chunks,
+                                 copy_workers=copy_workers, checkpoint=checkpoint, snapshot_table=snapshot_table)
+
+    ## add a hash value for detail type csv, it is computed while streaming into COPY
+    ## a gzip or zstd file is decompressed while streaming too
     if tag_storage_type == "detail":
+        print("Append line_hash to {} with {} worker(s)".format(local_file_path, hash_workers))
+        f = csv_stream.open_detail_stream(local_file_path, hash_workers)
+    else:
+        f = csv_stream.open_decompressed(open(local_file_path, 'rb'), local_file_path)
+
+    return load_stream_to_pg(table_name, f, pk_string, derived_tuple, column_type_dict,
+                             file_modify_time=file_modify_time, validate=validate, checkpoint=checkpoint,
+                             snapshot_table=snapshot_table)
+
+
+def is_compressed(local_file_path):
+    """ whether a local file is gzip or zstd, by its name or its first bytes """
+    with open(local_file_path, 'rb') as f:
+        return csv_stream.detect_compression(local_file_path, f.read(4)) is not None
+
+
+def copy_worker_count(local_file_path):
+    """ number of connections to COPY a local file with, [postgre] copy_workers is a number or auto,
+    auto takes one per copy_chunk_mb (default 256) of the file, at most the pool size minus the load connection.
+    a compressed file cannot be split and is always copied by one connection
+    :return: int
+    """
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    pg_cfg = config['postgre']
+    copy_workers = pg_cfg.get('copy_workers', '1')
+    if copy_workers == "1":
+        return 1
+
+    if is_compressed(local_file_path):
+        return 1
+    max_workers = max(db_pool.get_pg_pool().max_size - 1, 1)
+    if copy_workers == "auto":
+        chunk_size = int(pg_cfg.get('copy_chunk_mb', 256)) << 20
+        return min(max(os.path.getsize(local_file_path) // chunk_size, 1), max_workers)
+    return min(int(copy_workers), max_workers)
+
+
+def parallel_copy(conn, schema_name, copy_sql, chunk_list, workers=None, skip_chunks=None, on_chunk=None):
+    """ COPY the chunks of a file on the load connection and on helper connections of the pool,
+    each chunk sets tag_etl.chunk_no, the default of the _chunk_no column, so the file order can be restored.
+    the load connection copies too, so the load goes on when the pool has no free connection.
+    every chunk is committed on its own
+    :param conn: the load connection, the staging table must be committed already
+    :param schema_name: the schema of the staging table
+    :param copy_sql: COPY ... from STDIN
+    :param chunk_list: functions without argument, each opens the stream of one chunk, see csv_stream.plan_chunks
+    :param workers: connections to copy with, None means one per chunk
+    :param skip_chunks: numbers of the chunks copied already
+    :param on_chunk: called with the chunk number after its commit
+    :return: rows copied
+    """
+    chunk_queue = queue.Queue()
+    for chunk_no, open_chunk in enumerate(chunk_list):
+        if skip_chunks and chunk_no in skip_chunks:
+            continue
+        chunk_queue.put((chunk_no, open_chunk))
+    lock = threading.Lock()
+    result = {"rows": 0}
+    error_list = list()
+
+    def copy_chunks(chunk_conn):
+        cur = chunk_conn.cursor()
+        while not error_list:
+            try:
+                chunk_no, open_chunk = chunk_queue.get_nowait()
+            except queue.Empty:
+                return
+            cur.execute("set local tag_etl.chunk_no = %s", (str(chunk_no),))
+            with open_chunk() as f:
+                cur.copy_expert(copy_sql, f)
+            row_count = cur.rowcount
+            chunk_conn.commit()
+            with lock:
+                result["rows"] += row_count
+                if on_chunk is not None:
+                    on_chunk(chunk_no)
+
+    def helper():
         try:
-            subprocess.run([md5_script, table_name + ".csv"])
+            with db_pool.pg_connection(schema_name, timeout=1) as helper_conn:
+                copy_chunks(helper_conn)
+        except TimeoutError:
+            # no free connection, the remaining chunks are copied by the others
+            return
         except Exception as e:
-            print("md5 script failed: " + str(e))
-        else:
-            local_file_path = local_file_path + ".detail"
-            print("The detail file path is: {}".format(local_file_path))
-
-    # drop the source table, may cause concurrent issue  <<<<<<<
-    drop_tmp_sql = "drop table if exists " + table_name
-    cur.execute(drop_tmp_sql)
-    print("drop table {} completed...".format(table_name))
-
-    # create tmp table
-    create_tmp_sql = "create table " + table_name + " ("
-
-    with open(local_file_path, 'r') as f:
-        header = next(f)
-        col_list = header[:-1].split(',')
-        for col in col_list:
-            create_tmp_sql = create_tmp_sql + col + " varchar(4000), \n"
-
-        create_tmp_sql = create_tmp_sql[:-3] + ")"
-        print("Create PG table:")
-        print(create_tmp_sql)
-        try:
-            cur.execute(create_tmp_sql)
-        except:
-            raise FileloadError("Create temp table error.")
-        else:
-            print("temp table created...")
+            error_list.append(e)
 
-        # cur.copy_from(f, file_name, sep=',')
-        cur.copy_expert("COPY " + table_name + " from STDIN WITH NULL AS '' CSV", f)
-        conn.commit()
-        print("load csv complete...")
+    thread_count = min(workers if workers else len(chunk_list), chunk_queue.qsize()) - 1
+    thread_list = [threading.Thread(target=helper, name="copy-chunk-{}".format(i)) for i in range(thread_count)]
+    for thread in thread_list:
+        thread.start()
+    try:
+        copy_chunks(conn)
+    except BaseException as e:
+        error_list.append(e)
+        raise
+    finally:
+        for thread in thread_list:
+            thread.join()
+    if error_list:
+        raise FileloadError("Parallel copy error, {}".format(str(error_list[0])))
+    return result["rows"]
+
+
+def load_stream_to_pg(table_name, f, pk_string, derived_tuple, column_type_dict=None, staging_mode=None,
+                      file_modify_time=None, parallel_chunks=None, validate=None, copy_workers=None,
+                      checkpoint=None, snapshot_table=None):
+    """ load a csv stream to postgresql, the stream is closed after COPY
+    :param table_name: the table_name of the file
+    :param f: binary file like object of the csv, the first line is the header
+    :param pk_string: the primary key string
+    :param derived_tuple: tuple of derived field information
+    :param column_type_dict: lower case column name -> postgresql type, None means all varchar(4000)
+    :param staging_mode: unlogged or logged, None means [postgre] staging_mode, default logged
+    :param file_modify_time: the time of hdfs csv file modified, stored with the delta snapshot
+    :param parallel_chunks: chunks of the data after the header, see csv_stream.plan_chunks, they are copied by
+     parallel_copy and only the header is read from f. the duplicates are removed by the server keeping
+     the first record in file order
+    :param validate: function wrapping the stream to check its records, see validation_reader
+    :param copy_workers: connections copying parallel_chunks, None means one per chunk
+    :param checkpoint: LoadCheckpoint of the file version, a retry goes on with the staging tables of the
+     failed load when they are still there and skips the copied chunks and the finished stages
+    :param snapshot_table: the delta snapshot, it is shared by the staging generations of a file,
+     None means <table_name>_snapshot
+    :return: dict of load report, end_time, delta (see create_delta_tables) when delta mode is on,
+     duplicates when client dedup is on and rejects with reject_path when validate is given
+    """
+
+    # read postgres connection info
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+
+    pg_cfg = config['postgre']
+    tmp_schema = pg_cfg['tmp_schema']
+    if staging_mode is None:
+        staging_mode = pg_cfg.get('staging_mode', 'logged')
+    # unlogged staging tables skip the WAL, they are rebuilt from the file after a crash anyway
+    unlogged = staging_mode == "unlogged"
+    table_kind = "unlogged table" if unlogged else "table"
+    delta_mode = pg_cfg.get('delta_mode', 'false') == 'true'
+    if snapshot_table is None:
+        snapshot_table = table_name + "_snapshot"
+    load_report = dict()
 
     # while there is derived field, change pk_string during delete duplicates
+    merge_pk_string = pk_string
     if derived_tuple:
         derived_field = derived_tuple[0]
         pk_string_list = [x for x in pk_string.split(",") if x != derived_field]
         pk_string = ",".join(pk_string_list)
 
-    # delete duplicated
+    # a bad record fails the load before it reaches the merge, a rejected record is not a dedup candidate
+    validator = None
+    if validate:
+        f = validator = validate(f)
+
+    # client dedup keeps the first record of each key while streaming and copies into the dedup table directly
     dedup_table_name = table_name + '_dedup'
-    dedup_sql = "drop table if exists " + dedup_table_name + ";" + \
-                "create table " + dedup_table_name + " as select * from ( " + \
-                " select a.*, row_number() over (partition by " + pk_string + ") as rrn from " + table_name + " a " + \
-                " ) b where b.rrn = 1"
-    try:
-        cur.execute(dedup_sql)
-    except Exception as e:
-        raise FileloadError(str(e))
+    client_dedup = pg_cfg.get('dedup_mode', 'server') == "client" and not parallel_chunks
+    # the client compares the csv text, a typed key like level 01 and 1 is one key for the server only
+    if client_dedup and column_type_dict and \
+            any([column_type_dict.get(x.lower(), "text") != "text" for x in pk_string.split(',')]):
+        print("The primary key {} has typed staging columns, dedup on the server.".format(pk_string))
+        client_dedup = False
+    if client_dedup:
+        dedup_memory = int(pg_cfg.get('dedup_memory_mb', 256)) << 20
+        f = csv_stream.DedupRecordReader(f, pk_string.split(','), dedup_memory)
+        copy_table_name = dedup_table_name
     else:
+        copy_table_name = table_name
+
+    # borrow a connection from the pool, it is returned when the load finishes
+    with db_pool.pg_connection(tmp_schema) as conn:
+        cur = conn.cursor()
+        start_lsn = current_wal_lsn(cur)
+
+        # the staging table of the failed load is taken only if it is the very table the checkpoint was written for,
+        # the rows of unfinished chunks of a parallel copy cannot be told apart from a sequential copy
+        resume = checkpoint is not None and checkpoint.get("table_oid") is not None and \
+            checkpoint.get("table_oid") == table_oid(cur, tmp_schema + "." + copy_table_name)
+        if resume and not checkpoint.get("copied") and checkpoint.get("chunks_done") and not parallel_chunks:
+            resume = False
+        if checkpoint is not None and not resume:
+            checkpoint.reset()
+
+        # create tmp table
+        create_tmp_sql = "create " + table_kind + " " + copy_table_name + " ("
+
+        with f:
+            header = f.readline().decode('UTF-8')
+            col_list = header.rstrip('\r\n').split(',')
+            for col in col_list:
+                col_type = "varchar(4000)"
+                if column_type_dict:
+                    col_type = column_type_dict.get(col.lower(), "text")
+                create_tmp_sql = create_tmp_sql + col + " " + col_type + ", \n"
+
+            # keep the same columns as the server side dedup table
+            if client_dedup:
+                create_tmp_sql = create_tmp_sql + "rrn bigint default 1, \n"
+            # the chunk of each row, set by parallel_copy
+            if parallel_chunks:
+                create_tmp_sql = create_tmp_sql + \
+                    "_chunk_no integer default cast(current_setting('tag_etl.chunk_no', true) as integer), \n"
+
+            create_tmp_sql = create_tmp_sql[:-3] + ")"
+            if resume:
+                print("Resume the load of {}, finished: {}".format(copy_table_name, checkpoint.finished()))
+            else:
+                # the staging tables belong to this load run, see new_staging_generation
+                drop_tmp_sql = "drop table if exists " + copy_table_name
+                cur.execute(drop_tmp_sql)
+                print("drop table {} completed...".format(copy_table_name))
+
+                print("Create PG table:")
+                print(create_tmp_sql)
+                try:
+                    cur.execute(create_tmp_sql)
+                except:
+                    raise FileloadError("Create temp table error.")
+                else:
+                    print("temp table created...")
+                if checkpoint is not None:
+                    conn.commit()
+                    checkpoint.update(table_oid=table_oid(cur, tmp_schema + "." + copy_table_name))
+
+            # cur.copy_from(f, file_name, sep=',')
+            copy_sql = "COPY " + copy_table_name + " (" + ",".join(col_list) + ")" + \
+                       " from STDIN WITH NULL AS '' CSV"
+            if not (resume and checkpoint.get("copied")):
+                with stage_metrics.stage("copy", table_name) as metric:
+                    if parallel_chunks:
+                        # the helper connections must see the staging table
+                        conn.commit()
+                        metric.rows = parallel_copy(
+                            conn, tmp_schema, copy_sql, parallel_chunks, copy_workers,
+                            checkpoint.get("chunks_done") if checkpoint is not None else None,
+                            checkpoint.add_chunk if checkpoint is not None else None)
+                    else:
+                        cur.copy_expert(copy_sql, f)
+                        metric.rows = cur.rowcount
+                        metric.bytes = stream_bytes(f)
+                    metric.detail = {"staging_mode": staging_mode, "typed": bool(column_type_dict),
+                                     "chunks": len(parallel_chunks) if parallel_chunks else 1, "resumed": resume}
+
+        # commit after the stream is closed, a failed reader command must not leave a truncated table
         conn.commit()
+        if checkpoint is not None:
+            checkpoint.update(copied=True)
+        print("load csv complete...")
+        # the hash and client dedup run inside the COPY stream, their share of the copy time is reported apart
+        record_stream_stages(f, table_name)
+        if validator is not None:
+            load_report["rejects"] = validator.rejects
+            load_report["reject_path"] = validator.reject_path if validator.rejects else None
+
+        if client_dedup:
+            load_report["duplicates"] = f.duplicates
+        elif resume and checkpoint.get("dedup") and table_oid(cur, tmp_schema + "." + dedup_table_name):
+            print("{} is deduplicated already".format(table_name))
+        else:
+            # delete duplicated, the rows of a parallel copy are ordered back to the file order
+            # and the chunk column is not kept
+            select_str = "*"
+            order_str = ""
+            if parallel_chunks:
+                select_str = ",".join(col_list) + ", rrn"
+                order_str = " order by _chunk_no, ctid"
+            dedup_sql = "drop table if exists " + dedup_table_name + ";" + \
+                        "create " + table_kind + " " + dedup_table_name + " as select " + select_str + " from ( " + \
+                        " select a.*, row_number() over (partition by " + pk_string + order_str + ") as rrn from " + \
+                        table_name + " a " + \
+                        " ) b where b.rrn = 1"
+            with stage_metrics.stage("dedup", table_name) as metric:
+                try:
+                    cur.execute(dedup_sql)
+                except Exception as e:
+                    raise FileloadError(str(e))
+                else:
+                    metric.rows = cur.rowcount
+                    conn.commit()
+            if checkpoint is not None:
+                checkpoint.update(dedup=True)
+
+        # the dedup table has the csv columns plus rrn, no need to describe it again
+        dedup_fields_list = [x.lower() for x in col_list] + ["rrn"]
+        metadata_cache.get_cache().put("columns", (tmp_schema, dedup_table_name), dedup_fields_list)
+
+        # handle the temp table for derived field
+        derive_done = resume and checkpoint.get("derive") and \
+            table_oid(cur, tmp_schema + "." + dedup_table_name + "_derived")
+        if derived_tuple and not derive_done:
+            create_derived_sql = create_derived_table(tmp_schema, dedup_table_name, derived_tuple, unlogged,
+                                                      dedup_fields_list)
+            with stage_metrics.stage("derive", table_name) as metric:
+                try:
+                    cur.execute(create_derived_sql)
+                except Exception as e:
+                    print("Create derived table {}_derived succeed.".format(dedup_table_name))
+                    raise FileloadError(str(e))
+                metric.rows = cur.rowcount
 
-    # handle the temp table for derived field
-    if derived_tuple:
-        create_derived_sql = create_derived_table(tmp_schema, dedup_table_name, derived_tuple)
-        try:
-            cur.execute(create_derived_sql)
-        except Exception as e:
-            print("Create derived table {}_derived succeed.".format(dedup_table_name))
-            raise FileloadError(str(e))
+        conn.commit()
+        if checkpoint is not None and derived_tuple:
+            checkpoint.update(derive=True)
+
+        staging_table_list = [dedup_table_name] if client_dedup else [table_name, dedup_table_name]
+        if derived_tuple:
+            staging_table_list.append(dedup_table_name + "_derived")
+
+        # compare with the snapshot of the previous load, keep the changed rows for the merge
+        if delta_mode:
+            with stage_metrics.stage("delta", table_name) as metric:
+                try:
+                    load_report["delta"] = create_delta_tables(cur, staging_table_list[-1], merge_pk_string,
+                                                               snapshot_table, file_modify_time, table_kind)
+                except Exception as e:
+                    raise FileloadError("Create delta tables error, {}".format(str(e)))
+                else:
+                    conn.commit()
+                    metric.detail = load_report["delta"]
+                    print("Delta of {}: {}".format(table_name, load_report["delta"]))
+
+        print("Staging write report: {}".format(staging_write_report(cur, start_lsn, staging_table_list, staging_mode)))
+
+    load_report["end_time"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return load_report
 
-    conn.commit()
-    conn.close()
 
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+def table_oid(cur, full_table_name):
+    """ :return: oid of a table, None when it does not exist """
+    cur.execute("select cast(to_regclass(%s) as oid)", (full_table_name,))
+    return cur.fetchall()[0][0]
 
 
-def create_derived_table(schema_name, table_name, derived_tuple):
-    """ create a temp table contain derived field
+class LoadCheckpoint(object):
+    """ progress of the load of a file version, kept as json in the load_checkpoint column of the file log table,
+    a retry of the same version skips what is done: the download (fetching, fetched), the staging table (table_oid),
+    the committed copy chunks (chunk_count, chunks_done) and the stages (copied, dedup, derive)
+    :param file_name: the file name of algorithm output csv
+    :param file_modify_time: the time of hdfs csv file modified
+    :param state: dict of the progress saved by the failed load
+    """
+
+    # the progress which belongs to a staging table
+    TABLE_KEYS = ("table_oid", "chunks_done", "copied", "dedup", "derive")
+
+    def __init__(self, file_name, file_modify_time, state=None):
+        self.file_name = file_name
+        self.file_modify_time = file_modify_time
+        self.state = state if state else dict()
+        # parallel_copy reports its chunks from several threads
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self.state.get(key, default)
+
+    def finished(self):
+        """ :return: the names of the finished stages """
+        with self._lock:
+            return [x for x in ("fetched", "copied", "dedup", "derive") if self.state.get(x)]
+
+    def _save(self, state):
+        config = configparser.ConfigParser()
+        config.read('connection.cfg')
+        log_file_table = config['mysql_tables']['log_file']
+        checkpoint_sql = "update " + log_file_table + " set load_checkpoint = %s" + \
+                         " where file_name = %s and file_hdfs_time = %s"
+        mysql_executor(checkpoint_sql, (json.dumps(state) if state else None, self.file_name,
+                                        self.file_modify_time))
+
+    def update(self, **kwargs):
+        with self._lock:
+            self.state.update(kwargs)
+            self._save(self.state)
+
+    def add_chunk(self, chunk_no):
+        """ record a committed chunk of parallel_copy """
+        with self._lock:
+            self.state["chunks_done"] = self.state.get("chunks_done", list()) + [chunk_no]
+            self._save(self.state)
+
+    def reset(self):
+        """ forget the progress of the staging tables, the download is kept """
+        with self._lock:
+            if any([x in self.state for x in self.TABLE_KEYS]):
+                self.state = dict([(x, y) for x, y in self.state.items() if x not in self.TABLE_KEYS])
+                self._save(self.state)
+
+    def clear(self):
+        """ the load succeeded, nothing to resume """
+        with self._lock:
+            if self.state:
+                self.state = dict()
+                self._save(None)
+
+
+def open_load_checkpoint(file_name, file_modify_time, generation=None):
+    """ the checkpoint of a file version with [postgre] load_checkpoint = true, default false
+    :param generation: the staging generation of the load run, the checkpoint belongs to the generation
+     the file log row names, a run of another generation loads without one
+    :return: LoadCheckpoint with the progress of the last failed load, None when checkpoints are off
+    """
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    if config['postgre'].get('load_checkpoint', 'false') != 'true':
+        return None
+    log_file_table = config['mysql_tables']['log_file']
+    checkpoint_sql = "select load_checkpoint, tmp_table_name from " + log_file_table + \
+                     " where file_name = %s and file_hdfs_time = %s"
+    query_result = mysql_executor(checkpoint_sql, (file_name, file_modify_time))
+    if generation and query_result and query_result[0][1] != generation:
+        print("{} @{} is loaded by another run, no checkpoint".format(file_name, file_modify_time))
+        return None
+    state = json.loads(query_result[0][0]) if query_result and query_result[0][0] else None
+    if state:
+        print("Checkpoint of {} @{}: {}".format(file_name, file_modify_time, state))
+    return LoadCheckpoint(file_name, file_modify_time, state)
+
+
+def stream_bytes(f):
+    """ bytes read from the innermost stream of a reader chain, compressed bytes for a compressed file,
+    call it before the stream is closed
+    :return: int, None when it cannot be told
+    """
+    while isinstance(f, (csv_stream.LineStreamReader, csv_stream.DecompressedStream)):
+        f = f.fileobj
+    if isinstance(f, csv_stream.CommandStream):
+        return f.bytes_read
+    try:
+        return f.tell()
+    except Exception:
+        return None
+
+
+def record_stream_stages(f, table_name):
+    """ add the transform time of every reader of a chain to the stage metrics, HashedLineReader as hash,
+    DedupRecordReader as dedup, ValidatingRecordReader as validate and DecompressedStream as decompress
+    """
+    while isinstance(f, (csv_stream.LineStreamReader, csv_stream.DecompressedStream)):
+        if isinstance(f, csv_stream.DecompressedStream):
+            stage_metrics.record("decompress", f.seconds, None, f.bytes_out, table_name)
+        elif isinstance(f, csv_stream.HashedLineReader):
+            stage_metrics.record("hash", f.transform_seconds, f.line_no, f.bytes_in, table_name)
+        elif isinstance(f, csv_stream.DedupRecordReader):
+            stage_metrics.record("dedup", f.transform_seconds, f.line_no - f.duplicates, f.bytes_in, table_name)
+        elif isinstance(f, csv_stream.ValidatingRecordReader):
+            stage_metrics.record("validate", f.transform_seconds, f.line_no - f.rejects, f.bytes_in, table_name)
+        f = f.fileobj
+
+
+def staging_column_types(file_name, pk_string):
+    """ infer the column types of a typed staging table,
+    tag columns from sync_rule tag_data_type, level as integer and geo_point as geometry
+    :param file_name: the source file name
+    :param pk_string: the primary key string
+    :return: dict, lower case column name -> postgresql type
+    """
+    type_map = {"string": "text", "enum": "text", "numeric": "numeric", "bool": "bool"}
+    column_type_dict = dict()
+    for tag_name, tag_data_type, derived_source_column in metadata_cache.get_file_rules(file_name):
+        # a derived source column holds the values of its tag
+        col = derived_source_column if derived_source_column else tag_name
+        column_type_dict[col.lower()] = type_map.get(tag_data_type, "text")
+
+    for col in pk_string.split(','):
+        if "geo_point" == col.lower():
+            column_type_dict[col.lower()] = '"public"."geometry"'
+        elif "level" == col.lower():
+            column_type_dict[col.lower()] = "integer"
+
+    print("The staging column types are: {}".format(column_type_dict))
+    return column_type_dict
+
+
+# staging column types checked by the validation, see csv_stream.check_value
+VALIDATION_TYPES = {"numeric": "numeric", "bool": "bool", "integer": "integer", '"public"."geometry"': "geo_point"}
+
+
+def validation_reader(file_name, pk_string):
+    """ the stream validation of a file by [validation] mode, off (default) does not check,
+    abort fails the load at the first bad record, reject writes the bad records to
+    <reject_dir>/<file_name>.reject.csv (reject_dir default [paths] csv_base)
+    and fails the load when there are more than max_rejects (default 0)
+    :param file_name: the source file name
+    :param pk_string: the primary key string
+    :return: function wrapping a stream in csv_stream.ValidatingRecordReader, None when the validation is off
+    """
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    validation_cfg = config['validation'] if config.has_section('validation') else dict()
+    mode = validation_cfg.get('mode', 'off')
+    if mode == "off":
+        return None
+
+    # the same column types as a typed staging table
+    type_dict = dict([(col, VALIDATION_TYPES[col_type]) for col, col_type in
+                      staging_column_types(file_name, pk_string).items() if col_type in VALIDATION_TYPES])
+    if mode == "abort":
+        return functools.partial(csv_stream.ValidatingRecordReader, type_dict=type_dict)
+    elif mode == "reject":
+        reject_dir = validation_cfg.get('reject_dir', config['paths']['csv_base'])
+        reject_path = os.path.join(reject_dir, file_name + ".reject.csv")
+        # the rejects of the previous load are not kept
+        if os.path.exists(reject_path):
+            os.remove(reject_path)
+        return functools.partial(csv_stream.ValidatingRecordReader, type_dict=type_dict, reject_path=reject_path,
+                                 max_rejects=int(validation_cfg.get('max_rejects', 0)))
+    raise Exception("[validation] mode {} is not supported.".format(mode))
+
+
+def current_wal_lsn(cur):
+    """ get the current WAL insert position, None when it cannot be read """
+    try:
+        cur.execute("select pg_current_wal_insert_lsn()")
+        return cur.fetchone()[0]
+    except Exception as e:
+        print("Cannot read WAL position: {}".format(str(e)))
+        cur.connection.rollback()
+        return None
+
+
+def staging_write_report(cur, start_lsn, table_list, staging_mode):
+    """ bytes written by a staging load, the WAL part is server wide so concurrent work is included
+    :param cur: cursor of the load connection
+    :param start_lsn: WAL position before the load
+    :param table_list: staging tables created by the load
+    :param staging_mode: unlogged or logged
+    :return: dict of staging_mode, wal_bytes and table_bytes
+    """
+    report = {"staging_mode": staging_mode, "wal_bytes": None, "table_bytes": None}
+    try:
+        cur.execute("select sum(pg_total_relation_size(x::regclass)) from unnest(%s) as x", (table_list,))
+        report["table_bytes"] = int(cur.fetchone()[0] or 0)
+        if start_lsn is not None:
+            cur.execute("select pg_wal_lsn_diff(pg_current_wal_insert_lsn(), %s)", (start_lsn,))
+            report["wal_bytes"] = int(cur.fetchone()[0])
+        cur.connection.commit()
+    except Exception as e:
+        print("Cannot measure staging writes: {}".format(str(e)))
+        cur.connection.rollback()
+    return report
+
+
+def create_delta_tables(cur, source_table, pk_string, snapshot_table, file_modify_time, table_kind):
+    """ compare the staging table with the (primary key, row hash) snapshot of the previous load,
+    create <source_table>_delta with the inserted and changed rows (delta_op I or U),
+    <source_table>_deleted with the keys missing from this load, then replace the snapshot.
+    the snapshot stays a logged table, its comment is the file time it was taken from
+    :param cur: cursor of the load connection, the caller commits
+    :param source_table: the final staging table, dedup or dedup_derived
+    :param pk_string: the primary key string of the target table
+    :param snapshot_table: the snapshot table of the file
+    :param file_modify_time: the time of hdfs csv file modified
+    :param table_kind: table or unlogged table, used for the delta tables
+    :return: dict of base_time (None when there is no previous snapshot), inserted, changed, deleted
+    """
+    delta_table = source_table + "_delta"
+    deleted_table = source_table + "_deleted"
+    pk_list = pk_string.split(',')
+    join_str = " and ".join(["s.{0} = p.{0}".format(col) for col in pk_list])
+    row_hash = "md5(cast(row(s.*) as text))"
+
+    # the loads of different versions of a file replace the shared snapshot one after the other,
+    # the lock is held until the load commits
+    cur.execute("select pg_advisory_xact_lock(hashtext(%s))", ("tag_etl_snapshot:" + snapshot_table,))
+    cur.execute("select obj_description(to_regclass(%s), 'pg_class'), to_regclass(%s) is not null",
+                (snapshot_table, snapshot_table))
+    base_time, snapshot_exists = cur.fetchone()
+    delta_report = {"base_time": None, "inserted": None, "changed": None, "deleted": None}
+
+    delta_sql = "drop table if exists {0}; drop table if exists {1};".format(delta_table, deleted_table)
+    if snapshot_exists and base_time:
+        delta_report["base_time"] = base_time
+        delta_sql = delta_sql + \
+            "create {0} {1} as select s.*, case when p.row_hash is null then 'I' else 'U' end as delta_op " \
+            " from {2} s left join {3} p on {4} " \
+            " where p.row_hash is null or p.row_hash <> {5};".format(table_kind, delta_table, source_table,
+                                                                    snapshot_table, join_str, row_hash) + \
+            "create {0} {1} as select {2} from {3} p " \
+            " where not exists (select 1 from {4} s where {5});".format(table_kind, deleted_table,
+                                                                       ",".join(["p." + x for x in pk_list]),
+                                                                       snapshot_table, source_table, join_str)
+    delta_sql = delta_sql + \
+        "drop table if exists {0};" \
+        "create table {0} as select {1}, {2} as row_hash from {3} s;".format(
+            snapshot_table, ",".join(["s." + x for x in pk_list]), row_hash, source_table)
+    print("The delta sql is:")
+    print(delta_sql)
+    cur.execute(delta_sql)
+    cur.execute("comment on table {} is %s".format(snapshot_table), (file_modify_time,))
+
+    if delta_report["base_time"]:
+        cur.execute("select count(*) filter (where delta_op = 'I'), count(*) filter (where delta_op = 'U') "
+                    " from {}".format(delta_table))
+        delta_report["inserted"], delta_report["changed"] = cur.fetchone()
+        cur.execute("select count(*) from {}".format(deleted_table))
+        delta_report["deleted"] = cur.fetchone()[0]
+    return delta_report
+
+
+def delta_merge_source(file_name, file_modify_time, source_table, tag_name_list):
+    """ choose the staging table to merge from, the delta table can only be used when every tag
+    was merged successfully from the file version the delta is based on
+    :param file_name: the source file name
+    :param file_modify_time: the time of hdfs csv file modified
+    :param source_table: the final staging table, dedup or dedup_derived
+    :param tag_name_list: the tags to merge
+    :return: (table to merge from, table of deleted keys or None)
+    """
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    if config['postgre'].get('delta_mode', 'false') != 'true':
+        return source_table, None
+
+    mysql_tables_cfg = config['mysql_tables']
+    log_file_table = mysql_tables_cfg['log_file']
+    log_tag_table = mysql_tables_cfg['log_tag']
+
+    base_sql = "select delta_base_time from " + log_file_table + \
+               " where file_name = %s and file_hdfs_time = %s and status = 'success'"
+    base_result = mysql_executor(base_sql, (file_name, file_modify_time))
+    if len(base_result) == 0 or base_result[0][0] is None:
+        print("No delta base for {}, merge the whole staging table.".format(file_name))
+        return source_table, None
+
+    base_time = base_result[0][0]
+    tag_time_sql = "select max(file_hdfs_time) from " + log_tag_table + \
+                   " where file_name = %s and tag_name_en = %s and status = 'success'"
+    for tag_name in tag_name_list:
+        tag_time = mysql_executor(tag_time_sql, (file_name, tag_name))[0][0]
+        if tag_time != base_time:
+            print("{} was last merged from {} instead of delta base {}, merge the whole staging table.".format(
+                tag_name, tag_time, base_time))
+            return source_table, None
+
+    print("Merge the delta of {} based on {}".format(file_name, base_time))
+    return source_table + "_delta", source_table + "_deleted"
+
+
+def checksum_enabled():
+    """ the content checksum of the files is compared with [file_source] checksum = true, default false """
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    return config.has_section('file_source') and config['file_source'].get('checksum', 'false') == 'true'
+
+
+def file_checksum(file_path):
+    """ the content checksum of a source file, see file_source.FileSource.checksum
+    :return: checksum string, None when the checksum is off or the file source cannot tell
+    """
+    if not checksum_enabled():
+        return None
+    with stage_metrics.stage("checksum", os.path.basename(file_path)) as metric:
+        checksum = file_source.get_file_source().checksum(file_path)
+        metric.detail = {"checksum": checksum}
+    return checksum
+
+
+def skip_unchanged(file_name, file_path, file_modify_time, checksum):
+    """ a file version with the content of the last loaded version is not loaded again,
+    the version is logged as loaded with the checksum, the staging generation of the last version serves it
+    :return: True when the version is skipped
+    """
+    if checksum is None:
+        return False
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    log_file_table = config['mysql_tables']['log_file']
+    tmp_schema = config['postgre']['tmp_schema']
+
+    last_sql = "select file_hdfs_time, file_checksum from " + log_file_table + \
+               " where file_name = %s and status = 'success' and file_checksum is not null" + \
+               " order by file_hdfs_time desc limit 1"
+    last_result = mysql_executor(last_sql, (file_name,))
+    if len(last_result) == 0 or last_result[0][1] != checksum:
+        return False
+    # the new version points to the staging generation of the last version
+    tmp_table_name = staging_base_name(file_name, last_result[0][0].strftime('%Y-%m-%d %H:%M:%S'))
+    with db_pool.pg_connection(tmp_schema) as conn:
+        dedup_oid = table_oid(conn.cursor(), tmp_schema + "." + tmp_table_name + "_dedup")
+    if dedup_oid is None:
+        print("{} is unchanged but its staging table is gone, load it again.".format(file_name))
+        return False
+
+    # no delta base, a tag which was not merged from the last version merges the whole staging table
+    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    skip_sql = "insert into " + log_file_table + \
+               "(file_name,file_path,file_hdfs_time,start_time,end_time,status,error_msg,tmp_table_schema," + \
+               "tmp_table_name,file_checksum) values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)" + \
+               " on DUPLICATE KEY UPDATE end_time=%s, status=%s, error_msg=%s, delta_base_time=NULL," + \
+               " tmp_table_schema=%s, tmp_table_name=%s, file_checksum=%s"
+    mysql_executor(skip_sql, (file_name, file_path, file_modify_time, current_time, current_time, "success", None,
+                              tmp_schema, tmp_table_name, checksum, current_time, "success", None, tmp_schema,
+                              tmp_table_name, checksum))
+    print("{} @{} has the content of @{}, skip the load.".format(file_name, file_modify_time, last_result[0][0]))
+    return True
+
+
+def content_merged(file_name, file_modify_time, tag_name_list, target_table):
+    """ whether every tag was last merged from a version of the file with the content of this version,
+    and no merge of the tags into the target stopped part-way since, the merge would change nothing then
+    :param file_name: the source file name
+    :param file_modify_time: the time of hdfs csv file modified
+    :param tag_name_list: the tags to merge
+    :param target_table: target tag table
+    :return: True when the merge can be skipped
+    """
+    if not checksum_enabled():
+        return False
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    mysql_tables_cfg = config['mysql_tables']
+    log_file_table = mysql_tables_cfg['log_file']
+    log_tag_table = mysql_tables_cfg['log_tag']
+
+    checksum_sql = "select file_checksum from " + log_file_table + " where file_name = %s and file_hdfs_time = %s"
+    checksum_result = mysql_executor(checksum_sql, (file_name, file_modify_time))
+    if len(checksum_result) == 0 or checksum_result[0][0] is None:
+        return False
+
+    merged_sql = "select f.file_checksum from " + log_tag_table + " t join " + log_file_table + " f" + \
+                 " on f.file_name = t.file_name and f.file_hdfs_time = t.file_hdfs_time" + \
+                 " where t.file_name = %s and t.tag_name_en = %s and t.status = 'success'" + \
+                 " order by t.file_hdfs_time desc limit 1"
+    for tag_name in tag_name_list:
+        merged_result = mysql_executor(merged_sql, (file_name, tag_name))
+        if len(merged_result) == 0 or merged_result[0][0] != checksum_result[0][0]:
+            return False
+    # a failed batched merge of another version left the target partly updated, only batched merges stop part-way
+    if int(config['postgre'].get('merge_batch_size', 0)) > 0 and \
+            unfinished_merge_count(config['postgre']['tmp_schema'], target_table, tag_name_list) > 0:
+        print("A merge of {} into {} is unfinished, merge again.".format(",".join(tag_name_list), target_table))
+        return False
+    print("{} were merged from the same content of {}, skip the merge.".format(",".join(tag_name_list), file_name))
+    return True
+
+
+def _parse_derived_tuple(derived_tuple):
+    """ split derived_tuple to (derived_field, source field list, derived value list, tag list) """
+    derived_src_fields_list = list()
+    derived_value_list = list()
+    tag_list = list()
+    for item in derived_tuple[1].split(","):
+        derived_src_fields_list.append(item.split(":")[0])
+        derived_value_list.append(item.split(":")[1])
+        tag_list.append(item.split(":")[2])
+    return derived_tuple[0], derived_src_fields_list, derived_value_list, tag_list
+
+
+def create_derived_table(schema_name, table_name, derived_tuple, unlogged=False, fields_list=None):
+    """ create a temp table contain derived field, the source table is scanned once
+    and every row is expanded to one row per not null derived source column by a lateral VALUES list
     :param schema_name: schema name of table located
     :param table_name: the temp table name
     :param derived_tuple: format is (field_name, "source_column:derived_value:tag_name")
@@ -338,24 +1530,57 @@ def create_derived_table(schema_name, table_name, derived_tuple):
         2|c|t|bad
         2|d|f|bad
 
+    :param unlogged: create an unlogged table
+    :param fields_list: the fields of the temp table, None means read them from the database
     :return: sql string to create the derived table
     """
     derived_table_name = table_name + "_derived"
     drop_table_sql = "drop table if exists {}".format(derived_table_name)
-    derived_field = derived_tuple[0]
-    derived_source_str = derived_tuple[1]
+    derived_field, derived_src_fields_list, derived_value_list, tag_list = _parse_derived_tuple(derived_tuple)
 
-    # get the fields list from the original temp table
-    fields_list = postgre_desc_table(schema_name, table_name)
+    # get the fields list from the original temp table, the loader caches the columns it creates
+    if fields_list is None:
+        fields_list = metadata_cache.get_table_columns(schema_name, table_name)
 
-    # put the derived source fields and new value to list
-    derived_src_fields_list = list()
-    derived_value_list = list()
-    tag_list = list()
-    for item in derived_source_str.split(","):
-        derived_src_fields_list.append(item.split(":")[0])
-        derived_value_list.append(item.split(":")[1])
-        tag_list.append(item.split(":")[2])
+    # delete the derived source fields from full fields
+    clean_fields_list = [x for x in fields_list if x not in derived_src_fields_list]
+
+    # it will be like: select s.id, s.other, v.val, v.brand from t s
+    #   cross join lateral (values (s.xx_val, 't'), (s.yy_val, 'f')) as v(val, brand) where v.val is not null
+    # the output columns are named like the first select of the union all version
+    values_str = ", ".join(["(s.{}, '{}')".format(derived_src_fields_list[i], derived_value_list[i])
+                            for i in range(len(derived_src_fields_list))])
+    table_kind = "unlogged table" if unlogged else "table"
+    unpivot_sql = "create {} {} as \n".format(table_kind, derived_table_name) + \
+                  "select {}, v.{}, v.{} from {} s\n".format(",".join(["s." + x for x in clean_fields_list]),
+                                                          tag_list[0], derived_field, table_name) + \
+                  "cross join lateral (values {}) as v({}, {})\n".format(values_str, tag_list[0], derived_field) + \
+                  "where v.{} is not null".format(tag_list[0])
+
+    print("The unpivot sql for derived field is:")
+    print(unpivot_sql)
+
+    return drop_table_sql + ";\n" + unpivot_sql
+
+
+def create_derived_table_union(schema_name, table_name, derived_tuple, unlogged=False, fields_list=None):
+    """ create a temp table contain derived field with one select per derived source column
+    stitched by union all, it scans the source table once per column. kept as the reference
+    implementation of create_derived_table, see tests/test_derived_unpivot.py and benchmarks/check_derived_unpivot.py
+    :param schema_name: schema name of table located
+    :param table_name: the temp table name
+    :param derived_tuple: format is (field_name, "source_column:derived_value:tag_name")
+    :param unlogged: create an unlogged table
+    :param fields_list: the fields of the temp table, None means read them from the database
+    :return: sql string to create the derived table
+    """
+    derived_table_name = table_name + "_derived"
+    drop_table_sql = "drop table if exists {}".format(derived_table_name)
+    derived_field, derived_src_fields_list, derived_value_list, tag_list = _parse_derived_tuple(derived_tuple)
+
+    # get the fields list from the original temp table
+    if fields_list is None:
+        fields_list = postgre_desc_table(schema_name, table_name)
 
     # delete the derived source fields from full fields
     clean_fields_list = [x for x in fields_list if x not in derived_src_fields_list]
@@ -371,7 +1596,8 @@ def create_derived_table(schema_name, table_name, derived_tuple):
                    derived_src_fields_list[i])
         select_list.append(select_str)
 
-    union_sql = "create table {} as ".format(derived_table_name, derived_table_name)
+    table_kind = "unlogged table" if unlogged else "table"
+    union_sql = "create {} {} as ".format(table_kind, derived_table_name)
 
     select_count = len(select_list)
     for i in range(select_count):
@@ -385,13 +1611,347 @@ def create_derived_table(schema_name, table_name, derived_tuple):
     return drop_table_sql + ";\n" + union_sql
 
 
-def file_to_tempdb(file_name, file_path, pk_string, tag_storage_type, derived_tuple):
+def fetch_and_load(file_name, file_path, file_modify_time, pk_string, tag_storage_type, derived_tuple,
+                   checksum=None, generation=None):
+    """ fetch the file from HDFS and load it to tempdb, write the result to the file log table
+    with [paths] load_mode = stream, the file source stream is piped straight into COPY,
+    otherwise (default) the file is copied to csv_base first and loaded from the local copy
+    :param file_name: the file name of algorithm output csv
+    :param file_path: the file path in the HDFS
+    :param file_modify_time: the time of hdfs csv file modified
+    :param pk_string: primary key list for the target table
+    :param tag_storage_type: tag or detail
+    :param derived_tuple: a tuple store the information of derived field
+    :param checksum: content checksum of the file version, None means it is computed from the local copy
+     when the checksum is on, see file_checksum
+    :param generation: the staging generation of this load run, see new_staging_generation,
+     None means the staging tables are named after the file
+    :return: file_modify_time
+    """
+
+    # Access configuration file
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+
+    path_cfg = config['paths']
+    mysql_tables_cfg = config['mysql_tables']
+
+    local_csv = path_cfg['csv_base']
+    load_mode = path_cfg.get('load_mode', 'local')
+    log_file_table = mysql_tables_cfg['log_file']
+    staging_typed = config['postgre'].get('staging_typed', 'false') == 'true'
+
+    # the local copy and the staging tables belong to the generation, concurrent runs do not share them
+    tmp_table_name = generation if generation else file_name.split('.')[0]
+    local_file_path = local_staging_path(local_csv, file_name, generation)
+    snapshot_table = file_name.split('.')[0] + "_snapshot"
+
+    # file load fail log, the row points to the generation of the run finished last,
+    # a failed run does not take the row from a concurrent run which loaded the version
+    file_fail_sql = "insert into " + log_file_table + \
+                    "(file_name,file_path,file_hdfs_time,end_time,status,error_msg,tmp_table_name) " + \
+                    " values (%s, %s, %s, %s, %s, %s, %s)" + \
+                    " on DUPLICATE KEY UPDATE end_time=%s, error_msg=%s," + \
+                    " tmp_table_name=if(status='success', tmp_table_name, %s)," + \
+                    " status=if(status='success', status, 'fail')"
+
+    try:
+        column_type_dict = None
+        if staging_typed:
+            column_type_dict = staging_column_types(file_name, pk_string)
+        validate = validation_reader(file_name, pk_string)
+        # a retry of a failed load of this version goes on from its checkpoint
+        checkpoint = open_load_checkpoint(file_name, file_modify_time, generation)
+
+        if load_mode == "stream":
+            print("Stream {} into tempdb...".format(file_path))
+            f = file_source.get_file_source().open_stream(file_path)
+            f = csv_stream.open_decompressed(f, file_path)
+            if tag_storage_type == "detail":
+                f = csv_stream.HashedLineReader(f)
+            # a stream cannot be continued, the load starts over
+            load_report = load_stream_to_pg(tmp_table_name, f, pk_string, derived_tuple, column_type_dict,
+                                            file_modify_time=file_modify_time, validate=validate,
+                                            snapshot_table=snapshot_table)
+        else:
+            # start copy file to local, unless this version was prefetched
+            prefetched_path = prefetch_path(local_csv, file_name, file_modify_time)
+            if os.path.exists(prefetched_path):
+                os.replace(prefetched_path, local_file_path)
+                print(file_name + " was prefetched...")
+                if checkpoint is not None:
+                    checkpoint.update(fetching=False, fetched=os.path.getsize(local_file_path))
+            elif checkpoint is not None and os.path.exists(local_file_path) and \
+                    os.path.getsize(local_file_path) == checkpoint.get("fetched"):
+                print(file_name + " was fetched by the failed load...")
+            else:
+                with stage_metrics.stage("fetch", file_name) as metric:
+                    # a partial download of this version is continued when the file source can seek
+                    resume = checkpoint is not None and bool(checkpoint.get("fetching"))
+                    if checkpoint is not None:
+                        checkpoint.update(fetching=True, fetched=None)
+                    try:
+                        metric.bytes = file_source.get_file_source().fetch(file_path, local_file_path, resume)
+                    except FileloadError:
+                        print(file_name + " copy to local fail.")
+                        raise
+                    metric.detail = {"resumed": resume}
+                if checkpoint is not None:
+                    checkpoint.update(fetched=metric.bytes)
+                print(file_name + " copy to local success...")
+            # the file source cannot tell the checksum, the content is hashed after the download
+            if checksum is None and checksum_enabled():
+                with stage_metrics.stage("checksum", file_name):
+                    checksum = file_source.md5_file(local_file_path)
+                if skip_unchanged(file_name, file_path, file_modify_time, checksum):
+                    return file_modify_time
+            # start load data to tmp table
+            load_report = load_csv_to_pg(tmp_table_name, local_file_path, pk_string, tag_storage_type,
+                                         derived_tuple, column_type_dict, file_modify_time, validate, checkpoint,
+                                         snapshot_table)
+    except Exception as e:
+        # write fail to log table and raise exception
+        error_msg = (str(e))
+        end_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        file_error_val = (file_name, file_path, file_modify_time, end_time, "fail", error_msg, tmp_table_name,
+                          end_time, error_msg, tmp_table_name)
+        mysql_executor(file_fail_sql, file_error_val)
+        raise FileloadError(error_msg)
+    else:
+        # the checksum, the delta counts and the rejects are written with the status in one statement,
+        # a worker which sees the success sees them as well
+        result_dict = dict()
+        if checksum is not None:
+            result_dict["file_checksum"] = checksum
+        # the delta base is used to decide whether a tag can merge the delta only
+        if "delta" in load_report:
+            delta_report = load_report["delta"]
+            result_dict.update({"delta_base_time": delta_report["base_time"],
+                                "delta_inserted": delta_report["inserted"],
+                                "delta_changed": delta_report["changed"], "delta_deleted": delta_report["deleted"]})
+        # the records dropped by the validation, see the reject file
+        if "rejects" in load_report:
+            result_dict.update({"reject_rows": load_report["rejects"], "reject_file": load_report["reject_path"]})
+
+        end_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        result_column_list = sorted(result_dict)
+        file_success_sql = "insert into " + log_file_table + \
+                           "(file_name,file_path,file_hdfs_time,end_time,status,error_msg,tmp_table_name" + \
+                           "".join(["," + x for x in result_column_list]) + ") " + \
+                           " values (" + ", ".join(["%s"] * (7 + len(result_column_list))) + ")" + \
+                           " on DUPLICATE KEY UPDATE end_time=%s, status=%s, error_msg=%s, tmp_table_name=%s" + \
+                           "".join([", {}=%s".format(x) for x in result_column_list])
+        result_val_list = [result_dict[x] for x in result_column_list]
+        file_success_val = tuple([file_name, file_path, file_modify_time, end_time, "success", None,
+                                  tmp_table_name] + result_val_list +
+                                 [end_time, "success", None, tmp_table_name] + result_val_list)
+        mysql_executor(file_success_sql, file_success_val)
+        if checkpoint is not None:
+            checkpoint.clear()
+
+        # this generation is the latest good one now, the old ones are not needed
+        if generation:
+            gc_staging_generations(file_name)
+        return file_modify_time
+
+
+def prefetch_path(local_csv, file_name, file_modify_time):
+    """ the local path of a prefetched file version, fetch_and_load moves it into place instead of fetching """
+    return os.path.join(local_csv, ".{}.{}.prefetch".format(file_name, file_modify_time.replace(' ', '_')))
+
+
+def file_is_loaded(file_name, file_modify_time):
+    """ check in the file log table whether this file version is loaded already """
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    log_file_table = config['mysql_tables']['log_file']
+
+    file_log_sql = "select file_hdfs_time, status from " + log_file_table + \
+                   " where file_name = %s " + \
+                   " order by file_hdfs_time desc, start_time desc limit 1"
+    query_result = mysql_executor(file_log_sql, (file_name,))
+    if len(query_result) == 0 or query_result[0][1] != "success":
+        return False
+    return datetime.strptime(file_modify_time, '%Y-%m-%d %H:%M:%S') <= query_result[0][0]
+
+
+def prefetch_file(file_name, file_path, file_modify_time):
+    """ copy a file version to the local csv base ahead of its load, so the download overlaps other work,
+    nothing is done with [paths] load_mode = stream or when the version is loaded already
+    :return: the prefetched path, None when nothing was fetched
+    """
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    path_cfg = config['paths']
+    if path_cfg.get('load_mode', 'local') == "stream" or file_is_loaded(file_name, file_modify_time):
+        return None
+
+    local_path = prefetch_path(path_cfg['csv_base'], file_name, file_modify_time)
+    if os.path.exists(local_path):
+        return local_path
+    # fetch to a temp name first, a partial download is never taken as prefetched
+    partial_path = local_path + ".part"
+    with stage_metrics.stage("fetch", file_name) as metric:
+        metric.bytes = file_source.get_file_source().fetch(file_path, partial_path)
+        metric.detail = {"prefetch": True}
+    os.replace(partial_path, local_path)
+    return local_path
+
+
+def _generation_base(file_name):
+    """ the file part of a staging generation name, a long file name is cut and made unique by its hash,
+    the longest name built on a generation, <generation>_dedup_derived_deleted_pk_idx, stays within
+    the 63 bytes of an identifier, the file log row keeps the generation
+    """
+    base_name = file_name.split('.')[0].lower()
+    if len(base_name) <= 20:
+        return base_name
+    return base_name[:12] + "_" + hashlib.md5(base_name.encode()).hexdigest()[:7]
+
+
+def new_staging_generation(file_name):
+    """ a staging table name for one load run of a file, <file>_g<8 hex start time><4 hex random>,
+    the run creates <generation>, <generation>_dedup and so on and points the file log row of the version at it
+    """
+    return "{}_g{:08x}{}".format(_generation_base(file_name), int(time.time()), uuid.uuid4().hex[:4])
+
+
+def local_staging_path(local_csv, file_name, generation=None):
+    """ the local copy of a file for a load run, the file name stays the suffix for the compression check """
+    if generation is None:
+        return local_csv + '/' + file_name
+    return local_csv + '/' + generation.rsplit('_g', 1)[1] + '_' + file_name
+
+
+def staging_base_name(file_name, file_modify_time):
+    """ the staging generation a file version was loaded to, merges read <generation>_dedup
+    :return: tmp_table_name of the file log row, the file name without extension for a row without it
+    """
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    log_file_table = config['mysql_tables']['log_file']
+    generation_sql = "select tmp_table_name from " + log_file_table + \
+                     " where file_name = %s and file_hdfs_time = %s and status = 'success'"
+    query_result = mysql_executor(generation_sql, (file_name, file_modify_time))
+    if len(query_result) > 0 and query_result[0][0]:
+        return query_result[0][0]
+    return file_name.split('.')[0]
+
+
+def gc_staging_generations(file_name):
+    """ drop the staging tables and the local copies of the old generations of a file.
+    kept are the generations of the [postgre] staging_generations_keep (default 2) latest loaded versions,
+    so a merge still reading the previous one is not broken, of the latest row whatever its status,
+    so a failed load can resume, and the generations started within a day, which may still be loading.
+    a table in use is skipped at once and dropped by a later run, the merge checkpoints of the dropped
+    tables are deleted with purge_merge_checkpoints. the local copies in csv_base of the generations
+    older than a day without a table left are removed, e.g. of a run which failed in the fetch
+    :return: number of tables dropped
+    """
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    log_file_table = config['mysql_tables']['log_file']
+    pg_cfg = config['postgre']
+    tmp_schema = pg_cfg['tmp_schema']
+    keep_count = int(pg_cfg.get('staging_generations_keep', 2))
+    base_name = file_name.split('.')[0].lower()
+
+    generation_sql = "select tmp_table_name, status from " + log_file_table + \
+                     " where file_name = %s and tmp_table_name is not null" + \
+                     " order by file_hdfs_time desc, start_time desc"
+    keep_set = set()
+    success_count = 0
+    for i, (tmp_table_name, status) in enumerate(mysql_executor(generation_sql, (file_name,))):
+        if i == 0 or (status == "success" and success_count < keep_count):
+            keep_set.add(tmp_table_name.lower())
+        if status == "success":
+            success_count += 1
+
+    # the tables named after the file without a generation are the generation of the older loads
+    generation_base = _generation_base(file_name)
+    table_pattern = re.compile("^(" + re.escape(base_name) + "|" + re.escape(generation_base) +
+                               "_g([0-9a-f]{8})[0-9a-f]{4})(_dedup.*)?$")
+    recent_time = int(time.time()) - 86400
+    drop_dict = dict()
+    # the generations which keep a table, their local copies are kept as well
+    live_set = set()
+    with db_pool.pg_connection(tmp_schema) as conn:
+        cur = conn.cursor()
+        cur.execute("select tablename from pg_tables where schemaname = %s"
+                    " and (tablename like %s or tablename like %s)",
+                    (tmp_schema, base_name + '%', generation_base + '%'))
+        for table_name, in cur.fetchall():
+            matched = table_pattern.match(table_name)
+            if not matched:
+                continue
+            if matched.group(1) in keep_set or (matched.group(2) and int(matched.group(2), 16) > recent_time):
+                live_set.add(matched.group(1))
+                continue
+            drop_dict.setdefault(matched.group(1), list()).append(table_name)
+
+        drop_count = 0
+        for generation, table_list in drop_dict.items():
+            try:
+                # a merge reading the table holds a lock, do not queue behind it
+                cur.execute("set local lock_timeout = '1s'")
+                cur.execute("drop table if exists " + ", ".join(table_list))
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print("Drop staging generation {} later, {}".format(generation, str(e)))
+                live_set.add(generation)
+                continue
+            drop_count += len(table_list)
+
+    # the local copies of the dropped generations and of the runs which failed before they created a table
+    local_csv = config['paths']['csv_base']
+    file_pattern = re.compile("^([0-9a-f]{8})[0-9a-f]{4}_" + re.escape(file_name) + "$")
+    for local_name in os.listdir(local_csv) if os.path.isdir(local_csv) else list():
+        matched = file_pattern.match(local_name)
+        if not matched or int(matched.group(1), 16) > recent_time:
+            continue
+        generation = (generation_base + "_g" + local_name.split('_', 1)[0]).lower()
+        if generation in keep_set or generation in live_set:
+            continue
+        try:
+            os.remove(os.path.join(local_csv, local_name))
+        except OSError as e:
+            print("Remove local copy {} later, {}".format(local_name, str(e)))
+    if drop_count:
+        print("Dropped {} tables of {} old staging generations of {}".format(drop_count, len(drop_dict), file_name))
+        purge_merge_checkpoints(tmp_schema)
+    return drop_count
+
+
+@contextmanager
+def load_lock(file_name, file_modify_time, timeout=0):
+    """ the mysql named lock of a file version, held by the run which loads it, on a connection outside the pool,
+    so the runs holding or waiting for locks cannot take every pooled connection from the load itself
+    :param timeout: seconds to wait for the run holding it
+    :return: True when the lock is taken
+    """
+    lock_name = "tag_etl_load_" + hashlib.md5("{}@{}".format(file_name, file_modify_time).encode()).hexdigest()
+    with db_pool.mysql_dedicated_connection() as mydb:
+        mycursor = mydb.cursor()
+        mycursor.execute("select get_lock(%s, %s)", (lock_name, timeout))
+        locked = mycursor.fetchall()[0][0] == 1
+        try:
+            yield locked
+        finally:
+            if locked:
+                mycursor.execute("select release_lock(%s)", (lock_name,))
+                mycursor.fetchall()
+            mycursor.close()
+
+
+def file_to_tempdb(file_name, file_path, pk_string, tag_storage_type, derived_tuple, file_modify_time=None):
     """load file to tempdb in postgresql
     :param file_name: the file name of algorithm output csv
     :param file_path: the file path in the HDFS
     :param pk_string: primary key list for the target table
     :param tag_storage_type: tag or detail
     :param derived_tuple: a tuple store the information of derived field
+    :param file_modify_time: the modification time if the file was already stated, see file_source.stat_many
     :return: file_modify_time , the time of hdfs csv file modified
     """
 
@@ -405,175 +1965,94 @@ def file_to_tempdb(file_name, file_path, pk_string, tag_storage_type, derived_tu
     pg_cfg = config['postgre']
 
     # Read config values
-    hadoop_cmd = path_cfg['hadoop_cmd']
     log_file_table = mysql_tables_cfg['log_file']
-    local_csv = path_cfg['csv_base']
     tmp_schema = pg_cfg['tmp_schema']
 
-    local_file_path = local_csv + '/' + file_name
-
-    # get file modification time
-    shell_output = subprocess.check_output([hadoop_cmd, 'fs', '-stat', '%y', file_path], encoding='UTF-8')
-    file_modify_time = shell_output.split("\n")[0]
+    # get file modification time, unless the caller stated the files of a run up front
+    if file_modify_time is None:
+        with stage_metrics.stage("hdfs_stat", file_name):
+            file_modify_time = file_source.get_file_source().stat(file_path)
     # 2020-05-28 00:44:20
     file_modify_time_obj = datetime.strptime(file_modify_time, '%Y-%m-%d %H:%M:%S')
     print("{}'s modified @{}".format(file_path, file_modify_time))
 
-    # get table name from file_name
-    tmp_table_name = file_name.split('.')[0]
-
-    # compare file time with log
-    file_log_sql = "select file_hdfs_time, status from " + log_file_table + \
-                   " where file_name = %s " + \
-                   " order by file_hdfs_time desc, start_time desc limit 1"
-    query_result = mysql_executor(file_log_sql, (file_name,))
-    # file_load_status = "processing"
-    if len(query_result) > 0:
-        file_load_status = query_result[0][1]
-        file_time_in_log_obj = query_result[0][0]
-        file_time_in_log = file_time_in_log_obj.strftime("%Y-%m-%d %H:%M:%S")
-    else:
-        file_load_status = "fail"
-        file_time_in_log = "1970-01-01 00:00:00"
-        file_time_in_log_obj = datetime.strptime(file_time_in_log, '%Y-%m-%d %H:%M:%S')
-
-    # file load error log
-    file_log_result_sql = "insert into " + log_file_table + \
-                          "(file_name,file_path,file_hdfs_time,end_time,status,error_msg) " + \
-                          " values (%s, %s, %s, %s, %s, %s)" + \
-                          " on DUPLICATE KEY UPDATE end_time=%s, status=%s, error_msg=%s"
-
-    # if status is processing, wait
-    if file_load_status == "processing":
-        print("Original File load status: {}".format(file_load_status))
-        sleep_time = 30
-        # wait 10 minute at most
-        while sleep_time < 600 and file_load_status == "processing":
-            time.sleep(sleep_time)
-            wait_result = mysql_executor(file_log_sql, (file_name,))
-            file_load_status = wait_result[0][1]
-            sleep_time = sleep_time * 2
-            print("wait for {} processing another {} seconds...".format(file_name, sleep_time))
-
-        if sleep_time >= 600:
-            error_msg = "file processing overtime"
-            end_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            file_error_val = (
-                file_name, file_path, file_modify_time, end_time, "fail", error_msg, end_time, "fail", error_msg)
-            mysql_executor(file_log_result_sql, file_error_val)
-            raise FileloadError(error_msg)
-
-    # if status is success,
-    if file_load_status == "success":
-        print("Original File load status: {}".format(file_load_status))
-        if file_modify_time_obj <= file_time_in_log_obj:
-            # try:
-            #    end_time_string = load_csv_to_pg(tmp_table_name, local_file_path, pk_string)
-            # except:
-            #    error_msg = "COPY csv to PG temp table fail..."
-            #    raise FileloadError(error_msg)
-            # else:
-            print("CSV File in HDFS and table in the PG have same timestamp, no need to load.")
-            return file_modify_time
+    # one run loads a version at a time, the others wait for its lock and find the version loaded,
+    # the lock of a died run is released with its connection
+    processing_timeout = int(pg_cfg.get('processing_timeout', 3600))
+    with load_lock(file_name, file_modify_time, processing_timeout) as locked:
+        if not locked:
+            raise FileloadError("file processing overtime")
+
+        # compare file time with log
+        file_log_sql = "select file_hdfs_time, status, tmp_table_name from " + log_file_table + \
+                       " where file_name = %s " + \
+                       " order by file_hdfs_time desc, start_time desc limit 1"
+        query_result = mysql_executor(file_log_sql, (file_name,))
+        # file_load_status = "processing"
+        if len(query_result) > 0:
+            file_load_status = query_result[0][1]
+            file_time_in_log_obj = query_result[0][0]
+            file_time_in_log = file_time_in_log_obj.strftime("%Y-%m-%d %H:%M:%S")
+            generation_in_log = query_result[0][2]
         else:
-            # start copy new data to local
-            ## set log to processing
-            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            file_log_sql = "insert into " + log_file_table + \
-                           "(file_name,file_path,file_hdfs_time,start_time,status, tmp_table_schema, tmp_table_name) " + \
-                           " values (%s, %s, %s, %s, %s, %s, %s)"
-            # " on DUPLICATE KEY UPDATE start_time=%s, status=%s"
-            val = (file_name, file_path, file_modify_time, current_time, "processing", tmp_schema, tmp_table_name)
-            mysql_executor(file_log_sql, val)
-            # start copy file to local
-            ret_rm = subprocess.run(['rm', local_csv + '/' + file_name])
-            ret = subprocess.run([hadoop_cmd, 'fs', '-get', file_path, local_csv])
-            if ret.returncode == 0:
-                print(file_name + " copy to local success...")
-                # start load data to tmp table
-                try:
-                    end_time_string = load_csv_to_pg(tmp_table_name, local_file_path, pk_string, tag_storage_type, derived_tuple)
-                except Exception as e:
-                    error_msg = (str(e))
-                    end_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    file_error_val = (
-                        file_name, file_path, file_modify_time, end_time, "fail", error_msg, end_time, "fail",
-                        error_msg)
-                    mysql_executor(file_log_result_sql, file_error_val)
-                    raise FileloadError(error_msg)
-                else:
-                    end_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    file_success_val = (file_name, file_path, file_modify_time, end_time, "success", None,
-                                        end_time, "success", None)
-                    mysql_executor(file_log_result_sql, file_success_val)
-                    return file_modify_time
-
+            file_load_status = "fail"
+            file_time_in_log = "1970-01-01 00:00:00"
+            file_time_in_log_obj = datetime.strptime(file_time_in_log, '%Y-%m-%d %H:%M:%S')
+            generation_in_log = None
+
+        # if status is processing, the run which loaded the version died, its lock is free,
+        # a live run of another version loads into its own staging generation
+        if file_load_status == "processing":
+            print("Original File load status: {}".format(file_load_status))
+
+        # if status is success,
+        if file_load_status == "success":
+            print("Original File load status: {}".format(file_load_status))
+            if file_modify_time_obj <= file_time_in_log_obj:
+                # try:
+                #    end_time_string = load_csv_to_pg(tmp_table_name, local_file_path, pk_string)
+                # except:
+                #    error_msg = "COPY csv to PG temp table fail..."
+                #    raise FileloadError(error_msg)
+                # else:
+                print("CSV File in HDFS and table in the PG have same timestamp, no need to load.")
+                return file_modify_time
             else:
-                # write HDFS get fail to log table and raise exception
-                print(file_name + " copy to local fail.")
-                end_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                error_msg = "Hadoop get to local fail..."
-                file_error_val = (file_name, file_path, file_modify_time, end_time, "fail", error_msg,
-                                  end_time, "fail", error_msg)
-                mysql_executor(file_log_result_sql, file_error_val)
-                raise FileloadError(error_msg)
-
-    # if status is fail, just start csv file loading
-    if file_load_status == "fail":
-        print("Original File load status: {}".format(file_load_status))
+                # an unchanged content is not loaded again, only the new time is logged
+                checksum = file_checksum(file_path)
+                if skip_unchanged(file_name, file_path, file_modify_time, checksum):
+                    return file_modify_time
+                # start copy new data to local
+                ## set log to processing
+                generation = new_staging_generation(file_name)
+                current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                file_log_sql = "insert into " + log_file_table + \
+                               "(file_name,file_path,file_hdfs_time,start_time,status, tmp_table_schema," + \
+                               " tmp_table_name) values (%s, %s, %s, %s, %s, %s, %s)"
+                # " on DUPLICATE KEY UPDATE start_time=%s, status=%s"
+                val = (file_name, file_path, file_modify_time, current_time, "processing", tmp_schema, generation)
+                mysql_executor(file_log_sql, val)
+                return fetch_and_load(file_name, file_path, file_modify_time, pk_string, tag_storage_type,
+                                      derived_tuple, checksum, generation)
+
+        # if status is fail or processing, just start csv file loading
+        checksum = file_checksum(file_path)
+        if skip_unchanged(file_name, file_path, file_modify_time, checksum):
+            return file_modify_time
+        # a retry of the failed or died load of the version continues in its generation, see open_load_checkpoint
+        if file_time_in_log == file_modify_time and generation_in_log:
+            generation = generation_in_log
+        else:
+            generation = new_staging_generation(file_name)
         # start copy new data to local
         ## set log to processing
         current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         file_log_sql = "insert into " + log_file_table + \
-                       "(file_name,file_path,file_hdfs_time,start_time,status) " + \
-                       " values (%s, %s, %s, %s, %s)" + \
-                       " on DUPLICATE KEY UPDATE start_time=%s, status=%s"
-        val = (file_name, file_path, file_modify_time, current_time, "processing", current_time, "processing")
+                       "(file_name,file_path,file_hdfs_time,start_time,status, tmp_table_schema, tmp_table_name) " + \
+                       " values (%s, %s, %s, %s, %s, %s, %s)" + \
+                       " on DUPLICATE KEY UPDATE tmp_table_name=%s, start_time=%s, status=%s"
+        val = (file_name, file_path, file_modify_time, current_time, "processing", tmp_schema, generation,
+               generation, current_time, "processing")
         mysql_executor(file_log_sql, val)
-        # start copy file to local
-        ret_rm = subprocess.run(['rm', local_csv + '/' + file_name])
-        ret = subprocess.run([hadoop_cmd, 'fs', '-get', file_path, local_csv])
-        if ret.returncode == 0:
-            print(file_name + " copy to local success...")
-            # start load data to tmp table
-            try:
-                end_time_string = load_csv_to_pg(tmp_table_name, local_file_path, pk_string, tag_storage_type, derived_tuple)
-            except Exception as e:
-                error_msg = (str(e))
-                end_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                file_error_val = (
-                    file_name, file_path, file_modify_time, end_time, "fail", error_msg, end_time, "fail", error_msg)
-                mysql_executor(file_log_result_sql, file_error_val)
-                raise FileloadError(error_msg)
-            else:
-                end_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                file_success_val = (file_name, file_path, file_modify_time, end_time, "success", None,
-                                    end_time, "success", None)
-                mysql_executor(file_log_result_sql, file_success_val)
-                return file_modify_time
-        else:
-            # write HDFS get fail to log table and raise exception
-            print(file_name + " copy to local fail.")
-            end_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            error_msg = "Hadoop get to local fail..."
-            file_error_val = (
-                file_name, file_path, file_modify_time, end_time, "fail", error_msg, end_time, "fail", error_msg)
-            mysql_executor(file_log_result_sql, file_error_val)
-            raise FileloadError(error_msg)
-
-
-def column_set_null(schema_name, table_name, column_name):
-    """set whole column value to null
-    :param schema_name: schema name of target table
-    :param table_name: target table name
-    :param column_name: column to be set null
-    :return:
-    """
-
-    set_sql = "update {} set {} = NULL".format(table_name, column_name)
-    try:
-        postgre_executor(schema_name, set_sql, None)
-    except Exception as e:
-        print(str(e))
-    else:
-        print("Column {} of {} is set to null.".format(column_name, table_name))
\ No newline at end of file
+        return fetch_and_load(file_name, file_path, file_modify_time, pk_string, tag_storage_type, derived_tuple,
+                              checksum, generation)
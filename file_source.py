@@ -0,0 +1,235 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+
+import configparser
+import hashlib
+import io
+import os
+import shutil
+import subprocess
+import threading
+from datetime import datetime, timezone
+from custom_exception import *
+import csv_stream
+
+# modification times are compared as text in the log tables, in UTC like `hadoop fs -stat %y`
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class FileSource(object):
+    """ where the algorithm output files are read from, override every method in subclass """
+
+    def stat(self, path):
+        """ :return: modification time string of a file, see TIME_FORMAT """
+        stat_dict = self.stat_many([path])
+        if path not in stat_dict:
+            raise FileloadError("Stat {} fail, the file cannot be found.".format(path))
+        return stat_dict[path]
+
+    def stat_many(self, path_list):
+        """ stat several files at once, the files which cannot be stated are left out
+        :return: dict, path -> modification time string
+        """
+        raise NotImplementedError
+
+    def fetch(self, path, local_file_path, resume=False):
+        """ copy a file to the local file system
+        :param resume: continue a partial local copy from its size, a source which cannot seek starts over
+        :return: bytes of the local copy
+        """
+        raise NotImplementedError
+
+    def open_stream(self, path):
+        """ :return: binary file like object of the file content, closing it checks the read succeeded """
+        raise NotImplementedError
+
+    def checksum(self, path):
+        """ checksum of the file content, equal checksums mean equal content
+        :return: "<algorithm>:<value>", None when the source cannot tell
+        """
+        return None
+
+
+def md5_file(local_file_path):
+    """ checksum of a local file, in the format of FileSource.checksum """
+    digest = hashlib.md5()
+    with open(local_file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return "MD5:" + digest.hexdigest()
+
+
+class HadoopCliSource(FileSource):
+    """ the `hadoop fs` command line, every call starts a JVM so several paths are stated in one call
+    :param hadoop_cmd: the hadoop command
+    :param stream_cmd: reader command of open_stream, {path} is replaced by the file path
+    """
+
+    def __init__(self, hadoop_cmd, stream_cmd=None):
+        self.hadoop_cmd = hadoop_cmd
+        self.stream_cmd = stream_cmd if stream_cmd else hadoop_cmd + ' fs -cat {path}'
+
+    def stat_many(self, path_list):
+        path_list = list(path_list)
+        if not path_list:
+            return dict()
+        ret = subprocess.run([self.hadoop_cmd, 'fs', '-stat', '%y'] + path_list, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, encoding='UTF-8')
+        time_list = [x for x in ret.stdout.split("\n") if x]
+        if ret.returncode == 0 and len(time_list) == len(path_list):
+            return dict(zip(path_list, time_list))
+
+        # a missing file stops the output, stat one by one to find it
+        if len(path_list) > 1:
+            stat_dict = dict()
+            for path in path_list:
+                stat_dict.update(self.stat_many([path]))
+            return stat_dict
+        print("Hadoop stat {} fail: {}".format(path_list[0], ret.stderr.strip()[-1000:]))
+        return dict()
+
+    def fetch(self, path, local_file_path, resume=False):
+        # `fs -get` cannot start at an offset, the download starts over
+        if os.path.exists(local_file_path):
+            os.remove(local_file_path)
+        ret = subprocess.run([self.hadoop_cmd, 'fs', '-get', path, local_file_path])
+        if ret.returncode != 0:
+            raise FileloadError("Hadoop get to local fail...")
+        return os.path.getsize(local_file_path)
+
+    def open_stream(self, path):
+        return csv_stream.open_command_stream(self.stream_cmd, path)
+
+    def checksum(self, path):
+        # the namenode combines the block checksums, the file is not read
+        ret = subprocess.run([self.hadoop_cmd, 'fs', '-checksum', path], stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, encoding='UTF-8')
+        field_list = ret.stdout.strip().split("\t")
+        if ret.returncode != 0 or len(field_list) < 3:
+            print("Hadoop checksum {} fail: {}".format(path, ret.stderr.strip()[-1000:]))
+            return None
+        return "{}:{}".format(field_list[1], field_list[2])
+
+
+class PyArrowHdfsSource(FileSource):
+    """ native HDFS client of pyarrow, one connection per process and no JVM start per call
+    :param host: name node host, default reads fs.defaultFS of the hadoop configuration
+    :param port: name node port, 0 with host default
+    :param user: hdfs user, None means the current user
+    """
+
+    def __init__(self, host='default', port=0, user=None):
+        try:
+            from pyarrow import fs
+        except ImportError:
+            raise ImportError("[file_source] type = pyarrow needs the pyarrow package.")
+        self.fs = fs
+        self.hdfs = fs.HadoopFileSystem(host, port, user=user)
+
+    def stat_many(self, path_list):
+        path_list = list(path_list)
+        stat_dict = dict()
+        # the infos are in the order of the paths, info.path may be normalized
+        for path, info in zip(path_list, self.hdfs.get_file_info(path_list)):
+            if info.type == self.fs.FileType.NotFound:
+                print("HDFS file {} not found.".format(path))
+                continue
+            stat_dict[path] = info.mtime.astimezone(timezone.utc).strftime(TIME_FORMAT)
+        return stat_dict
+
+    def fetch(self, path, local_file_path, resume=False):
+        offset = os.path.getsize(local_file_path) if resume and os.path.exists(local_file_path) else 0
+        try:
+            with self.hdfs.open_input_file(path) as src, open(local_file_path, 'ab' if offset else 'wb') as dst:
+                if offset:
+                    print("Resume get {} at byte {}".format(path, offset))
+                    src.seek(offset)
+                shutil.copyfileobj(src, dst, 1 << 20)
+        except OSError as e:
+            raise FileloadError("HDFS get {} to local fail: {}".format(path, str(e)))
+        return os.path.getsize(local_file_path)
+
+    def open_stream(self, path):
+        try:
+            stream = self.hdfs.open_input_stream(path)
+        except OSError as e:
+            raise FileloadError("HDFS open {} fail: {}".format(path, str(e)))
+        return io.BufferedReader(csv_stream.RawInput(stream), 1 << 20)
+
+
+class LocalFileSource(FileSource):
+    """ files on a local or mounted file system
+    :param root: directory the file paths are relative to, empty means the paths are used as they are
+    """
+
+    def __init__(self, root=''):
+        self.root = root
+
+    def local_path(self, path):
+        return os.path.join(self.root, path.lstrip('/')) if self.root else path
+
+    def stat_many(self, path_list):
+        stat_dict = dict()
+        for path in path_list:
+            try:
+                mtime = os.path.getmtime(self.local_path(path))
+            except OSError as e:
+                print("Stat {} fail: {}".format(path, str(e)))
+                continue
+            stat_dict[path] = datetime.fromtimestamp(int(mtime), timezone.utc).strftime(TIME_FORMAT)
+        return stat_dict
+
+    def fetch(self, path, local_file_path, resume=False):
+        offset = os.path.getsize(local_file_path) if resume and os.path.exists(local_file_path) else 0
+        try:
+            with open(self.local_path(path), 'rb') as src, open(local_file_path, 'ab' if offset else 'wb') as dst:
+                if offset:
+                    print("Resume copy {} at byte {}".format(path, offset))
+                    src.seek(offset)
+                shutil.copyfileobj(src, dst, 1 << 20)
+        except OSError as e:
+            raise FileloadError("Copy {} to local fail: {}".format(path, str(e)))
+        return os.path.getsize(local_file_path)
+
+    def open_stream(self, path):
+        try:
+            return open(self.local_path(path), 'rb')
+        except OSError as e:
+            raise FileloadError("Open {} fail: {}".format(path, str(e)))
+
+    def checksum(self, path):
+        try:
+            return md5_file(self.local_path(path))
+        except OSError as e:
+            print("Checksum {} fail: {}".format(path, str(e)))
+            return None
+
+
+_source = None
+_source_lock = threading.Lock()
+
+
+def get_file_source():
+    """ the process wide file source of [file_source] type: hadoop_cli (default), pyarrow or local
+    hadoop_cli uses [paths] hadoop_cmd and stream_cmd, pyarrow uses [file_source] host, port and user,
+    local uses [file_source] root
+    """
+    global _source
+    with _source_lock:
+        if _source is None:
+            config = configparser.ConfigParser()
+            config.read('connection.cfg')
+            source_cfg = config['file_source'] if config.has_section('file_source') else dict()
+            source_type = source_cfg.get('type', 'hadoop_cli')
+            if source_type == "pyarrow":
+                _source = PyArrowHdfsSource(source_cfg.get('host', 'default'), int(source_cfg.get('port', 0)),
+                                            source_cfg.get('user'))
+            elif source_type == "local":
+                _source = LocalFileSource(source_cfg.get('root', ''))
+            elif source_type == "hadoop_cli":
+                path_cfg = config['paths']
+                _source = HadoopCliSource(path_cfg['hadoop_cmd'], path_cfg.get('stream_cmd'))
+            else:
+                raise Exception("[file_source] type {} is not supported.".format(source_type))
+            print("File source: {}".format(type(_source).__name__))
+        return _source
@@ -0,0 +1,258 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+
+import atexit
+import configparser
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+import db_pool
+
+_insert_pattern = re.compile(r"^\s*insert\s+into\s+(\S+?)\s*\((.*)\)\s+values\s+(\(.*\))\s*$",
+                             re.IGNORECASE | re.DOTALL)
+
+
+class LogSink(object):
+    """ write telemetry rows on a background thread, the rows of the same insert statement are written
+    in multi-row inserts, so a slow mysql does not hold up the sync.
+    only rows nothing reads back belong here, e.g. the stage metrics and the fail rows of the tag log,
+    the file log and the success rows of the tag log decide the next loads and merges and are written
+    with etl_toolbox.mysql_executor at once. a row appended after close is written at once.
+    a batch which fails max_attempts times is written row by row, a row which still fails is appended
+    to the dead letter file as a json line, so one bad row cannot hold up the rows behind it
+    :param flush_interval: seconds a row waits at most before it is written
+    :param batch_size: rows per insert statement, a full batch is written at once
+    :param max_queue: rows waiting at most, a writer blocks beyond, so the queue cannot grow without bound
+    :param max_attempts: failed writes of a batch before it is written row by row
+    :param dead_letter_path: file of the rows which cannot be written
+    """
+
+    def __init__(self, flush_interval=1.0, batch_size=500, max_queue=10000, max_attempts=3,
+                 dead_letter_path="log_sink_dead_letter.jsonl"):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self.dead_letter_path = dead_letter_path
+        self._attempts = 0
+        self._cond = threading.Condition()
+        self._rows = list()
+        self._flush_requested = False
+        self._writing = False
+        self._closed = False
+        # finished write rounds, a flush waits for the round which takes its rows
+        self._round = 0
+        self._error_round = 0
+        self.stats = {"queued": 0, "written": 0, "batches": 0, "errors": 0, "dead_letter": 0, "max_queue_depth": 0,
+                      "flush_ms_last": None, "flush_ms_max": None, "flush_ms_total": 0.0, "flushes": 0}
+        self._thread = threading.Thread(target=self._run, name="log-sink", daemon=True)
+        self._thread.start()
+
+    def append(self, insert_sql, values):
+        """ queue one row
+        :param insert_sql: "insert into <table>(<columns>) values (%s, ...)"
+        :param values: tuple, the values of the row
+        """
+        matched = _insert_pattern.match(insert_sql)
+        if matched is None:
+            raise ValueError("Not a single row insert: {}".format(insert_sql))
+        statement = (matched.group(1), matched.group(2), matched.group(3))
+        with self._cond:
+            while len(self._rows) >= self.max_queue and not self._closed:
+                self._flush_requested = True
+                self._cond.notify_all()
+                self._cond.wait()
+            closed = self._closed
+            if not closed:
+                self._rows.append((statement, tuple(values)))
+                self.stats["queued"] += 1
+                self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], len(self._rows))
+                if len(self._rows) >= self.batch_size:
+                    self._cond.notify_all()
+        # the thread is stopped, e.g. a worker still finishing at exit, the row is written at once
+        if closed:
+            row_list = [(statement, tuple(values))]
+            if not self._write(row_list):
+                self._write_each(row_list)
+
+    def flush(self, timeout=None):
+        """ wait until the rows queued before the call are written
+        :return: True when they are written, False after a failed write or the timeout
+        """
+        with self._cond:
+            if not self._rows and not self._writing:
+                return True
+            # the round being written has taken the rows queued before it, the next round takes the rest
+            start_round = self._round
+            target_round = start_round + (2 if self._writing and self._rows else 1)
+            self._flush_requested = True
+            self._cond.notify_all()
+            self._cond.wait_for(lambda: self._round >= target_round or self._closed, timeout)
+            return self._round >= target_round and self._error_round <= start_round
+
+    def close(self):
+        """ stop the thread and write the rows left, called at exit """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        with self._cond:
+            row_list = self._rows
+            self._rows = list()
+        if row_list and not self._write(row_list):
+            self._write_each(row_list)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._closed or self._flush_requested or
+                                    len(self._rows) >= self.batch_size, self.flush_interval)
+                if self._closed:
+                    return
+                row_list = self._rows
+                self._rows = list()
+                self._flush_requested = False
+                self._writing = True
+            written = self._write(row_list) if row_list else True
+            if not written:
+                self._attempts += 1
+                if self._attempts >= self.max_attempts:
+                    # the rows which can be written are, the others go to the dead letter file
+                    self._write_each(row_list)
+                    written = True
+            if written:
+                self._attempts = 0
+            with self._cond:
+                self._round += 1
+                if not written:
+                    # kept in order for the next round, the rows queued meanwhile follow them
+                    self._rows = row_list + self._rows
+                    self._error_round = self._round
+                self._writing = False
+                self._cond.notify_all()
+            if not written:
+                time.sleep(self.flush_interval)
+
+    def _write(self, row_list):
+        """ write the rows grouped by statement, batch_size rows per insert
+        :return: True when every row is written
+        """
+        statement_dict = dict()
+        for statement, values in row_list:
+            statement_dict.setdefault(statement, list()).append(values)
+
+        start = time.perf_counter()
+        try:
+            with db_pool.mysql_connection() as mydb:
+                mycursor = mydb.cursor()
+                batch_count = 0
+                for (table_name, column_string, row_string), value_list in statement_dict.items():
+                    for i in range(0, len(value_list), self.batch_size):
+                        batch = value_list[i:i + self.batch_size]
+                        insert_sql = "insert into {}({}) values {}".format(table_name, column_string,
+                                                                          ", ".join([row_string] * len(batch)))
+                        mycursor.execute(insert_sql, tuple([x for values in batch for x in values]))
+                        batch_count += 1
+                mydb.commit()
+                mycursor.close()
+        except Exception as e:
+            with self._cond:
+                self.stats["errors"] += 1
+            print("Log sink write {} rows fail: {}".format(len(row_list), str(e)))
+            return False
+
+        flush_ms = (time.perf_counter() - start) * 1000
+        with self._cond:
+            self.stats["written"] += len(row_list)
+            self.stats["batches"] += batch_count
+            self.stats["flushes"] += 1
+            self.stats["flush_ms_last"] = round(flush_ms, 1)
+            self.stats["flush_ms_max"] = round(max(self.stats["flush_ms_max"] or 0, flush_ms), 1)
+            self.stats["flush_ms_total"] += flush_ms
+        return True
+
+    def _write_each(self, row_list):
+        """ write the rows one by one, append the failing ones to the dead letter file """
+        dead_list = list()
+        for statement, values in row_list:
+            if not self._write([(statement, values)]):
+                dead_list.append((statement, values))
+        if not dead_list:
+            return
+        try:
+            with open(self.dead_letter_path, 'a') as f:
+                for (table_name, column_string, row_string), values in dead_list:
+                    f.write(json.dumps({"table": table_name, "columns": column_string, "values": values},
+                                       default=str) + "\n")
+        except OSError as e:
+            print("Log sink cannot write the dead letter file {}: {}".format(self.dead_letter_path, str(e)))
+        with self._cond:
+            self.stats["dead_letter"] += len(dead_list)
+        print("Log sink moved {} rows to {}".format(len(dead_list), self.dead_letter_path))
+
+    def get_stats(self):
+        """ :return: dict of counters, queue_depth and the flush latency in milliseconds """
+        with self._cond:
+            stats = dict(self.stats)
+            stats["queue_depth"] = len(self._rows)
+        stats["flush_ms_avg"] = round(stats["flush_ms_total"] / stats["flushes"], 1) if stats["flushes"] else None
+        stats["flush_ms_total"] = round(stats["flush_ms_total"], 1)
+        return stats
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def get_sink():
+    """ the process wide sink, None unless [log_sink] buffered = true, the other keys are
+    flush_interval (default 1 second), batch_size (500), max_queue (10000), max_attempts (3)
+    and dead_letter_path (log_sink_dead_letter.jsonl)
+    """
+    global _sink
+    with _sink_lock:
+        if _sink is None:
+            config = configparser.ConfigParser()
+            config.read('connection.cfg')
+            sink_cfg = config['log_sink'] if config.has_section('log_sink') else dict()
+            if sink_cfg.get('buffered', 'false') != 'true':
+                return None
+            _sink = LogSink(float(sink_cfg.get('flush_interval', 1.0)), int(sink_cfg.get('batch_size', 500)),
+                            int(sink_cfg.get('max_queue', 10000)), int(sink_cfg.get('max_attempts', 3)),
+                            sink_cfg.get('dead_letter_path', 'log_sink_dead_letter.jsonl'))
+            atexit.register(_sink.close)
+        return _sink
+
+
+def flush(timeout=None):
+    """ write the waiting rows, e.g. before a failure is reported
+    :return: True when nothing is left
+    """
+    if _sink is None:
+        return True
+    return _sink.flush(timeout)
+
+
+@contextmanager
+def flush_on_error():
+    """ the rows of a failed sync are written before the error leaves the block """
+    try:
+        yield
+    except BaseException:
+        flush()
+        raise
+
+
+def sink_stats():
+    """ :return: dict of the sink counters, empty when the sink is off """
+    return _sink.get_stats() if _sink is not None else dict()
+
+
+def close():
+    """ write the waiting rows and stop the sink thread """
+    if _sink is not None:
+        _sink.close()
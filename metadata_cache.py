@@ -0,0 +1,261 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+
+import configparser
+import threading
+import time
+
+
+class TTLCache(object):
+    """ thread safe cache of metadata query results, an entry expires ttl seconds after it was loaded,
+    the expired entries are purged once per ttl, so keys which are not asked again, e.g. the columns of
+    old staging generations, do not pile up in a long running worker
+    :param ttl: seconds an entry is valid, 0 disables the cache
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = dict()
+        self._stats = dict()
+        self._next_purge = time.monotonic() + ttl
+        self._purged = 0
+
+    def _count(self, namespace, name):
+        stats = self._stats.setdefault(namespace, {"hit": 0, "miss": 0, "expired": 0})
+        stats[name] += 1
+
+    def get(self, namespace, key, loader, cache_empty=True):
+        """ get a value, load and cache it when missing or expired
+        :param namespace: kind of metadata, e.g. task_rules, derived, primary_key
+        :param key: hashable key inside the namespace
+        :param loader: function without argument returning the value
+        :param cache_empty: cache an empty value too, otherwise it is loaded again next time
+        :return: the value
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            if entry is not None and entry[0] > now:
+                self._count(namespace, "hit")
+                return entry[1]
+            self._count(namespace, "expired" if entry is not None else "miss")
+            if entry is not None:
+                del self._entries[(namespace, key)]
+
+        # load outside the lock, a concurrent miss of the same key only loads twice
+        value = loader()
+        if self.ttl > 0 and (cache_empty or value):
+            self.put(namespace, key, value)
+        return value
+
+    def put(self, namespace, key, value):
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._next_purge:
+                self._purge(now)
+            self._entries[(namespace, key)] = (now + self.ttl, value)
+
+    def _purge(self, now):
+        """ drop the expired entries, called with the lock held """
+        drop_list = [x for x, entry in self._entries.items() if entry[0] <= now]
+        for x in drop_list:
+            del self._entries[x]
+        self._purged += len(drop_list)
+        self._next_purge = now + self.ttl
+
+    def invalidate(self, namespace=None, key=None):
+        """ drop entries, all of a namespace when key is None, everything when namespace is None too
+        :return: number of entries dropped
+        """
+        with self._lock:
+            drop_list = [x for x in self._entries
+                         if (namespace is None or x[0] == namespace) and (key is None or x[1] == key)]
+            for x in drop_list:
+                del self._entries[x]
+        return len(drop_list)
+
+    def get_stats(self):
+        """ :return: dict of size, purged and hit, miss, expired and hit_rate per namespace """
+        with self._lock:
+            stats = {"size": len(self._entries), "ttl": self.ttl, "purged": self._purged}
+            for namespace, counts in self._stats.items():
+                total = counts["hit"] + counts["miss"] + counts["expired"]
+                stats[namespace] = dict(counts, hit_rate=round(counts["hit"] / total, 3) if total else None)
+        return stats
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """ the process wide cache, [cache] ttl_seconds default 300 """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            config = configparser.ConfigParser()
+            config.read('connection.cfg')
+            cache_cfg = config['cache'] if config.has_section('cache') else dict()
+            _cache = TTLCache(int(cache_cfg.get('ttl_seconds', 300)))
+        return _cache
+
+
+def _mysql_tables():
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    return config['mysql_tables']
+
+
+def get_task_rules(task_id):
+    """ all sync rules of a task in one query, loaded once for every tag of the task
+    :return: list of (tag_name_en, src_file_name, src_file_path, schema_name, table_name, tag_data_type,
+     tag_storage_type, upload_method)
+    """
+    # imported here, etl_toolbox imports this module
+    import etl_toolbox as tb
+
+    def load():
+        task_detail_sql = "select tag_name_en, src_file_name, src_file_path, schema_name, table_name, " + \
+                          " tag_data_type, tag_storage_type, upload_method from " + \
+                          _mysql_tables()['sync_rule'] + \
+                          " where task_id = %s "
+        return tb.mysql_executor(task_detail_sql, (task_id,))
+
+    return get_cache().get("task_rules", task_id, load, cache_empty=False)
+
+
+def get_task_detail(task_id, tag_name_en):
+    """ the sync rule of one tag, a tag missing from the cached rules of its task reloads them once
+    :return: (src_file_name, src_file_path, schema_name, table_name, tag_data_type, tag_storage_type,
+     upload_method) or None
+    """
+    for refresh in [False, True]:
+        if refresh:
+            get_cache().invalidate("task_rules", task_id)
+        for rule in get_task_rules(task_id):
+            if rule[0] == tag_name_en:
+                return tuple(rule[1:])
+    return None
+
+
+def get_derived_tuple(target_schema, target_table, file_name):
+    """ get the derived field information of a file<>table relation
+    :param target_schema: schema of the target table
+    :param target_table: the target table
+    :param file_name: the source file name
+    :return: (derived_field, "source_column:derived_value:tag_name,...") or empty tuple
+    """
+    import etl_toolbox as tb
+
+    def load():
+        # check if target table has derived field, currently only support only 1 derived field.
+        # !! It bases on the file<>table relation level !!
+        check_derived_sql = "select derived_field, " + \
+                            "group_concat(concat(derived_source_column, ':', derived_value, ':', tag_name_en)) " + \
+                            " from " + \
+                            _mysql_tables()['sync_rule'] + \
+                            " where schema_name = %s and table_name = %s and src_file_name = %s " + \
+                            " and derived_field is not null" + \
+                            " and derived_value is not null" + \
+                            " and derived_source_column is not null" + \
+                            " group by derived_field"
+        derived_list = tb.mysql_executor(check_derived_sql, (target_schema, target_table, file_name))
+        if len(derived_list) > 1:
+            error_msg = "{} has more than 1 derived field, which not supported.".format(target_table)
+            raise Exception(error_msg)
+        return tuple(derived_list[0]) if derived_list else tuple()
+
+    return get_cache().get("derived", (target_schema, target_table, file_name), load)
+
+
+def get_primary_key(target_table):
+    """ get the primary key string of a target table
+    :return: the primary key string, None when it is not configured
+    """
+    import etl_toolbox as tb
+
+    def load():
+        get_pk_sql = "select primary_key from " + _mysql_tables()['pk_table'] + \
+                     " where table_name = %s"
+        pk_string = tb.mysql_executor(get_pk_sql, (target_table,))
+        return pk_string[0][0] if pk_string else None
+
+    return get_cache().get("primary_key", target_table, load, cache_empty=False)
+
+
+def get_file_rules(file_name):
+    """ the tag rules of all tasks sourced from a file, used to type the staging columns
+    :return: list of (tag_name_en, tag_data_type, derived_source_column)
+    """
+    import etl_toolbox as tb
+
+    def load():
+        rule_sql = "select tag_name_en, tag_data_type, derived_source_column from " + \
+                   _mysql_tables()['sync_rule'] + \
+                   " where src_file_name = %s"
+        return tb.mysql_executor(rule_sql, (file_name,))
+
+    return get_cache().get("file_rules", file_name, load)
+
+
+def get_table_columns(schema_name, table_name):
+    """ the column names of a postgresql table, loaders put the columns of the staging tables they create
+    :return: list of field names
+    """
+    import etl_toolbox as tb
+    return get_cache().get("columns", (schema_name, table_name),
+                           lambda: tb.postgre_desc_table(schema_name, table_name))
+
+
+def preload_task(task_id):
+    """ load the rules of a task with the derived fields and primary keys of all its target tables,
+    three queries whatever the number of tags
+    :return: number of rules of the task
+    """
+    import etl_toolbox as tb
+    cache = get_cache()
+    cache.invalidate("task_rules", task_id)
+    rule_list = get_task_rules(task_id)
+    if not rule_list:
+        return 0
+    tables_cfg = _mysql_tables()
+
+    relation_list = sorted(set([(x[3], x[4], x[1]) for x in rule_list]))
+    derived_sql = "select schema_name, table_name, src_file_name, derived_field, " + \
+                  "group_concat(concat(derived_source_column, ':', derived_value, ':', tag_name_en)) " + \
+                  " from " + tables_cfg['sync_rule'] + \
+                  " where (schema_name, table_name, src_file_name) in (" + \
+                  ", ".join(["(%s, %s, %s)"] * len(relation_list)) + ")" + \
+                  " and derived_field is not null" + \
+                  " and derived_value is not null" + \
+                  " and derived_source_column is not null" + \
+                  " group by schema_name, table_name, src_file_name, derived_field"
+    derived_dict = dict()
+    for row in tb.mysql_executor(derived_sql, tuple([y for x in relation_list for y in x])):
+        derived_dict.setdefault(tuple(row[:3]), list()).append(tuple(row[3:]))
+    for relation in relation_list:
+        # more than 1 derived field is left to get_derived_tuple to report
+        if len(derived_dict.get(relation, [])) <= 1:
+            cache.put("derived", relation, derived_dict[relation][0] if relation in derived_dict else tuple())
+
+    table_list = sorted(set([x[4] for x in rule_list]))
+    pk_sql = "select table_name, primary_key from " + tables_cfg['pk_table'] + \
+             " where table_name in (" + ", ".join(["%s"] * len(table_list)) + ")"
+    for table_name, primary_key in tb.mysql_executor(pk_sql, tuple(table_list)):
+        cache.put("primary_key", table_name, primary_key)
+
+    print("Preload metadata of task {}: {} rules, {} relations, {} tables".format(
+        task_id, len(rule_list), len(relation_list), len(table_list)))
+    return len(rule_list)
+
+
+def invalidate(namespace=None, key=None):
+    """ drop cached metadata, call it after the rule tables are changed
+    :return: number of entries dropped
+    """
+    return get_cache().invalidate(namespace, key)
+
+
+def cache_stats():
+    return get_cache().get_stats()
@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+
+import configparser
+import contextvars
+import json
+import logging
+import time
+from contextlib import contextmanager
+from datetime import datetime
+import log_sink
+
+logger = logging.getLogger("tag_sync.stage")
+
+_current_recorder = contextvars.ContextVar("stage_recorder", default=None)
+
+
+class StageMetric(object):
+    """ measurement of one stage, set rows and bytes inside the stage block
+    :param name: stage name
+    :param file_name: the source file the stage works on
+    """
+
+    def __init__(self, name, file_name=None):
+        self.name = name
+        self.file_name = file_name
+        self.start_time = datetime.now()
+        self.seconds = None
+        self.rows = None
+        self.bytes = None
+        self.status = "success"
+        self.detail = dict()
+
+    def to_dict(self):
+        return {"stage": self.name, "file_name": self.file_name,
+                "start_time": self.start_time.strftime("%Y-%m-%d %H:%M:%S"),
+                "seconds": None if self.seconds is None else round(self.seconds, 4),
+                "rows": self.rows, "bytes": self.bytes, "status": self.status,
+                "detail": self.detail or None}
+
+
+class StageRecorder(object):
+    """ collect the stage metrics of one sync request
+    :param request_id: the id provided by app to link the original log
+    :param task_id: unique id for the tag sync task
+    :param tag_name_en: English name of tag, None for a multi tag sync
+    """
+
+    def __init__(self, request_id, task_id, tag_name_en):
+        self.request_id = request_id
+        self.task_id = task_id
+        self.tag_name_en = tag_name_en
+        self.metric_list = list()
+
+    def add(self, metric):
+        self.metric_list.append(metric)
+
+    def summary(self):
+        """ :return: dict, stage -> total seconds """
+        summary = dict()
+        for metric in self.metric_list:
+            summary[metric.name] = round(summary.get(metric.name, 0) + (metric.seconds or 0), 4)
+        return summary
+
+    def persist(self):
+        """ write the metrics to [mysql_tables] stage_metrics in one multi-row insert, or queue them to the
+        buffered log_sink, skipped when not configured
+        the table columns are request_id, sync_task_id, tag_name_en, file_name, stage, start_time,
+        duration_ms, row_count, byte_count, status, detail
+        """
+        config = configparser.ConfigParser()
+        config.read('connection.cfg')
+        metrics_table = config['mysql_tables'].get('stage_metrics') if config.has_section('mysql_tables') else None
+        if not metrics_table or not self.metric_list:
+            return
+
+        # imported here, etl_toolbox imports this module
+        import etl_toolbox as tb
+        row_list = list()
+        for metric in self.metric_list:
+            row_list.append((self.request_id, self.task_id, self.tag_name_en, metric.file_name, metric.name,
+                             metric.start_time.strftime("%Y-%m-%d %H:%M:%S"),
+                             None if metric.seconds is None else int(metric.seconds * 1000),
+                             metric.rows, metric.bytes, metric.status,
+                             json.dumps(metric.detail) if metric.detail else None))
+        metrics_sql = "insert into " + metrics_table + \
+                      "(request_id, sync_task_id, tag_name_en, file_name, stage, start_time, " + \
+                      "duration_ms, row_count, byte_count, status, detail) values "
+        row_sql = "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+
+        # the buffered sink batches the rows with the metrics of the other requests
+        sink = log_sink.get_sink()
+        if sink is not None:
+            for row in row_list:
+                sink.append(metrics_sql + row_sql, row)
+            return
+        metrics_sql = metrics_sql + ", ".join([row_sql] * len(row_list))
+        value_list = [x for row in row_list for x in row]
+        try:
+            tb.mysql_executor(metrics_sql, tuple(value_list))
+        except Exception as e:
+            # metrics must never fail the sync
+            print("Write stage metrics fail: {}".format(str(e)))
+
+
+def _emit(metric):
+    recorder = _current_recorder.get()
+    log_dict = metric.to_dict()
+    if recorder is not None:
+        recorder.add(metric)
+        log_dict.update({"request_id": recorder.request_id, "task_id": recorder.task_id,
+                         "tag_name_en": recorder.tag_name_en})
+    logger.info(json.dumps(log_dict, default=str))
+
+
+@contextmanager
+def recording(request_id, task_id, tag_name_en=None):
+    """ collect the stages run inside the block for one sync request and persist them at the end
+    :return: StageRecorder
+    """
+    recorder = StageRecorder(request_id, task_id, tag_name_en)
+    token = _current_recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _current_recorder.reset(token)
+        print("Stage timing of request {}: {}".format(request_id, recorder.summary()))
+        recorder.persist()
+
+
+@contextmanager
+def stage(name, file_name=None):
+    """ measure a stage, the metric is logged and added to the current recording, if any
+    :param name: stage name, e.g. rule_lookup, hdfs_stat, fetch, hash, copy, dedup, derive, merge
+    :param file_name: the source file the stage works on
+    :return: StageMetric, set its rows, bytes and detail in the block
+    """
+    metric = StageMetric(name, file_name)
+    start = time.perf_counter()
+    try:
+        yield metric
+    except BaseException:
+        metric.status = "fail"
+        raise
+    finally:
+        metric.seconds = time.perf_counter() - start
+        _emit(metric)
+
+
+def record(name, seconds, rows=None, bytes=None, file_name=None):
+    """ add a stage measured elsewhere, e.g. time spent hashing inside the COPY stream """
+    metric = StageMetric(name, file_name)
+    metric.seconds = seconds
+    metric.rows = rows
+    metric.bytes = bytes
+    _emit(metric)
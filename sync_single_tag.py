@@ -3,17 +3,47 @@
 
 import argparse
 import configparser
+import logging
+import db_pool
 import etl_toolbox as tb
+import file_source
+import log_sink
+import metadata_cache
+import stage_metrics
 from custom_exception import *
 from datetime import datetime
 
 
-def sync_single_task(task_id, tag_name_en, request_id=None):
+def get_derived_tuple(target_schema, target_table, file_name):
+    """ get the derived field information of a file<>table relation
+    :param target_schema: schema of the target table
+    :param target_table: the target table
+    :param file_name: the source file name
+    :return: (derived_field, "source_column:derived_value:tag_name,...") or empty tuple
+    """
+    # the lookup query is in metadata_cache, the result is cached per file<>table relation
+    derived_tuple = metadata_cache.get_derived_tuple(target_schema, target_table, file_name)
+    if not derived_tuple:
+        print("{} is not a derived table".format(target_table))
+    return derived_tuple
+
+
+def sync_single_task(task_id, tag_name_en, request_id=None, file_loader=None):
     """ interface for system to start single tag synchronization
     :param task_id: unique id for the tag sync tssk
     :param tag_name_en: English name of tag
     :param request_id: the id provided by app to link the original log
+    :param file_loader: function with the interface of etl_toolbox.file_to_tempdb, default is that function
     """
+    # every stage is timed and written to [mysql_tables] stage_metrics with the request id,
+    # the buffered metrics of a failed sync are written before the error is raised, see log_sink
+    with log_sink.flush_on_error(), stage_metrics.recording(request_id, task_id, tag_name_en):
+        _sync_single_task(task_id, tag_name_en, request_id, file_loader)
+
+
+def _sync_single_task(task_id, tag_name_en, request_id, file_loader):
+    if file_loader is None:
+        file_loader = tb.file_to_tempdb
 
     # Access connection file
     config = configparser.ConfigParser()
@@ -23,128 +53,306 @@ def sync_single_task(task_id, tag_name_en, request_id=None):
     tab_list = config['mysql_tables']
     cfg_table = tab_list['sync_rule']
 
-    mysql_tables_cfg = config['mysql_tables']
-
-    log_file_table = mysql_tables_cfg['log_file']
-    log_tag_table = mysql_tables_cfg['log_tag']
-    cfg_pk_table = mysql_tables_cfg['pk_table']
-
     # Get the source schema
     pg_cfg = config['postgre']
     temp_schema = pg_cfg['tmp_schema']
 
-    # get tag sync detail, generate sql
-    task_detail_sql = "select src_file_name, src_file_path, schema_name, table_name, tag_data_type, " + \
-                      " tag_storage_type, upload_method from " + \
-                      cfg_table + \
-                      " where task_id = %s and tag_name_en = %s "
-    task_detail_val = (task_id, tag_name_en)
+    # get tag sync detail, the rules of all tags of the task are loaded and cached at once
+    with stage_metrics.stage("rule_lookup") as metric:
+        task_detail = metadata_cache.get_task_detail(task_id, tag_name_en)
+        task_detail_list = [task_detail] if task_detail else list()
+        metric.rows = len(task_detail_list)
 
-    task_detail_list = tb.mysql_executor(task_detail_sql, task_detail_val)
-
-    print("The Execute parameters: {}".format(task_detail_list))
-    # start get execute parameters
-    if len(task_detail_list) > 0:
-        file_name = task_detail_list[0][0]
-        file_path = task_detail_list[0][1]
-        target_schema = task_detail_list[0][2]
-        target_table = task_detail_list[0][3]
-        tag_data_type = task_detail_list[0][4]
-        tag_storage_type = task_detail_list[0][5]
-        tag_upload_method = task_detail_list[0][6]
-    else:
-        error_msg = "The task id cannot get request record in {}.".format(cfg_table)
-        raise Exception(error_msg)
+        print("The Execute parameters: {}".format(task_detail_list))
+        # start get execute parameters
+        if len(task_detail_list) > 0:
+            file_name = task_detail_list[0][0]
+            file_path = task_detail_list[0][1]
+            target_schema = task_detail_list[0][2]
+            target_table = task_detail_list[0][3]
+            tag_data_type = task_detail_list[0][4]
+            tag_storage_type = task_detail_list[0][5]
+            tag_upload_method = task_detail_list[0][6]
+        else:
+            error_msg = "The task id cannot get request record in {}.".format(cfg_table)
+            raise Exception(error_msg)
 
-    # check if target table has derived field, currently only support only 1 derived field.
-    # !! It bases on the file<>table relation level !!
-    check_derived_sql = "select derived_field, " + \
-                        "group_concat(concat(derived_source_column, ':', derived_value, ':', tag_name_en)) " + \
-                        " from " +\
-                        cfg_table + \
-                        " where schema_name = %s and table_name = %s and src_file_name = %s " + \
-                        " and derived_field is not null" + \
-                        " and derived_value is not null" + \
-                        " and derived_source_column is not null" + \
-                        " group by derived_field"
-    check_derived_val = (target_schema, target_table, file_name)
-    derived_list = tb.mysql_executor(check_derived_sql, check_derived_val)
-    derived_tuple = tuple()
-    if len(derived_list) == 0:
-        print("{} is not a derived table".format(target_table))
-    elif len(derived_list) == 1:
-        derived_tuple = derived_list[0]
-    else:
-        error_msg = "{} has more than 1 derived field, which not supported.".format(target_table)
-        raise Exception(error_msg)
+        metric.file_name = file_name
+        derived_tuple = get_derived_tuple(target_schema, target_table, file_name)
 
-    # log write sql
-    tag_log_sql = "insert into " + log_tag_table + \
-                  "(request_id, sync_task_id, tag_name_en, file_name, file_hdfs_time, " + \
-                  "start_time, end_time, status, error_msg) " + \
-                  " values (%s, %s, %s, %s, %s, %s, %s, %s, %s)"
+    # the start time of the tag log rows, see write_tag_logs
     start_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
     # get table primary key list
-    get_pk_sql = "select primary_key from " + cfg_pk_table + \
-                 " where table_name = %s"
-    val = (target_table,)
-    pk_string = tb.mysql_executor(get_pk_sql, val)
+    with stage_metrics.stage("pk_lookup", file_name):
+        primary_key = metadata_cache.get_primary_key(target_table)
+    pk_string = [(primary_key,)] if primary_key else list()
     if len(pk_string) == 0:
-        end_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         error_msg = target_table + " Primary key cannot be fetched."
-        tag_log_val = (request_id, task_id, tag_name_en, file_name, None,
-                       start_time, end_time, "fail", error_msg)
-        tb.mysql_executor(tag_log_sql, tag_log_val)
+        write_tag_logs(request_id, task_id, [(tag_name_en,)], file_name, None, start_time, "fail", error_msg)
         raise LookupError(error_msg)
 
     # add data to temp table and delete duplicates
     try:
-        file_modify_time = tb.file_to_tempdb(file_name, file_path, pk_string[0][0], tag_storage_type, derived_tuple)
+        file_modify_time = file_loader(file_name, file_path, pk_string[0][0], tag_storage_type, derived_tuple)
     except FileloadError as e:
-        end_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        tag_log_val = (request_id, task_id, tag_name_en, file_name, None,
-                       start_time, end_time, "fail", str(e))
-        tb.mysql_executor(tag_log_sql, tag_log_val)
+        write_tag_logs(request_id, task_id, [(tag_name_en,)], file_name, None, start_time, "fail", str(e))
     else:
-        # if upload method is full, need set null for that column
-        if tag_upload_method == "full":
-            tb.column_set_null(target_schema, target_table, tag_name_en)
+        temp_table = tb.staging_base_name(file_name, file_modify_time) + "_dedup"
+        if derived_tuple:
+            temp_table = temp_table + "_derived"
+        # merge only the changed rows when the delta of this file version can be used
+        temp_table, deleted_table = tb.delta_merge_source(file_name, file_modify_time, temp_table, [tag_name_en])
+
+        # if upload method is full, values of keys absent from the file are set to null,
+        # in the merge transaction, for the deleted keys of the delta or the keys absent from the source
+        full_tag_list = [tag_name_en] if tag_upload_method == "full" else None
 
         # start merge tags
         try:
-            temp_table = file_name.split(".")[0] + "_dedup"
-            if derived_tuple:
-                temp_table = temp_table + "_derived"
             print("Start to tag merge {}.{} ===> {}.{}...".format(temp_schema, temp_table, target_schema, target_table))
-            tb.merge_tag(temp_schema, temp_table, target_schema, target_table, pk_string[0][0], tag_name_en,
-                         tag_data_type)
+            with stage_metrics.stage("merge", file_name) as metric:
+                if tb.content_merged(file_name, file_modify_time, [tag_name_en], target_table):
+                    metric.detail = {"skipped": "unchanged content"}
+                else:
+                    merge_report = tb.merge_tags(temp_schema, temp_table, target_schema, target_table,
+                                                 pk_string[0][0], [(tag_name_en, tag_data_type)], full_tag_list,
+                                                 deleted_table)
+                    metric.rows = merge_report["merged"]
+                    metric.detail = {"source_table": temp_table, "nulled": merge_report["nulled"],
+                                     "strategy": merge_report["plan"]["strategy"] if merge_report["plan"]
+                                     else "batched"}
         except Exception as e:
-            end_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            tag_log_val = (request_id, task_id, tag_name_en, file_name, None,
-                           start_time, end_time, "fail", str(e))
-            tb.mysql_executor(tag_log_sql, tag_log_val)
+            write_tag_logs(request_id, task_id, [(tag_name_en,)], file_name, None, start_time, "fail", str(e))
             raise Exception(str(e))
         else:
-            end_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            tag_log_val = (request_id, task_id, tag_name_en, file_name, file_modify_time,
-                           start_time, end_time, "success", None)
-            tb.mysql_executor(tag_log_sql, tag_log_val)
+            write_tag_logs(request_id, task_id, [(tag_name_en,)], file_name, file_modify_time, start_time,
+                           "success", None)
+
+
+def sync_multi_task(task_id, tag_name_list=None, src_file_name=None, request_id=None, file_loader=None):
+    """ interface to synchronize several tags of one task, the tags sourced from the same file
+    and the same target table are loaded once and merged in one statement
+    :param task_id: unique id for the tag sync task
+    :param tag_name_list: English names of tags, None means all tags of the task
+    :param src_file_name: only sync the tags sourced from this file, None means no filter
+    :param request_id: the id provided by app to link the original log
+    :param file_loader: function with the interface of etl_toolbox.file_to_tempdb, default is that function
+    """
+    # the stages of all groups are recorded under the request id, the file name tells the groups apart
+    with log_sink.flush_on_error(), stage_metrics.recording(request_id, task_id):
+        _sync_multi_task(task_id, tag_name_list, src_file_name, request_id, file_loader)
+
+
+def _sync_multi_task(task_id, tag_name_list, src_file_name, request_id, file_loader):
+    group_dict = plan_task_groups(task_id, tag_name_list, src_file_name)
+
+    # stat all source files up front, one call of the file source instead of one per group,
+    # a file missing here is stated again by the loader which fails its group only
+    with stage_metrics.stage("hdfs_stat") as metric:
+        stat_dict = file_source.get_file_source().stat_many(sorted(set([x[1] for x in group_dict])))
+        metric.rows = len(stat_dict)
+
+    error_list = list()
+    for group_key, detail_list in group_dict.items():
+        error_msg = sync_group(request_id, task_id, group_key, detail_list, file_loader, stat_dict.get(group_key[1]))
+        if error_msg:
+            error_list.append(error_msg)
+
+    if error_list:
+        raise Exception("; ".join(error_list))
+
+
+def plan_task_groups(task_id, tag_name_list=None, src_file_name=None):
+    """ get the sync rules of the tags and group them by file and target table, keep the order of the rule table
+    :param task_id: unique id for the tag sync task
+    :param tag_name_list: English names of tags, None means all tags of the task
+    :param src_file_name: only sync the tags sourced from this file, None means no filter
+    :return: dict, (file_name, file_path, schema_name, table_name, tag_storage_type) -> list of rule rows
+     (tag_name_en, src_file_name, src_file_path, schema_name, table_name, tag_data_type, tag_storage_type,
+     upload_method)
+    """
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    cfg_table = config['mysql_tables']['sync_rule']
+
+    # get all tag sync details of the task with the derived fields and primary keys of their tables
+    with stage_metrics.stage("rule_lookup") as metric:
+        metadata_cache.preload_task(task_id)
+        task_detail_list = metadata_cache.get_task_rules(task_id)
+        metric.rows = len(task_detail_list)
+    if tag_name_list is not None:
+        task_detail_list = [x for x in task_detail_list if x[0] in tag_name_list]
+        missing_list = [x for x in tag_name_list if x not in [y[0] for y in task_detail_list]]
+        if missing_list:
+            error_msg = "The task id cannot get request record of {} in {}.".format(",".join(missing_list), cfg_table)
+            raise Exception(error_msg)
+    if src_file_name is not None:
+        task_detail_list = [x for x in task_detail_list if x[1] == src_file_name]
+    if len(task_detail_list) == 0:
+        error_msg = "The task id cannot get request record in {}.".format(cfg_table)
+        raise Exception(error_msg)
+
+    print("The Execute parameters: {}".format(task_detail_list))
+
+    group_dict = dict()
+    for detail in task_detail_list:
+        group_key = (detail[1], detail[2], detail[3], detail[4], detail[6])
+        group_dict.setdefault(group_key, list()).append(detail)
+    return group_dict
+
+
+def write_tag_logs(request_id, task_id, detail_list, file_name, file_hdfs_time, start_time, status, error_msg):
+    """ write one tag log row per tag of a group, the success rows in one multi-row insert at once,
+    they decide the next merges, see etl_toolbox.content_merged, the fail rows are read by nobody
+    and are queued to the buffered log_sink when it is on
+    """
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    log_tag_table = config['mysql_tables']['log_tag']
+
+    # log write sql
+    tag_log_sql = "insert into " + log_tag_table + \
+                  "(request_id, sync_task_id, tag_name_en, file_name, file_hdfs_time, " + \
+                  "start_time, end_time, status, error_msg) values "
+    row_sql = "(%s, %s, %s, %s, %s, %s, %s, %s, %s)"
+    end_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    row_list = [(request_id, task_id, detail[0], file_name, file_hdfs_time, start_time, end_time, status, error_msg)
+                for detail in detail_list]
+    if not row_list:
+        return
+
+    sink = log_sink.get_sink() if status != "success" else None
+    if sink is not None:
+        for row in row_list:
+            sink.append(tag_log_sql + row_sql, row)
+        return
+    tb.mysql_executor(tag_log_sql + ", ".join([row_sql] * len(row_list)), tuple([x for row in row_list for x in row]))
+
+
+def load_group(group_key, file_loader=None, file_modify_time=None):
+    """ load the source file of a group of tags to tempdb
+    :param group_key: (file_name, file_path, schema_name, table_name, tag_storage_type), see plan_task_groups
+    :param file_loader: function with the interface of etl_toolbox.file_to_tempdb, default is that function
+    :param file_modify_time: the modification time if the file was already stated
+    :return: (pk_string, derived_tuple, file_modify_time), raise LookupError without primary key
+     and FileloadError when the load fails
+    """
+    if file_loader is None:
+        file_loader = tb.file_to_tempdb
+    file_name, file_path, target_schema, target_table, tag_storage_type = group_key
+
+    with stage_metrics.stage("rule_lookup", file_name):
+        derived_tuple = get_derived_tuple(target_schema, target_table, file_name)
+
+    # get table primary key list
+    with stage_metrics.stage("pk_lookup", file_name):
+        pk_string = metadata_cache.get_primary_key(target_table)
+    if not pk_string:
+        raise LookupError(target_table + " Primary key cannot be fetched.")
+
+    # add data to temp table and delete duplicates
+    file_modify_time = file_loader(file_name, file_path, pk_string, tag_storage_type, derived_tuple, file_modify_time)
+    return pk_string, derived_tuple, file_modify_time
+
+
+def merge_group(group_key, detail_list, pk_string, derived_tuple, file_modify_time):
+    """ merge all tags of a group at once from the staging table loaded by load_group
+    :param group_key: (file_name, file_path, schema_name, table_name, tag_storage_type), see plan_task_groups
+    :param detail_list: the rule rows of the group
+    :param pk_string: primary key string of the target table
+    :param derived_tuple: tuple of derived field information
+    :param file_modify_time: the time of hdfs csv file modified
+    """
+    file_name, file_path, target_schema, target_table, tag_storage_type = group_key
+
+    # the tags hold the values of this content already
+    if tb.content_merged(file_name, file_modify_time, [x[0] for x in detail_list], target_table):
+        with stage_metrics.stage("merge", file_name) as metric:
+            metric.detail = {"skipped": "unchanged content", "tags": len(detail_list)}
+        return
+
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    temp_schema = config['postgre']['tmp_schema']
+
+    # the staging generation the version was loaded to
+    temp_table = tb.staging_base_name(file_name, file_modify_time) + "_dedup"
+    if derived_tuple:
+        temp_table = temp_table + "_derived"
+    # merge only the changed rows when the delta of this file version can be used
+    temp_table, deleted_table = tb.delta_merge_source(file_name, file_modify_time, temp_table,
+                                                      [x[0] for x in detail_list])
+
+    # if upload method is full, values of keys absent from the file are set to null,
+    # in the merge transaction, for the deleted keys of the delta or the keys absent from the source
+    full_tag_list = [x[0] for x in detail_list if x[7] == "full"]
+
+    print("Start to tag merge {}.{} ===> {}.{}...".format(temp_schema, temp_table, target_schema, target_table))
+    with stage_metrics.stage("merge", file_name) as metric:
+        merge_report = tb.merge_tags(temp_schema, temp_table, target_schema, target_table, pk_string,
+                                     [(x[0], x[5]) for x in detail_list], full_tag_list or None, deleted_table)
+        metric.rows = merge_report["merged"]
+        metric.detail = {"source_table": temp_table, "tags": len(detail_list), "nulled": merge_report["nulled"],
+                         "strategy": merge_report["plan"]["strategy"] if merge_report["plan"] else "batched"}
+
+
+def sync_group(request_id, task_id, group_key, detail_list, file_loader=None, file_modify_time=None):
+    """ load and merge a group of tags, write the result of every tag to the tag log
+    :return: None on success, the error message on failure
+    """
+    file_name = group_key[0]
+    start_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        pk_string, derived_tuple, file_modify_time = load_group(group_key, file_loader, file_modify_time)
+    except (LookupError, FileloadError) as e:
+        write_tag_logs(request_id, task_id, detail_list, file_name, None, start_time, "fail", str(e))
+        return str(e)
+
+    try:
+        merge_group(group_key, detail_list, pk_string, derived_tuple, file_modify_time)
+    except Exception as e:
+        write_tag_logs(request_id, task_id, detail_list, file_name, None, start_time, "fail", str(e))
+        return str(e)
+    write_tag_logs(request_id, task_id, detail_list, file_name, file_modify_time, start_time, "success", None)
+    return None
 
 
 if __name__ == '__main__':
     # Setup command line arguments.
     parser = argparse.ArgumentParser()
     parser.add_argument('task_id', help='the unique id of task to sync tag')
-    parser.add_argument('tag_name_en', help='English name of tag')
+    parser.add_argument('tag_name_en', nargs='*',
+                        help='English name of tag, several names are merged together, none means all tags')
+    parser.add_argument('--file', dest='src_file_name', default=None,
+                        help='only sync the tags sourced from this file')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='overlap the fetch, load and merge of different files, see [pipeline]')
     #parser.add_argument('request_id', help='the id provided by app to link the original log')
 
     # Parse arguments.
     args = parser.parse_args()
     task_id = args.task_id
-    tag_name_en = args.tag_name_en
+    tag_name_list = args.tag_name_en
     #request_id = args.request_id
     request_id = 0
+    # the stage metrics are logged as one json object per line
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
 
     # get task detail
-    sync_single_task(task_id, tag_name_en, request_id)
+    try:
+        if args.pipeline:
+            # imported here, batch_pipeline imports this module
+            import batch_pipeline
+            batch_pipeline.sync_batch(task_id, tag_name_list or None, args.src_file_name, request_id)
+        elif len(tag_name_list) == 1 and args.src_file_name is None:
+            sync_single_task(task_id, tag_name_list[0], request_id)
+        else:
+            sync_multi_task(task_id, tag_name_list or None, args.src_file_name, request_id)
+    finally:
+        print("Metadata cache stats: {}".format(metadata_cache.cache_stats()))
+        # the buffered metrics are written before the connections are closed
+        log_sink.close()
+        print("Log sink stats: {}".format(log_sink.sink_stats()))
+        print("Connection pool stats: {}".format(db_pool.pool_stats()))
+        db_pool.close_all()
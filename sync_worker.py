@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+
+import argparse
+import configparser
+import json
+import logging
+import os
+import queue
+import signal
+import socket
+import socketserver
+import threading
+from concurrent.futures import Future
+import db_pool
+import etl_toolbox as tb
+import log_sink
+import metadata_cache
+from sync_single_tag import sync_single_task
+
+
+class FileLoadCoordinator(object):
+    """ coalesce concurrent loads of the same file inside the worker process,
+    the first job loads the file and the others wait on the same future,
+    so they are notified as soon as the load ends instead of polling the log table
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loading = dict()
+        self.stats = {"load": 0, "coalesced": 0}
+
+    def file_to_tempdb(self, file_name, file_path, pk_string, tag_storage_type, derived_tuple, file_modify_time=None):
+        """ same interface as etl_toolbox.file_to_tempdb """
+        with self._lock:
+            future = self._loading.get(file_name)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._loading[file_name] = future
+                self.stats["load"] += 1
+            else:
+                self.stats["coalesced"] += 1
+
+        if not owner:
+            print("{} is loading by another job, wait for it...".format(file_name))
+            return future.result()
+
+        try:
+            file_modify_time = tb.file_to_tempdb(file_name, file_path, pk_string, tag_storage_type, derived_tuple,
+                                                 file_modify_time)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(file_modify_time)
+            return file_modify_time
+        finally:
+            with self._lock:
+                del self._loading[file_name]
+
+
+class SyncWorker(object):
+    """ pool of threads running sync jobs from a local queue with warm connections
+    :param workers: number of worker threads
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.jobs = queue.Queue()
+        self.coordinator = FileLoadCoordinator()
+        self.stats = {"done": 0, "fail": 0}
+        self._stats_lock = threading.Lock()
+        self._threads = list()
+
+    def submit(self, task_id, tag_name_en, request_id=None):
+        """ put a job to the queue
+        :return: Future of the job, the result is None or the exception of the sync
+        """
+        future = Future()
+        self.jobs.put((task_id, tag_name_en, request_id, future))
+        return future
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            task_id, tag_name_en, request_id, future = job
+            print("Start job task_id={} tag={} request_id={}".format(task_id, tag_name_en, request_id))
+            try:
+                sync_single_task(task_id, tag_name_en, request_id, file_loader=self.coordinator.file_to_tempdb)
+            except Exception as e:
+                print("Job task_id={} tag={} fail: {}".format(task_id, tag_name_en, str(e)))
+                with self._stats_lock:
+                    self.stats["fail"] += 1
+                future.set_exception(e)
+            else:
+                with self._stats_lock:
+                    self.stats["done"] += 1
+                future.set_result(None)
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name="sync-worker-{}".format(i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """ finish the queued jobs and stop the threads """
+        for thread in self._threads:
+            self.jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+        log_sink.close()
+        db_pool.close_all()
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats["queue_depth"] = self.jobs.qsize()
+        stats["file_load"] = dict(self.coordinator.stats)
+        stats["pool"] = db_pool.pool_stats()
+        stats["metadata_cache"] = metadata_cache.cache_stats()
+        stats["log_sink"] = log_sink.sink_stats()
+        return stats
+
+
+class JobRequestHandler(socketserver.StreamRequestHandler):
+    """ one json request per line:
+    {"task_id": .., "tag_name_en": .., "request_id": .., "wait": false} queues a job,
+    {"stats": true} returns the worker statistics,
+    {"preload": task_id} caches the rules of a task before a burst of its jobs,
+    {"invalidate": true} drops the cached metadata after the rule tables are changed
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if request.get("stats"):
+                    response = self.server.worker.get_stats()
+                elif request.get("preload") is not None:
+                    response = {"status": "success", "rules": metadata_cache.preload_task(request["preload"])}
+                elif request.get("invalidate"):
+                    response = {"status": "success", "dropped": metadata_cache.invalidate()}
+                else:
+                    future = self.server.worker.submit(request["task_id"], request["tag_name_en"],
+                                                       request.get("request_id"))
+                    if request.get("wait"):
+                        error = future.exception()
+                        response = {"status": "fail" if error else "success", "error_msg": str(error) if error else None}
+                    else:
+                        response = {"status": "queued", "queue_depth": self.server.worker.jobs.qsize()}
+            except Exception as e:
+                response = {"status": "error", "error_msg": str(e)}
+            self.wfile.write((json.dumps(response) + "\n").encode('UTF-8'))
+
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(socket_path, workers):
+    """ run the worker pool and accept jobs from the unix socket until interrupted """
+    worker = SyncWorker(workers)
+    worker.start()
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = JobServer(socket_path, JobRequestHandler)
+    server.worker = worker
+
+    # a service manager stops the worker with SIGTERM, the queued jobs and the buffered metrics are finished
+    # like on an interrupt, shutdown waits for serve_forever and is called from another thread
+    def terminate(signum, frame):
+        threading.Thread(target=server.shutdown, name="sync-worker-shutdown").start()
+    signal.signal(signal.SIGTERM, terminate)
+
+    print("Sync worker listening on {} with {} worker(s)".format(socket_path, workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+        worker.stop()
+        print("Sync worker stats: {}".format(worker.get_stats()))
+
+
+def send_request(socket_path, request):
+    """ send one request to the worker and return its response """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request) + "\n").encode('UTF-8'))
+        sock.shutdown(socket.SHUT_WR)
+        response = sock.makefile('rb').readline()
+    return json.loads(response)
+
+
+if __name__ == '__main__':
+    config = configparser.ConfigParser()
+    config.read('connection.cfg')
+    worker_cfg = config['worker'] if config.has_section('worker') else dict()
+    default_socket = worker_cfg.get('socket_path', '/tmp/tag_sync_worker.sock')
+    default_workers = int(worker_cfg.get('workers', 4))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', default=default_socket, help='unix socket path of the worker')
+    sub_parsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = sub_parsers.add_parser('serve', help='start the worker pool')
+    serve_parser.add_argument('--workers', type=int, default=default_workers, help='number of worker threads')
+    submit_parser = sub_parsers.add_parser('submit', help='queue a tag sync job')
+    submit_parser.add_argument('task_id', help='the unique id of task to sync tag')
+    submit_parser.add_argument('tag_name_en', help='English name of tag')
+    submit_parser.add_argument('--request-id', default=0, help='the id provided by app to link the original log')
+    submit_parser.add_argument('--wait', action='store_true', help='wait until the job is done')
+    sub_parsers.add_parser('stats', help='print the worker statistics')
+    preload_parser = sub_parsers.add_parser('preload', help='cache the rules of a task')
+    preload_parser.add_argument('task_id', help='the unique id of task to sync tag')
+    sub_parsers.add_parser('invalidate', help='drop the cached metadata')
+
+    args = parser.parse_args()
+    if args.command == 'serve':
+        # the stage metrics of the jobs are logged as one json object per line
+        logging.basicConfig(level=logging.INFO, format="%(threadName)s %(message)s")
+        serve(args.socket, args.workers)
+    elif args.command == 'submit':
+        print(send_request(args.socket, {"task_id": args.task_id, "tag_name_en": args.tag_name_en,
+                                         "request_id": args.request_id, "wait": args.wait}))
+    elif args.command == 'preload':
+        print(send_request(args.socket, {"preload": args.task_id}))
+    elif args.command == 'invalidate':
+        print(send_request(args.socket, {"invalidate": True}))
+    else:
+        print(send_request(args.socket, {"stats": True}))
@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+""" the sql of create_derived_table against the union all reference, no database needed.
+the comparison of the two outputs on a live postgresql runs with TAG_ETL_LIVE_CHECK=1,
+from the directory of connection.cfg, see benchmarks/check_derived_unpivot.py
+"""
+
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# etl_toolbox imports the database drivers through db_pool
+pytest.importorskip("psycopg2")
+pytest.importorskip("mysql.connector")
+import etl_toolbox as tb
+
+DERIVED_TUPLE = ("brand", "xx_val:t:val,yy_val:f:val,zz_val:z:val")
+FIELDS_LIST = ["id", "xx_val", "other", "yy_val", "zz_val", "rrn"]
+
+
+def _output_columns(select_str):
+    """ the output names of a select list, the alias when there is one, else the column without its table """
+    column_list = list()
+    for item in select_str.split(","):
+        item = item.strip()
+        matched = re.search(r"\s+as\s+(\w+)$", item)
+        column_list.append(matched.group(1) if matched else item.split(".")[-1])
+    return column_list
+
+
+def _create_sql(sql):
+    """ the create table statement after the drop """
+    drop_sql, create_sql = sql.split(";\n")
+    assert drop_sql == "drop table if exists tmp_file_derived"
+    return create_sql
+
+
+def test_unpivot_scans_the_source_once():
+    create_sql = _create_sql(tb.create_derived_table("tmp", "tmp_file", DERIVED_TUPLE, fields_list=FIELDS_LIST))
+    assert create_sql.startswith("create table tmp_file_derived as")
+    assert "union all" not in create_sql
+    assert create_sql.count(" from ") == 1
+    assert "cross join lateral (values (s.xx_val, 't'), (s.yy_val, 'f'), (s.zz_val, 'z')) as v(val, brand)" \
+        in create_sql
+    assert create_sql.endswith("where v.val is not null")
+
+
+def test_unpivot_unlogged():
+    create_sql = _create_sql(tb.create_derived_table("tmp", "tmp_file", DERIVED_TUPLE, unlogged=True,
+                                                     fields_list=FIELDS_LIST))
+    assert create_sql.startswith("create unlogged table tmp_file_derived as")
+
+
+def test_unpivot_column_order_equals_union_all():
+    unpivot_sql = _create_sql(tb.create_derived_table("tmp", "tmp_file", DERIVED_TUPLE, fields_list=FIELDS_LIST))
+    union_sql = _create_sql(tb.create_derived_table_union("tmp", "tmp_file", DERIVED_TUPLE,
+                                                          fields_list=FIELDS_LIST))
+
+    unpivot_select = re.search(r"select (.*?) from tmp_file s", unpivot_sql).group(1)
+    union_select_list = re.findall(r"select (.*?) from tmp_file where", union_sql)
+    assert len(union_select_list) == 3
+    expected = ["id", "other", "rrn", "val", "brand"]
+    assert _output_columns(unpivot_select) == expected
+    for union_select in union_select_list:
+        assert _output_columns(union_select) == expected
+
+
+@pytest.mark.skipif(os.environ.get("TAG_ETL_LIVE_CHECK") != "1",
+                    reason="compares the outputs on postgresql, set TAG_ETL_LIVE_CHECK=1")
+def test_unpivot_output_equals_union_all_live():
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks',
+                          'check_derived_unpivot.py')
+    result = subprocess.run([sys.executable, script, "--rows", "2000", "--sources", "5"],
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    assert result.returncode == 0, result.stdout
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+""" local stand-in for the `hadoop` command, HDFS paths are mapped under $FAKE_HDFS_ROOT
+point [paths] hadoop_cmd at this script to run the sync without a cluster, supported commands:
+    fake_hadoop.py fs -stat %y <path> [<path> ...]
+    fake_hadoop.py fs -get <path> <local_dir or local_file>
+    fake_hadoop.py fs -cat <path>
+    fake_hadoop.py fs -checksum <path>
+set $FAKE_HDFS_FAIL_AFTER to a byte count to make -cat fail after writing that many bytes
+"""
+
+import hashlib
+import os
+import shutil
+import sys
+from datetime import datetime
+
+
+def local_path(hdfs_path):
+    root = os.environ.get('FAKE_HDFS_ROOT', '/tmp/fake_hdfs')
+    return os.path.join(root, hdfs_path.lstrip('/'))
+
+
+def fs_stat(fmt, path_list):
+    for path in path_list:
+        mtime = datetime.fromtimestamp(int(os.path.getmtime(local_path(path))))
+        sys.stdout.write(fmt.replace('%y', mtime.strftime('%Y-%m-%d %H:%M:%S')).replace('%n', os.path.basename(path))
+                         + "\n")
+
+
+def fs_get(path, local_dir):
+    shutil.copy(local_path(path), local_dir)
+
+
+def fs_cat(path):
+    fail_after = os.environ.get('FAKE_HDFS_FAIL_AFTER')
+    written = 0
+    with open(local_path(path), 'rb') as f:
+        while True:
+            chunk = f.read(1 << 16)
+            if not chunk:
+                break
+            if fail_after is not None and written + len(chunk) > int(fail_after):
+                sys.stdout.buffer.write(chunk[:int(fail_after) - written])
+                sys.stdout.flush()
+                sys.stderr.write("cat: simulated read failure\n")
+                sys.exit(1)
+            sys.stdout.buffer.write(chunk)
+            written += len(chunk)
+
+
+def fs_checksum(path):
+    # same layout as hadoop: path, algorithm and value separated by tabs
+    digest = hashlib.md5()
+    with open(local_path(path), 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    sys.stdout.write("{}\tMD5\t{}\n".format(path, digest.hexdigest()))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4 or sys.argv[1] != 'fs':
+        sys.stderr.write("USAGE: {} fs -stat|-get|-cat|-checksum ...\n".format(sys.argv[0]))
+        sys.exit(1)
+
+    try:
+        if sys.argv[2] == '-stat':
+            fs_stat(sys.argv[3], sys.argv[4:])
+        elif sys.argv[2] == '-get':
+            fs_get(sys.argv[3], sys.argv[4])
+        elif sys.argv[2] == '-cat':
+            fs_cat(sys.argv[3])
+        elif sys.argv[2] == '-checksum':
+            fs_checksum(sys.argv[3])
+        else:
+            sys.stderr.write("{}: Unknown command\n".format(sys.argv[2]))
+            sys.exit(1)
+    except OSError as e:
+        sys.stderr.write("{}: {}\n".format(sys.argv[2], str(e)))
+        sys.exit(1)